@@ -1,3 +1,5 @@
 from memgpt.main import app
 
-app()
+# guarded, since worker processes (sharded archival memory) re-import the main module
+if __name__ == "__main__":
+    app()
@@ -9,6 +9,8 @@ import openai
 
 from .system import get_heartbeat, get_login_event, package_function_response, package_summarize_message, get_initial_boot_messages
 from .memory import CoreMemory as Memory, summarize_messages
+from .journal import load_context_messages
+from .checkpoint_store import CheckpointStore
 from .openai_tools import acompletions_with_backoff as acreate
 from .utils import get_local_time, parse_json, united_diff, printd, count_tokens
 from .constants import \
@@ -151,6 +153,7 @@ class AgentAsync(object):
         # - set_messages
         # - get_messages
         # - append_to_messages
+        # It shares self._messages (see link_messages): the agent updates the list in place, the manager records the changes
         self.persistence_manager = persistence_manager
         if persistence_manager_init:
             # creates a new agent object in the database
@@ -179,15 +182,13 @@ class AgentAsync(object):
         """Trim messages from the front, not including the system message"""
         self.persistence_manager.trim_messages(num)
 
-        new_messages = [self.messages[0]] + self.messages[num:]
-        self._messages = new_messages
+        del self._messages[1:num]
 
     def prepend_to_messages(self, added_messages):
         """Wrapper around self.messages.prepend to allow additional calls to a state/persistence manager"""
         self.persistence_manager.prepend_to_messages(added_messages)
 
-        new_messages = [self.messages[0]] + added_messages + self.messages[1:]  # prepend (no system)
-        self._messages = new_messages
+        self._messages[1:1] = added_messages  # prepend (no system)
         self.messages_total += len(added_messages)  # still should increment the message counter (summaries are additions too)
 
     def append_to_messages(self, added_messages):
@@ -198,9 +199,7 @@ class AgentAsync(object):
         for msg in added_messages:
             msg.pop('api_response', None)
             msg.pop('api_args', None)
-        new_messages = self.messages + added_messages  # append
-
-        self._messages = new_messages
+        self._messages.extend(added_messages)  # append
         self.messages_total += len(added_messages)
 
     def swap_system_message(self, new_system_message):
@@ -209,8 +208,7 @@ class AgentAsync(object):
 
         self.persistence_manager.swap_system_message(new_system_message)
 
-        new_messages = [new_system_message] + self.messages[1:]  # swap index 0 (system)
-        self._messages = new_messages
+        self._messages[0] = new_system_message  # swap index 0 (system)
 
     def rebuild_memory(self):
         """Rebuilds the system message with the latest memory object"""
@@ -244,15 +242,53 @@ class AgentAsync(object):
         }
 
     def save_to_json_file(self, filename):
+        """Save a checkpoint manifest, the system prompt, functions, memory blocks and messages go to the store next to it (see CheckpointStore)"""
+        state = self.to_dict()
+        store = CheckpointStore.next_to(filename)
+        state['store'] = store.path
+        state['system'] = store.put(state['system'])
+        state['functions'] = store.put(state['functions'])
+        state['memory'] = {name: store.put(block) for name, block in state['memory'].items()}
+        journal = getattr(self.persistence_manager, 'journal', None)
+        if journal is not None:
+            # the messages are in the persistence manager's journal already, only record how far into it this checkpoint is
+            state['messages'] = None
+            state['messages_journal'] = {'path': journal.path, 'seq': journal.checkpoint()}
+        else:
+            state['messages'] = [store.put(msg) for msg in state['messages']]
         with open(filename, 'w') as file:
-            json.dump(self.to_dict(), file)
+            json.dump(state, file)
+        # what the checkpoint uses is kept for as long as it is, the rest goes once no other checkpoint uses it either
+        store.pin(filename, [state['system'], state['functions']] + list(state['memory'].values()) + (state['messages'] or []))
+        store.collect_garbage()
+
+    @staticmethod
+    def _state_from_manifest(state):
+        """The full state of a checkpoint, read back from its store (checkpoints saved without one are complete already)"""
+        if state.get('store') is None:
+            return state
+        store = CheckpointStore(state['store'])
+        state = dict(state)
+        state['system'] = store.get(state['system'])
+        state['functions'] = store.get(state['functions'])
+        state['memory'] = {name: store.get(key) for name, key in state['memory'].items()}
+        if state['messages'] is not None:
+            state['messages'] = [store.get(key) for key in state['messages']]
+        return state
+
+    @staticmethod
+    def _messages_from_state(state):
+        if state.get('messages_journal') is not None:
+            return load_context_messages(state['messages_journal']['path'], state['messages_journal']['seq'])
+        return state['messages']
 
     @classmethod
     def load(cls, state, interface, persistence_manager):
+        state = cls._state_from_manifest(state)
         model = state['model']
         system = state['system']
         functions = state['functions']
-        messages = state['messages']
+        messages = cls._messages_from_state(state)
         try:
             messages_total = state['messages_total']
         except KeyError:
@@ -275,9 +311,11 @@ class AgentAsync(object):
             messages_total=messages_total,
         )
         new_agent._messages = messages
+        persistence_manager.link_messages(new_agent._messages)
         return new_agent
 
     def load_inplace(self, state):
+        state = self._state_from_manifest(state)
         self.model = state['model']
         self.system = state['system']
         self.functions = state['functions']
@@ -287,11 +325,13 @@ class AgentAsync(object):
         human_notes = memory_dict['human']
         self.memory = initialize_memory(persona_notes, human_notes)
         # messages also
-        self._messages = state['messages']
+        self._messages = self._messages_from_state(state)
         try:
             self.messages_total = state['messages_total']
         except KeyError:
             self.messages_total = len(self.messages) - 1  # -system
+        # not linked to the current persistence manager, it belongs to a different state: the caller loads the manager
+        # saved with this checkpoint and links the messages to it (see main.load)
 
     @classmethod
     def load_from_json(cls, json_state, interface, persistence_manager):
@@ -467,29 +507,35 @@ class AgentAsync(object):
             if user_message is not None:
                 await self.interface.user_message(user_message)
                 packed_user_message = {'role': 'user', 'content': user_message}
-                input_message_sequence = self.messages + [packed_user_message]
-            else:
-                input_message_sequence = self.messages
+                # sent at the end of the window without copying it, it's only kept once the step succeeds (see Step 4)
+                self._messages.append(packed_user_message)
+            input_message_sequence = self.messages
+            # the window keeps changing after the call (starting with the pop below), api_args records what was sent
+            sent_message_sequence = list(input_message_sequence)
 
-            if len(input_message_sequence) > 1 and input_message_sequence[-1]['role'] != 'user':
-                printd(f"WARNING: attempting to run ChatCompletion without user as the last message in the queue")
+            try:
+                if len(input_message_sequence) > 1 and input_message_sequence[-1]['role'] != 'user':
+                    printd(f"WARNING: attempting to run ChatCompletion without user as the last message in the queue")
 
-            # Step 1: send the conversation and available functions to GPT
-            if not skip_verify and (first_message or self.messages_total == self.messages_total_init):
-                printd(f"This is the first message. Running extra verifier on AI response.")
-                counter = 0
-                while True:
+                # Step 1: send the conversation and available functions to GPT
+                if not skip_verify and (first_message or self.messages_total == self.messages_total_init):
+                    printd(f"This is the first message. Running extra verifier on AI response.")
+                    counter = 0
+                    while True:
 
-                    response = await get_ai_reply_async(model=self.model, message_sequence=input_message_sequence, functions=self.functions)
-                    if self.verify_first_message_correctness(response, require_monologue=self.first_message_verify_mono):
-                        break
+                        response = await get_ai_reply_async(model=self.model, message_sequence=input_message_sequence, functions=self.functions)
+                        if self.verify_first_message_correctness(response, require_monologue=self.first_message_verify_mono):
+                            break
 
-                    counter += 1
-                    if counter > first_message_retry_limit:
-                        raise Exception(f'Hit first message retry limit ({first_message_retry_limit})')
+                        counter += 1
+                        if counter > first_message_retry_limit:
+                            raise Exception(f'Hit first message retry limit ({first_message_retry_limit})')
 
-            else:
-                response = await get_ai_reply_async(model=self.model, message_sequence=input_message_sequence, functions=self.functions)
+                else:
+                    response = await get_ai_reply_async(model=self.model, message_sequence=input_message_sequence, functions=self.functions)
+            finally:
+                if user_message is not None:
+                    self._messages.pop()
 
             # Step 2: check if LLM wanted to call a function
             # (if yes) Step 3: call the function
@@ -505,7 +551,7 @@ class AgentAsync(object):
             assert 'api_args' not in all_response_messages[0]
             all_response_messages[0]['api_args'] = {
                 'model': self.model,
-                'messages': input_message_sequence,
+                'messages': sent_message_sequence,
                 'functions': self.functions,
             }
 
@@ -663,8 +709,8 @@ class AgentAsync(object):
         await self.persistence_manager.archival_memory.insert(content, embedding=None)
         return None
 
-    async def archival_memory_search(self, query, count=5, page=0):
-        results, total = await self.persistence_manager.archival_memory.search(query, count=count, start=page*count)
+    async def archival_memory_search(self, query, count=5, page=0, start_date=None, end_date=None):
+        results, total = await self.persistence_manager.archival_memory.search(query, count=count, start=page*count, start_date=start_date, end_date=end_date)
         num_pages = math.ceil(total / count) - 1  # 0 index
         if len(results) == 0:
             results_str = f"No results found."
@@ -203,7 +203,8 @@ class MemGPTAgent(ConversableAgent):
                 )
             else:
                 # Extend the MemGPT message list with multiple 'user' messages, then push the last one with agent.step()
-                self.agent.messages.extend(new_messages[:-1])
+                # (through the agent, the list is shared with the persistence manager, which records the change)
+                self.agent.append_to_messages(new_messages[:-1])
                 user_message = new_messages[-1]
         elif len(new_messages) == 1:
             user_message = new_messages[0]
@@ -0,0 +1,167 @@
+from functools import reduce
+import hashlib
+import json
+import operator
+import os
+import pickle
+
+from .utils import printd
+
+
+class CheckpointStore(object):
+    """Content-addressed storage shared by the checkpoints saved to one directory
+
+    Every value (a message, the system prompt, the function schemas, a memory block, a pickled memory store) is
+    written once, to a file named by the hash of its contents, and checkpoints only record the hashes. Consecutive
+    checkpoints are mostly the same, so saving only writes (and disk use only grows by) what changed. A sequence
+    that is only ever appended to is stored in chunks (see put_chunks), so saving it again only writes the new items.
+
+    Blobs are never modified. Every checkpoint pins the blobs it uses (see pin), and once a pinned checkpoint file is
+    deleted, collect_garbage deletes the blobs no remaining checkpoint uses (directly, or through the blobs they use).
+    """
+
+    DIRNAME = "store"
+    PINS_FILE = "pins.json"
+    # chunks of a sequence aren't merged beyond this many items (see put_chunks)
+    CHUNK_MAX_ITEMS = 4096
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def next_to(cls, filename):
+        """The store of the checkpoints in the same directory as filename"""
+        return cls(os.path.join(os.path.dirname(filename), cls.DIRNAME))
+
+    def file(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    @staticmethod
+    def key_of(filename):
+        """The key of a blob file (see file)"""
+        return os.path.basename(os.path.dirname(filename)) + os.path.basename(filename)
+
+    @staticmethod
+    def _write_file(filename, data):
+        # written under a temporary name first, so a file is always complete
+        tmp_file = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(data)
+        os.replace(tmp_file, filename)
+
+    def put_bytes(self, data, children=()):
+        """Store data (unless it's stored already), returns its key
+
+        children are the keys of the blobs data refers to, they're kept for as long as this one is.
+        """
+        key = hashlib.sha256(data).hexdigest()
+        filename = self.file(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # the children are recorded before the blob exists, so garbage collection never sees it without them
+        if children and not os.path.exists(filename + ".children"):
+            self._write_file(filename + ".children", json.dumps(sorted(set(children))).encode("utf-8"))
+        if not os.path.exists(filename):
+            self._write_file(filename, data)
+        return key
+
+    def get_bytes(self, key):
+        with open(self.file(key), "rb") as f:
+            return f.read()
+
+    def put(self, value):
+        """Store a JSON-serializable value, returns its key"""
+        # keys keep their order (eg. a function schema's properties are shown to the model in it), so equal values
+        # with a different order are stored separately
+        return self.put_bytes(json.dumps(value).encode("utf-8"))
+
+    def get(self, key):
+        return json.loads(self.get_bytes(key))
+
+    def put_chunks(self, sequence, chunks=()):
+        """Store a sequence that's only ever appended to (a list, an array, or anything else sliced and joined with +=)
+
+        chunks are the ones returned by an earlier call for the same sequence, only the items appended since then are
+        written (as a new chunk). Chunks are merged size-tiered: the new chunk also takes in the last ones as long as
+        they aren't bigger than it (up to CHUNK_MAX_ITEMS), so there are few chunks to read, and saving rewrites at
+        most a chunk's worth of earlier items. Returns the [key, number of items] chunks of the whole sequence.
+        """
+        start = sum(count for _, count in chunks)
+        if start > len(sequence):
+            raise ValueError(f"The sequence has {len(sequence)} items, fewer than the {start} already stored")
+        if start == len(sequence) and len(chunks) > 0:
+            return [list(chunk) for chunk in chunks]
+        chunks = [list(chunk) for chunk in chunks]
+        while chunks and chunks[-1][1] <= len(sequence) - start and len(sequence) - start + chunks[-1][1] <= self.CHUNK_MAX_ITEMS:
+            start -= chunks.pop()[1]
+        # an empty sequence is stored as one empty chunk, so get_chunks knows its type
+        chunks.append([self.put_bytes(pickle.dumps(sequence[start:], protocol=pickle.HIGHEST_PROTOCOL)), len(sequence) - start])
+        return chunks
+
+    def get_chunks(self, chunks):
+        """The sequence stored with put_chunks"""
+        return reduce(operator.iadd, [pickle.loads(self.get_bytes(key)) for key, _ in chunks])
+
+    def _read_pins(self):
+        pins_file = os.path.join(self.path, self.PINS_FILE)
+        if not os.path.exists(pins_file):
+            return {"checkpoints": {}, "dirty": False}
+        with open(pins_file, "rt") as f:
+            return json.load(f)
+
+    def _write_pins(self, pins):
+        os.makedirs(self.path, exist_ok=True)
+        self._write_file(os.path.join(self.path, self.PINS_FILE), json.dumps(pins).encode("utf-8"))
+
+    def pin(self, checkpoint_file, keys):
+        """Record the blobs a checkpoint file uses, they're kept for as long as that file exists"""
+        pins = self._read_pins()
+        checkpoint_file = os.path.abspath(checkpoint_file)
+        keys = sorted(set(keys))
+        if checkpoint_file in pins["checkpoints"] and pins["checkpoints"][checkpoint_file] != keys:
+            # overwritten, what it used before may be garbage now
+            pins["dirty"] = True
+        pins["checkpoints"][checkpoint_file] = keys
+        self._write_pins(pins)
+
+    def collect_garbage(self):
+        """Delete the blobs that no pinned checkpoint uses anymore, returns the number of blobs deleted
+
+        Only looks at the blobs once a pinned checkpoint file was deleted or overwritten, and never while the directory
+        has checkpoint files that weren't pinned (saved before pinning existed), since what they use isn't known.
+        """
+        pins = self._read_pins()
+        checkpoints = {checkpoint_file: keys for checkpoint_file, keys in pins["checkpoints"].items() if os.path.exists(checkpoint_file)}
+        if not pins["dirty"] and len(checkpoints) == len(pins["checkpoints"]):
+            return 0
+        directory = os.path.abspath(os.path.dirname(self.path))
+        unpinned = [filename for filename in os.listdir(directory) if filename.endswith((".json", ".pickle")) and os.path.join(directory, filename) not in checkpoints]
+        if unpinned:
+            printd(f"CheckpointStore.collect_garbage: {len(unpinned)} checkpoints in {directory} weren't pinned, not deleting anything")
+            self._write_pins({"checkpoints": checkpoints, "dirty": True})
+            return 0
+
+        used, stack = set(), [key for keys in checkpoints.values() for key in keys]
+        while stack:
+            key = stack.pop()
+            if key in used:
+                continue
+            used.add(key)
+            if os.path.exists(self.file(key) + ".children"):
+                with open(self.file(key) + ".children", "rt") as f:
+                    stack.extend(json.load(f))
+        deleted = 0
+        for prefix in os.listdir(self.path):
+            if not os.path.isdir(os.path.join(self.path, prefix)):
+                continue
+            for filename in os.listdir(os.path.join(self.path, prefix)):
+                # .children files go with their blob, .tmp files may be a blob being written
+                if "." in filename or prefix + filename in used:
+                    continue
+                os.remove(os.path.join(self.path, prefix, filename))
+                if os.path.exists(os.path.join(self.path, prefix, filename + ".children")):
+                    os.remove(os.path.join(self.path, prefix, filename + ".children"))
+                deleted += 1
+        self._write_pins({"checkpoints": checkpoints, "dirty": False})
+        if deleted:
+            printd(f"CheckpointStore.collect_garbage: deleted {deleted} blobs from {self.path}")
+        return deleted
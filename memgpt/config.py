@@ -15,6 +15,11 @@ import memgpt.interface as interface
 from memgpt.personas.personas import get_persona_text
 from memgpt.humans.humans import get_human_text
 from memgpt.constants import MEMGPT_DIR
+from memgpt.embeddings import (
+    DEFAULT_EMBEDDING_MODEL,
+    DEFAULT_LOCAL_EMBEDDING_MODEL,
+    is_local_embedding_model,
+)
 
 model_choices = [
     questionary.Choice("gpt-4"),
@@ -42,6 +47,12 @@ class Config:
         self.persistence_manager_save_file = None
         self.host = os.getenv("OPENAI_API_BASE")
         self.index = None
+        self.archival_index_type = "flat"
+        self.archival_index_nprobe = None
+        self.archival_index_ef_search = None
+        self.archival_hybrid_search = False
+        # local embedding models (see memgpt/embeddings.py) are opt-in, with --embedding_model or when computing embeddings
+        self.embedding_model = DEFAULT_EMBEDDING_MODEL
         self.config_file = None
         self.preload_archival = False
 
@@ -55,6 +66,11 @@ class Config:
         archival_storage_files: str = None,
         archival_storage_index: str = None,
         compute_embeddings: bool = False,
+        archival_index_type: str = "flat",
+        archival_index_nprobe: int = None,
+        archival_index_ef_search: int = None,
+        archival_hybrid_search: bool = False,
+        embedding_model: str = None,
     ):
         self = cls()
         self.model = model
@@ -64,6 +80,12 @@ class Config:
         self.archival_storage_files = archival_storage_files
         self.archival_storage_index = archival_storage_index
         self.compute_embeddings = compute_embeddings
+        self.archival_index_type = archival_index_type
+        self.archival_index_nprobe = archival_index_nprobe
+        self.archival_index_ef_search = archival_index_ef_search
+        self.archival_hybrid_search = archival_hybrid_search
+        if embedding_model is not None:
+            self.embedding_model = embedding_model
         recompute_embeddings = self.compute_embeddings
         if self.archival_storage_index:
             recompute_embeddings = False  # TODO Legacy support -- can't recompute embeddings on a path that's not specified.
@@ -156,6 +178,31 @@ class Config:
             self.compute_embeddings = await questionary.confirm(
                 "Would you like to compute embeddings over these files to enable embeddings search?"
             ).ask_async()
+            if self.compute_embeddings:
+                self.embedding_model = await questionary.select(
+                    "Which embedding model would you like to use?",
+                    choices=[
+                        questionary.Choice("OpenAI text-embedding-ada-002 (best quality, paid API calls)", value=DEFAULT_EMBEDDING_MODEL),
+                        questionary.Choice("Local hashing vectorizer (keyword-level, no downloads, runs anywhere)", value=DEFAULT_LOCAL_EMBEDDING_MODEL),
+                        questionary.Choice("Local sentence-transformers/all-MiniLM-L6-v2 (semantic, needs sentence-transformers)", value="sentence-transformers/all-MiniLM-L6-v2"),
+                    ],
+                    default=self.embedding_model,
+                ).ask_async()
+                self.archival_index_type = await questionary.select(
+                    "Which type of FAISS index would you like to build over the embeddings?",
+                    choices=[
+                        questionary.Choice("Flat (exact search, best for small collections)", value="flat"),
+                        questionary.Choice("SQ-fp16 (exact search, float16 vectors, half the memory)", value="sq-fp16"),
+                        questionary.Choice("SQ8 (exact search, int8 vectors, a quarter of the memory)", value="sq8"),
+                        questionary.Choice("IVF-Flat (approximate, faster search)", value="ivf-flat"),
+                        questionary.Choice("IVF-PQ (approximate, compressed, for millions of chunks)", value="ivf-pq"),
+                        questionary.Choice("HNSW (approximate graph index, fastest search)", value="hnsw"),
+                    ],
+                ).ask_async()
+                self.archival_hybrid_search = await questionary.confirm(
+                    "Would you like to combine embeddings search with keyword search (helps with exact names, codes and identifiers)?",
+                    default=False,
+                ).ask_async()
             await self.configure_archival_storage(self.compute_embeddings)
 
         self.write_config()
@@ -163,19 +210,32 @@ class Config:
 
     async def configure_archival_storage(self, recompute_embeddings):
         if recompute_embeddings:
-            if self.host:
+            if self.host and not is_local_embedding_model(self.embedding_model):
                 interface.warning_message(
-                    "⛔️ Embeddings on a non-OpenAI endpoint are not yet supported, falling back to substring matching search."
+                    f"⛔️ OpenAI embeddings ({self.embedding_model}) are not available on a non-OpenAI endpoint, falling back to substring matching search. Use a local embedding model (e.g. {DEFAULT_LOCAL_EMBEDDING_MODEL}) for embeddings search."
                 )
             else:
                 self.archival_storage_index = (
                     await utils.prepare_archival_index_from_files_compute_embeddings(
-                        self.archival_storage_files
+                        self.archival_storage_files,
+                        embeddings_model=self.embedding_model,
+                        index_type=self.archival_index_type,
                     )
                 )
         if self.compute_embeddings and self.archival_storage_index:
-            self.index, self.archival_database = utils.prepare_archival_index(
+            # queries have to be embedded with the model the index was built with
+            index_embedding_model = utils.read_archival_index_info(
                 self.archival_storage_index
+            )["embedding_model"]
+            if index_embedding_model != self.embedding_model:
+                interface.warning_message(
+                    f"⛔️ Archival index {self.archival_storage_index} was built with embedding model {index_embedding_model}, using it instead of {self.embedding_model}."
+                )
+                self.embedding_model = index_embedding_model
+            self.index, self.archival_database = utils.prepare_archival_index(
+                self.archival_storage_index,
+                nprobe=self.archival_index_nprobe,
+                ef_search=self.archival_index_ef_search,
             )
         else:
             self.archival_database = utils.prepare_archival_index_from_files(
@@ -191,6 +251,11 @@ class Config:
             "archival_storage_files": self.archival_storage_files,
             "archival_storage_index": self.archival_storage_index,
             "compute_embeddings": self.compute_embeddings,
+            "archival_index_type": self.archival_index_type,
+            "archival_index_nprobe": self.archival_index_nprobe,
+            "archival_index_ef_search": self.archival_index_ef_search,
+            "archival_hybrid_search": self.archival_hybrid_search,
+            "embedding_model": self.embedding_model,
             "load_type": self.load_type,
             "agent_save_file": self.agent_save_file,
             "persistence_manager_save_file": self.persistence_manager_save_file,
@@ -207,6 +272,11 @@ class Config:
         self.archival_storage_files = cfg["archival_storage_files"]
         self.archival_storage_index = cfg["archival_storage_index"]
         self.compute_embeddings = cfg["compute_embeddings"]
+        self.archival_index_type = cfg.get("archival_index_type", "flat")
+        self.archival_index_nprobe = cfg.get("archival_index_nprobe")
+        self.archival_index_ef_search = cfg.get("archival_index_ef_search")
+        self.archival_hybrid_search = cfg.get("archival_hybrid_search", False)
+        self.embedding_model = cfg.get("embedding_model", DEFAULT_EMBEDDING_MODEL)
         self.load_type = cfg["load_type"]
         self.agent_save_file = cfg["agent_save_file"]
         self.persistence_manager_save_file = cfg["persistence_manager_save_file"]
@@ -0,0 +1,174 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+from .constants import MEMGPT_DIR
+
+
+DEFAULT_EMBEDDING_CACHE_PATH = os.path.join(MEMGPT_DIR, "embedding_cache.db")
+DEFAULT_EMBEDDING_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1 GB, ~170k ada-002 embeddings
+
+
+def normalize_text(text):
+    """Texts that only differ in unicode form or whitespace get the same embedding"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+class EmbeddingCache(object):
+    """On-disk (sqlite) cache of embeddings, keyed by sha256(model, normalized text)
+
+    Vectors are stored as float32 blobs. Once the cache grows past max_bytes,
+    the least recently used entries are evicted.
+    """
+
+    def __init__(self, path=DEFAULT_EMBEDDING_CACHE_PATH, max_bytes=DEFAULT_EMBEDDING_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # shared by the event loop and executor threads, so every access goes through the lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, model TEXT, vector BLOB, last_used INTEGER)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model, text):
+        return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).digest()
+
+    def get_many(self, model, texts):
+        """Cached embedding (float32 array) of each text, None where there is none"""
+        keys = [self.key(model, text) for text in texts]
+        found = {}
+        with self._lock:
+            # stay well below sqlite's limit on query parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                placeholders = ",".join("?" * len(batch))
+                found.update(self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch).fetchall())
+            if found:
+                now = time.time_ns()
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+        self.hits += len([key for key in keys if key in found])
+        self.misses += len([key for key in keys if key not in found])
+        return [np.frombuffer(found[key], dtype=np.float32) if key in found else None for key in keys]
+
+    def get(self, model, text):
+        return self.get_many(model, [text])[0]
+
+    def put_many(self, model, texts, embeddings):
+        now = time.time_ns()
+        rows = {}
+        for text, embedding in zip(texts, embeddings):
+            rows[self.key(model, text)] = np.asarray(embedding, dtype=np.float32).tobytes()
+        with self._lock:
+            # replaced entries don't count twice
+            for i in range(0, len(rows), 500):
+                batch = list(rows)[i : i + 500]
+                placeholders = ",".join("?" * len(batch))
+                self._total_bytes -= self._conn.execute(
+                    f"SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchone()[0]
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(key, model, vector, now) for key, vector in rows.items()],
+            )
+            self._total_bytes += sum(len(vector) for vector in rows.values())
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def put(self, model, text, embedding):
+        self.put_many(model, [text], [embedding])
+
+    def _evict(self):
+        # evict down to 90% of the cap, so the next few inserts don't each trigger another eviction
+        target = int(self.max_bytes * 0.9)
+        while self._total_bytes > target:
+            rows = self._conn.execute("SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 1000").fetchall()
+            if not rows:
+                break
+            evicted, evicted_bytes = [], 0
+            for key, nbytes in rows:
+                if self._total_bytes - evicted_bytes <= target:
+                    break
+                evicted.append((key,))
+                evicted_bytes += nbytes
+            self._conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+            self._total_bytes -= evicted_bytes
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def stats(self):
+        return {"entries": len(self), "bytes": self._total_bytes, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._total_bytes = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# shared by every memory (and ingestion) in the process, created on first use
+_embedding_cache = None
+_embedding_cache_disabled = False
+
+
+def get_embedding_cache():
+    """The process-wide embedding cache, None if caching is disabled (see set_embedding_cache)"""
+    global _embedding_cache
+    if _embedding_cache is None and not _embedding_cache_disabled:
+        try:
+            _embedding_cache = EmbeddingCache()
+        except sqlite3.Error as e:
+            # a read-only home directory shouldn't stop embeddings from working
+            print(f"Couldn't open the embedding cache at {DEFAULT_EMBEDDING_CACHE_PATH}, embeddings won't be cached: {e}")
+            set_embedding_cache(None)
+    return _embedding_cache
+
+
+def set_embedding_cache(cache):
+    """Replace the process-wide embedding cache, None disables caching"""
+    global _embedding_cache, _embedding_cache_disabled
+    _embedding_cache = cache
+    _embedding_cache_disabled = cache is None
+
+
+async def get_embeddings_cached(model, texts, embed):
+    """Embeddings of texts (one per text, in order), with the embedding cache in front of embed
+
+    Texts already in the cache aren't embedded again, and texts that only differ in whitespace share a cache entry,
+    so each distinct missing text is embedded once: await embed(missing_texts) returns their embeddings in order.
+    Cached embeddings are float32 arrays, new ones are returned as embed returned them.
+    """
+    cache = get_embedding_cache()
+    if cache is None or len(texts) == 0:
+        return list(await embed(texts)) if len(texts) else []
+    cached = cache.get_many(model, texts)
+    missing = {}
+    for text, embedding in zip(texts, cached):
+        if embedding is None:
+            missing.setdefault(normalize_text(text), text)
+    if missing:
+        new_embeddings = await embed(list(missing.values()))
+        cache.put_many(model, list(missing.values()), new_embeddings)
+        new_embeddings = dict(zip(missing, new_embeddings))
+        cached = [new_embeddings[normalize_text(text)] if embedding is None else embedding for text, embedding in zip(texts, cached)]
+    return cached
@@ -0,0 +1,176 @@
+"""Embedding providers, which turn text into vectors for archival / recall memory search
+
+Memories only store the embedding model name, the provider is looked up from it with get_embedding_provider:
+    text-embedding-ada-002 (or any other OpenAI model)   -- OpenAI embeddings endpoint
+    hashing, hashing-<dim>                                -- in-process feature hashing, no model or network needed
+    sentence-transformers/<model>, st:<model>             -- in-process sentence-transformers model (optional dependency)
+"""
+from abc import ABC, abstractmethod
+import asyncio
+import functools
+import hashlib
+import re
+
+import numpy as np
+
+from .openai_tools import async_get_embedding_with_backoff, async_get_embeddings_with_backoff
+from .embedding_cache import get_embeddings_cached
+
+
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
+DEFAULT_LOCAL_EMBEDDING_MODEL = "hashing-1024"
+
+
+class EmbeddingProvider(ABC):
+    """Embeds batches of texts, returns a (len(texts), dim) float32 array"""
+
+    model_name = None
+    dim = None  # None if not known until the first embedding comes back
+    is_local = False  # True if the provider runs in-process (no API calls, no cost)
+    cacheable = True  # False if embedding is cheaper than an embedding cache lookup, or the provider is cached further down
+
+    @abstractmethod
+    async def embed(self, texts, batch_size=None, concurrency=None):
+        pass
+
+    async def embed_one(self, text):
+        return (await self.embed([text]))[0]
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+
+    # the openai_tools helpers it calls go through the embedding cache themselves (so direct callers of them share it)
+    cacheable = False
+
+    DIMENSIONS = {
+        "text-embedding-ada-002": 1536,
+    }
+
+    def __init__(self, model_name=DEFAULT_EMBEDDING_MODEL, batch_size=256, concurrency=4):
+        self.model_name = model_name
+        self.dim = self.DIMENSIONS.get(model_name)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+
+    async def embed(self, texts, batch_size=None, concurrency=None):
+        if len(texts) == 1:
+            embeddings = [await async_get_embedding_with_backoff(texts[0], model=self.model_name)]
+        else:
+            embeddings = await async_get_embeddings_with_backoff(
+                texts,
+                model=self.model_name,
+                batch_size=batch_size or self.batch_size,
+                concurrency=concurrency or self.concurrency,
+            )
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(texts), -1)
+        self.dim = embeddings.shape[1]
+        return embeddings
+
+
+@functools.lru_cache(maxsize=65536)
+def _feature_hash(feature):
+    # features repeat a lot across texts, the most recent ones are kept (bounded, unlike the vocabulary)
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    """Feature hashing ("hashing trick") of word unigrams and bigrams
+
+    Lexical rather than semantic, but it needs no model files or network access and embeds thousands
+    of texts per second on a CPU, so it works for air-gapped local LLM setups.
+    """
+
+    is_local = True
+    cacheable = False
+
+    def __init__(self, dim=1024):
+        self.dim = dim
+        self.model_name = f"hashing-{dim}"
+
+    def _bucket(self, feature):
+        h = _feature_hash(feature)
+        # the sign bit keeps collisions from only ever adding up
+        return h % self.dim, 1.0 if (h >> 63) & 1 else -1.0
+
+    def _embed_text(self, text, out):
+        tokens = re.findall(r"\w+", text.lower())
+        features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        if not features:
+            return
+        buckets, signs = zip(*[self._bucket(feature) for feature in features])
+        np.add.at(out, np.array(buckets), np.array(signs, dtype=np.float32))
+        # sublinear term frequency, so repeated words don't dominate
+        np.copyto(out, np.sign(out) * np.log1p(np.abs(out)))
+
+    async def embed(self, texts, batch_size=None, concurrency=None):
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            self._embed_text(text, embeddings[i])
+        return embeddings
+
+
+class SentenceTransformerEmbeddingProvider(EmbeddingProvider):
+    """In-process sentence-transformers model (e.g. sentence-transformers/all-MiniLM-L6-v2), on CPU unless told otherwise"""
+
+    is_local = True
+
+    def __init__(self, model_name, device="cpu", batch_size=64):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError(f"Embedding model '{model_name}' needs the sentence-transformers package (pip install sentence-transformers)")
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self._model = SentenceTransformer(model_name[len("st:"):] if model_name.startswith("st:") else model_name, device=device)
+        self.dim = self._model.get_sentence_embedding_dimension()
+
+    async def embed(self, texts, batch_size=None, concurrency=None):
+        # inference is CPU bound, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        embeddings = await loop.run_in_executor(
+            None,
+            lambda: self._model.encode(list(texts), batch_size=batch_size or self.batch_size, convert_to_numpy=True, show_progress_bar=False),
+        )
+        return np.asarray(embeddings, dtype=np.float32).reshape(len(texts), self.dim)
+
+
+# providers are shared by every memory that uses the same model (local models are only loaded once)
+_providers = {}
+
+
+def get_embedding_provider(model_name=DEFAULT_EMBEDDING_MODEL):
+    if model_name not in _providers:
+        if model_name == "hashing":
+            provider = HashingEmbeddingProvider()
+        elif model_name.startswith("hashing-"):
+            provider = HashingEmbeddingProvider(dim=int(model_name[len("hashing-"):]))
+        elif model_name.startswith("sentence-transformers/") or model_name.startswith("st:"):
+            provider = SentenceTransformerEmbeddingProvider(model_name)
+        else:
+            provider = OpenAIEmbeddingProvider(model_name)
+        _providers[model_name] = provider
+    return _providers[model_name]
+
+
+def is_local_embedding_model(model_name):
+    return model_name is not None and (model_name.startswith("hashing") or model_name.startswith("sentence-transformers/") or model_name.startswith("st:"))
+
+
+async def async_get_embedding(text, model=DEFAULT_EMBEDDING_MODEL):
+    """Embedding of a single text, as a float32 vector"""
+    return (await async_get_embeddings([text], model=model))[0]
+
+
+async def async_get_embeddings(texts, model=DEFAULT_EMBEDDING_MODEL, batch_size=None, concurrency=None):
+    """Embeddings of a list of texts, as a (len(texts), dim) float32 array
+
+    Texts already in the embedding cache (see embedding_cache.py) aren't embedded again,
+    and each distinct text is only embedded once.
+    """
+    provider = get_embedding_provider(model)
+    if len(texts) == 0:
+        return np.empty((0, provider.dim or 0), dtype=np.float32)
+    if not provider.cacheable:
+        return await provider.embed(texts, batch_size=batch_size, concurrency=concurrency)
+    embeddings = await get_embeddings_cached(model, texts, lambda missing: provider.embed(missing, batch_size=batch_size, concurrency=concurrency))
+    return np.stack(embeddings).astype(np.float32, copy=False)
@@ -0,0 +1,261 @@
+import json
+import os
+import re
+import threading
+
+import faiss
+import numpy as np
+
+from .utils import printd
+
+
+class FaissIndexStore(object):
+    """On-disk home of a FAISS-backed archival memory: a base index plus append-only delta segments
+
+    Layout of the store directory:
+        head.json               -- the next free id (for generations, bases and segments), replaced atomically
+        manifest-<n>.json       -- generation n of the archive: a base + the segments after it, in order
+        merged-<n>.json         -- the generation holding the same memories as generation n, with its segments merged
+        pins.json               -- the generation each checkpoint file was saved as (see pin)
+        base-<n>.index          -- FAISS index holding the first base_count memories
+        base-<n>.jsonl          -- their {'timestamp', 'content'} records
+        segment-<n>.npy         -- embeddings (as added to the index) of memories inserted after the base
+        segment-<n>.jsonl       -- their records
+
+    Every checkpoint is a new generation, so it only writes the memories inserted since its parent as a new segment
+    and saving costs time proportional to the new data. Generations are never modified: a checkpoint loads exactly
+    the generation it pinned, also after branching off an older one. Once a generation has many segments, its newest
+    ones are merged in a background thread (as a new generation with the same memories, see merge). Generations no
+    remaining checkpoint pinned, and the files only they used, are deleted by collect_garbage.
+    """
+
+    HEAD_FILE = "head.json"
+    PINS_FILE = "pins.json"
+
+    # instances on the same directory share their lock and the names of files that are being written
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path, max_segments=8):
+        self.path = path
+        # merge once a generation has more than this many segments
+        self.max_segments = max_segments
+        os.makedirs(self.path, exist_ok=True)
+        with FaissIndexStore._shared_lock:
+            shared = FaissIndexStore._shared.setdefault(os.path.abspath(self.path), (threading.Lock(), set()))
+        # guards head.json, pins.json and the set of files being written (which garbage collection leaves alone)
+        self._lock, self._writing = shared
+        self._merge_thread = None
+
+    def _file(self, filename):
+        return os.path.join(self.path, filename)
+
+    @staticmethod
+    def _write_json(filename, value):
+        tmp_file = filename + ".tmp"
+        with open(tmp_file, "wt") as f:
+            json.dump(value, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, filename)
+
+    def _next_id(self):
+        """Reserve an id for a new generation, base or segment (call with the lock held)"""
+        head_file = self._file(self.HEAD_FILE)
+        next_id = 0
+        if os.path.exists(head_file):
+            with open(head_file, "rt") as f:
+                next_id = json.load(f)["next_id"]
+        self._write_json(head_file, {"next_id": next_id + 1})
+        return next_id
+
+    def read_manifest(self, generation):
+        manifest_file = self._file(f"manifest-{generation}.json")
+        if not os.path.exists(manifest_file):
+            raise FileNotFoundError(f"Archival store {self.path} has no checkpoint {generation}, it can't be loaded as it was saved")
+        with open(manifest_file, "rt") as f:
+            return json.load(f)
+
+    def _write_manifest(self, base, base_count, segments):
+        """Write a new generation, returns its number (call with the lock held)"""
+        generation = self._next_id()
+        self._write_json(self._file(f"manifest-{generation}.json"), {"base": base, "base_count": base_count, "segments": segments})
+        return generation
+
+    @staticmethod
+    def count(manifest):
+        return manifest["base_count"] + sum(segment["count"] for segment in manifest["segments"])
+
+    @staticmethod
+    def _write_records(filename, memories):
+        with open(filename, "wt", encoding="utf-8") as f:
+            for memory in memories:
+                f.write(json.dumps({"timestamp": memory["timestamp"], "content": memory["content"]}) + "\n")
+
+    @staticmethod
+    def _read_records(filename):
+        with open(filename, "rt", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def write_base(self, index, memories):
+        """Start a new line of generations from a full copy of the index (the first checkpoint into this store)"""
+        with self._lock:
+            name = f"base-{self._next_id()}"
+            faiss.write_index(index, self._file(name + ".index"))
+            self._write_records(self._file(name + ".jsonl"), memories)
+            return self._write_manifest(name, len(memories), [])
+
+    def append_segment(self, parent, embeddings, memories):
+        """Write the memories inserted since generation parent as a new segment, returns the new generation"""
+        if len(memories) == 0:
+            return parent
+        with self._lock:
+            # builds on the merged copy of the parent, once there is one
+            manifest = self.read_manifest(self._merged(parent))
+            name = f"segment-{self._next_id()}"
+            np.save(self._file(name + ".npy"), np.asarray(embeddings, dtype=np.float32))
+            self._write_records(self._file(name + ".jsonl"), memories)
+            segments = manifest["segments"] + [{"name": name, "count": len(memories)}]
+            generation = self._write_manifest(manifest["base"], manifest["base_count"], segments)
+        if len(segments) > self.max_segments:
+            self.merge_in_background(generation)
+        return generation
+
+    def _merged(self, generation):
+        """The generation with the same memories as generation and its segments merged (generation itself if none)"""
+        merged_file = self._file(f"merged-{generation}.json")
+        if not os.path.exists(merged_file):
+            return generation
+        with open(merged_file, "rt") as f:
+            return json.load(f)["generation"]
+
+    def load(self, generation):
+        """The index, memories and manifest of a generation, exactly as it was checkpointed"""
+        manifest = self.read_manifest(generation)
+        # a merged copy holds the same memories in fewer files
+        source = self.read_manifest(self._merged(generation))
+        index = faiss.read_index(self._file(source["base"] + ".index"))
+        memories = self._read_records(self._file(source["base"] + ".jsonl"))
+        for segment in source["segments"]:
+            index.add(np.ascontiguousarray(np.load(self._file(segment["name"] + ".npy"))))
+            memories.extend(self._read_records(self._file(segment["name"] + ".jsonl")))
+        if len(memories) != self.count(manifest) or index.ntotal != len(memories):
+            raise ValueError(f"Archival store {self.path} checkpoint {generation} should hold {self.count(manifest)} memories, found {len(memories)} ({index.ntotal} vectors)")
+        return index, memories, manifest
+
+    def merge_in_background(self, generation):
+        if self._merge_thread is not None and self._merge_thread.is_alive():
+            return
+        self._merge_thread = threading.Thread(target=self.merge, args=(generation,), daemon=True)
+        self._merge_thread.start()
+
+    def merge(self, generation):
+        """Merge the newest segments of a generation, as a new generation with the same base (all files read are immutable)
+
+        Segments are merged size-tiered: the newest ones are merged until every segment holds more memories than all
+        the ones after it together, and once that includes all of them and they hold as many as the base, they're
+        folded into a new base instead. So older segments (and the base) are shared with the generation merged, and
+        every memory gets rewritten a logarithmic number of times.
+        """
+        manifest = self.read_manifest(generation)
+        segments = manifest["segments"]
+        if len(segments) == 0:
+            return
+        first, count = len(segments), 0
+        while first > 0 and (first > len(segments) - 2 or segments[first - 1]["count"] <= count):
+            first -= 1
+            count += segments[first]["count"]
+        rebase = first == 0 and count >= manifest["base_count"]
+        if len(segments) - first < 2 and not rebase:
+            return
+        with self._lock:
+            name = f"base-{self._next_id()}" if rebase else f"segment-{self._next_id()}"
+            self._writing.add(name)
+        printd(f"FaissIndexStore.merge: merging {len(segments) - first} segments of checkpoint {generation} into {name}")
+
+        try:
+            sources = ([manifest["base"]] if rebase else []) + [segment["name"] for segment in segments[first:]]
+            with open(self._file(name + ".jsonl"), "wb") as out:
+                for source in sources:
+                    with open(self._file(source + ".jsonl"), "rb") as f:
+                        out.write(f.read())
+            embeddings = [np.load(self._file(segment["name"] + ".npy")) for segment in segments[first:]]
+            if rebase:
+                index = faiss.read_index(self._file(manifest["base"] + ".index"))
+                for segment_embeddings in embeddings:
+                    index.add(np.ascontiguousarray(segment_embeddings))
+                faiss.write_index(index, self._file(name + ".index"))
+            else:
+                np.save(self._file(name + ".npy"), np.concatenate(embeddings))
+
+            with self._lock:
+                if rebase:
+                    merged = self._write_manifest(name, self.count(manifest), [])
+                else:
+                    merged = self._write_manifest(manifest["base"], manifest["base_count"], segments[:first] + [{"name": name, "count": count}])
+                self._write_json(self._file(f"merged-{generation}.json"), {"generation": merged})
+        finally:
+            with self._lock:
+                self._writing.discard(name)
+
+    def pin(self, checkpoint_file, generation):
+        """Record that checkpoint_file was saved as generation, which is kept for as long as that file exists"""
+        with self._lock:
+            pins = self._read_pins()
+            pins[os.path.abspath(checkpoint_file)] = generation
+            self._write_json(self._file(self.PINS_FILE), pins)
+
+    def _read_pins(self):
+        pins_file = self._file(self.PINS_FILE)
+        if not os.path.exists(pins_file):
+            return {}
+        with open(pins_file, "rt") as f:
+            return json.load(f)
+
+    def collect_garbage(self, keep=()):
+        """Delete the generations that no existing checkpoint pinned, and the bases and segments none of the rest use
+
+        The generations in keep (eg. the one a live archive builds on) and the newest one are kept too. Returns the
+        number of files deleted.
+        """
+        with self._lock:
+            pins = self._read_pins()
+            live_pins = {checkpoint_file: generation for checkpoint_file, generation in pins.items() if os.path.exists(checkpoint_file)}
+            if live_pins != pins:
+                self._write_json(self._file(self.PINS_FILE), live_pins)
+            generations = [int(filename[len("manifest-"):-len(".json")]) for filename in os.listdir(self.path) if re.fullmatch(r"manifest-\d+\.json", filename)]
+            if len(generations) == 0:
+                return 0
+            kept = set(live_pins.values()) | set(keep) | {max(generations)}
+            # a merged generation is loaded from the files of its merged copy (its own manifest still has its count)
+            sources = {self._merged(generation) for generation in kept}
+            kept_manifests = kept | sources
+            used = set(self._writing)
+            for generation in sources:
+                manifest = self.read_manifest(generation)
+                used.add(manifest["base"])
+                used.update(segment["name"] for segment in manifest["segments"])
+
+            deleted = 0
+            for filename in os.listdir(self.path):
+                match = re.fullmatch(r"(manifest|merged|base|segment)-(\d+)\.(json|index|jsonl|npy)", filename)
+                if match is None:
+                    continue
+                kind, number = match.group(1), int(match.group(2))
+                if kind == "manifest":
+                    garbage = number not in kept_manifests
+                elif kind == "merged":
+                    garbage = number not in kept
+                else:
+                    garbage = f"{kind}-{number}" not in used
+                if garbage:
+                    os.remove(self._file(filename))
+                    deleted += 1
+        if deleted:
+            printd(f"FaissIndexStore.collect_garbage: deleted {deleted} files from {self.path}")
+        return deleted
+
+    def wait(self):
+        """Block until a running background merge is done"""
+        if self._merge_thread is not None:
+            self._merge_thread.join()
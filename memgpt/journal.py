@@ -0,0 +1,327 @@
+from array import array
+import glob
+import json
+import os
+
+
+class MessageJournal(object):
+    """Append-only on-disk record of an agent's messages, so saving costs time proportional to what changed
+
+    Layout of the journal directory:
+        history.jsonl           -- every logged message ({'timestamp', 'message'}), line i is message id i
+        history.idx             -- the byte offset of each line of history.jsonl (8 bytes per message), so messages
+                                   can be read by id without scanning the history
+        ops-<seq>.jsonl         -- context window operations after snapshot <seq>, one per line:
+                                   {'seq', 'op': 'append'|'prepend', 'ids'}, {'seq', 'op': 'swap', 'id'},
+                                   {'seq', 'op': 'trim', 'num'} and {'seq', 'op': 'save'} (a checkpoint was taken)
+        snapshot-<seq>.json     -- the context window (as message ids) and the number of logged messages after operation <seq>
+
+    Operations only reference message ids, so they stay small however long messages are. Every
+    `snapshot_every` operations a snapshot is written, so replaying never reads more than that many operations.
+    Old snapshots and operations are kept (they are small), so any checkpoint can still be loaded.
+
+    A torn last line (the process died mid-write) is dropped when the journal is opened. Opening the journal and
+    reading the context window (see load_context) don't depend on the length of the history. Operations logged
+    after the last checkpoint (saved_seq) are what the process logged before it ended without saving again, loading
+    a checkpoint doesn't replay them (loading the latest operation does, for crash recovery).
+    """
+
+    HISTORY_FILE = "history.jsonl"
+    INDEX_FILE = "history.idx"
+
+    def __init__(self, path, snapshot_every=1000):
+        self.path = path
+        self.snapshot_every = snapshot_every
+        os.makedirs(self.path, exist_ok=True)
+        self._recover()
+        # sequence number of the last operation, and of the snapshot the current ops file follows
+        self.seq, self.snapshot_seq = self._last_seq()
+        self.n_messages = os.path.getsize(self._file(self.INDEX_FILE)) // self._offsets_itemsize()
+        self.context_ids = self._replay(self.seq)[0]
+        self._last_op, self.saved_seq = self._last_ops()
+        self._history = open(self._file(self.HISTORY_FILE), "ab")
+        self._index = open(self._file(self.INDEX_FILE), "ab")
+        self._ops = open(self._ops_file(self.snapshot_seq), "a", encoding="utf-8")
+
+    @classmethod
+    def create(cls, path, all_messages, context_ids, snapshot_every=1000):
+        """Start a journal from the full state (eg. on the first save), later changes are recorded with the log_* methods"""
+        if os.path.exists(os.path.join(path, cls.HISTORY_FILE)):
+            raise FileExistsError(f"There is a message journal at {path} already")
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, cls.HISTORY_FILE), "wb") as history, open(os.path.join(path, cls.INDEX_FILE), "wb") as index:
+            cls._write_lines(history, index, 0, all_messages)
+        cls._write_snapshot(path, 0, context_ids, len(all_messages))
+        return cls(path, snapshot_every=snapshot_every)
+
+    def _file(self, filename):
+        return os.path.join(self.path, filename)
+
+    def _ops_file(self, snapshot_seq):
+        return self._file(f"ops-{snapshot_seq}.jsonl")
+
+    def _snapshots(self):
+        """Sequence numbers of the snapshots, ascending"""
+        return sorted(int(os.path.basename(f)[len("snapshot-"):-len(".json")]) for f in glob.glob(self._file("snapshot-*.json")))
+
+    @staticmethod
+    def _dumps(d):
+        # the raw API response is stripped off messages by the agent (and isn't serializable)
+        message = {key: value for key, value in d["message"].items() if key not in ["api_response", "api_args"]}
+        return json.dumps({"timestamp": d["timestamp"], "message": message})
+
+    @staticmethod
+    def _offsets_itemsize():
+        return array("q").itemsize
+
+    @classmethod
+    def _write_lines(cls, history, index, offset, messages):
+        """Write messages to the history starting at byte offset, and their offsets to the index"""
+        lines = [(cls._dumps(d) + "\n").encode("utf-8") for d in messages]
+        offsets = array("q")
+        for line in lines:
+            offsets.append(offset)
+            offset += len(line)
+        history.write(b"".join(lines))
+        # the history has to have the messages before the index (and then an operation) references them
+        history.flush()
+        index.write(offsets.tobytes())
+        index.flush()
+        return offset
+
+    @staticmethod
+    def _write_snapshot(path, seq, context_ids, n_messages):
+        tmp_file = os.path.join(path, f"snapshot-{seq}.json.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump({"seq": seq, "context": list(context_ids), "n_messages": n_messages}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, os.path.join(path, f"snapshot-{seq}.json"))
+
+    @staticmethod
+    def _truncate_torn_line(filename):
+        """Cut off an incomplete last line"""
+        if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+            return
+        with open(filename, "rb+") as f:
+            end = f.seek(0, os.SEEK_END)
+            # only the end of the file is read, looking back for the last complete line
+            while end > 0:
+                start = max(0, end - 65536)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    break
+                end = start
+            size = start + newline + 1 if end > 0 else 0
+            if size != f.seek(0, os.SEEK_END):
+                f.truncate(size)
+
+    def _build_index(self):
+        """Index the history from scratch (journals written before the index existed)"""
+        offsets, offset = array("q"), 0
+        with open(self._file(self.HISTORY_FILE), "rb") as f:
+            for line in f:
+                offsets.append(offset)
+                offset += len(line)
+        with open(self._file(self.INDEX_FILE), "wb") as f:
+            f.write(offsets.tobytes())
+
+    def _recover(self):
+        history_file, index_file = self._file(self.HISTORY_FILE), self._file(self.INDEX_FILE)
+        open(history_file, "ab").close()
+        if not os.path.exists(index_file):
+            self._truncate_torn_line(history_file)
+            self._build_index()
+        # a message is logged once its offset is in the index, a torn offset or any history after the last indexed line is cut off
+        itemsize = self._offsets_itemsize()
+        n_messages = os.path.getsize(index_file) // itemsize
+        with open(index_file, "rb+") as f:
+            f.truncate(n_messages * itemsize)
+        with open(history_file, "rb+") as f:
+            if n_messages == 0:
+                f.truncate(0)
+            else:
+                f.seek(self._read_offsets(n_messages - 1, n_messages)[0])
+                f.truncate(f.tell() + len(f.readline()))
+        snapshots = self._snapshots()
+        if snapshots:
+            ops_file = self._ops_file(snapshots[-1])
+            self._truncate_torn_line(ops_file)
+            # operations on messages that didn't make it into the history are dropped too
+            ops = self._read_ops(snapshots[-1])
+            valid = len(ops)
+            for i, op in enumerate(ops):
+                if max(op.get("ids", []) + [op.get("id", -1)]) >= n_messages:
+                    valid = i
+                    break
+            if valid < len(ops):
+                with open(ops_file, "w", encoding="utf-8") as f:
+                    f.writelines(json.dumps(op) + "\n" for op in ops[:valid])
+        for tmp_file in glob.glob(self._file("*.tmp")):
+            os.remove(tmp_file)
+
+    def _read_offsets(self, start, end):
+        """Byte offsets in the history of messages start, ..., end - 1"""
+        offsets = array("q")
+        with open(self._file(self.INDEX_FILE), "rb") as f:
+            f.seek(start * offsets.itemsize)
+            offsets.frombytes(f.read((end - start) * offsets.itemsize))
+        return offsets
+
+    def read_messages(self, ids):
+        """The logged messages ({'timestamp', 'message'} dicts) with these ids, read through the index"""
+        messages = []
+        with open(self._file(self.HISTORY_FILE), "rb") as history, open(self._file(self.INDEX_FILE), "rb") as index:
+            for id in ids:
+                offset = array("q")
+                index.seek(id * offset.itemsize)
+                offset.frombytes(index.read(offset.itemsize))
+                history.seek(offset[0])
+                messages.append(json.loads(history.readline()))
+        return messages
+
+    def read_history(self, n_messages):
+        """The first n_messages logged messages, in order"""
+        messages = []
+        with open(self._file(self.HISTORY_FILE), "r", encoding="utf-8") as f:
+            for line in f:
+                if len(messages) >= n_messages:
+                    break
+                messages.append(json.loads(line))
+        return messages
+
+    def _read_ops(self, snapshot_seq):
+        ops_file = self._ops_file(snapshot_seq)
+        if not os.path.exists(ops_file):
+            return []
+        with open(ops_file, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def _last_seq(self):
+        snapshots = self._snapshots()
+        if not snapshots:
+            return 0, 0
+        ops = self._read_ops(snapshots[-1])
+        return (ops[-1]["seq"] if ops else snapshots[-1]), snapshots[-1]
+
+    def _last_ops(self):
+        """The last operation, and the sequence number of the last checkpoint (None if there is none)"""
+        last_op = None
+        for snapshot_seq in reversed(self._snapshots()):
+            ops = self._read_ops(snapshot_seq)
+            if last_op is None and ops:
+                last_op = ops[-1]["op"]
+            saves = [op["seq"] for op in ops if op["op"] == "save"]
+            if saves:
+                return last_op, saves[-1]
+        return last_op, None
+
+    def _replay(self, seq):
+        """The context window (as message ids) after operation seq, and the number of messages logged by then"""
+        snapshot_seq = max([s for s in self._snapshots() if s <= seq])
+        with open(self._file(f"snapshot-{snapshot_seq}.json"), "r") as f:
+            snapshot = json.load(f)
+        context_ids, n_messages = snapshot["context"], snapshot["n_messages"]
+        for op in self._read_ops(snapshot_seq):
+            if op["seq"] > seq:
+                break
+            if op["op"] == "append":
+                context_ids = context_ids + op["ids"]
+            elif op["op"] == "prepend":
+                context_ids = context_ids[:1] + op["ids"] + context_ids[1:]
+            elif op["op"] == "trim":
+                context_ids = context_ids[:1] + context_ids[op["num"]:]
+            elif op["op"] == "swap":
+                context_ids = [op["id"]] + context_ids[1:]
+            n_messages = max([n_messages] + [i + 1 for i in op.get("ids", []) + [op.get("id", -1)]])
+        return context_ids, n_messages
+
+    def load_context(self, seq=None):
+        """The context window as of operation seq (default: the latest), without reading the rest of the history
+
+        Returns (context_messages, context_ids, n_messages, seq), n_messages being the number of messages logged by then.
+        """
+        if seq is None:
+            seq = self.seq
+        context_ids, n_messages = self._replay(seq)
+        if seq == self.seq:
+            n_messages = self.n_messages
+        return self.read_messages(context_ids), context_ids, n_messages, seq
+
+    def load(self, seq=None):
+        """The messages logged by operation seq (default: the latest), and the context window then (as the same dicts)
+
+        Returns (all_messages, context_messages, seq), see load_context.
+        """
+        _, context_ids, n_messages, seq = self.load_context(seq)
+        all_messages = self.read_history(n_messages)
+        return all_messages, [all_messages[i] for i in context_ids], seq
+
+    # recording changes
+
+    def _log_messages(self, messages):
+        ids = list(range(self.n_messages, self.n_messages + len(messages)))
+        self._write_lines(self._history, self._index, self._history.tell(), messages)
+        self.n_messages += len(messages)
+        return ids
+
+    def _log_op(self, op, **fields):
+        self._last_op = op
+        self.seq += 1
+        if op == "save":
+            self.saved_seq = self.seq
+        self._ops.write(json.dumps(dict(seq=self.seq, op=op, **fields)) + "\n")
+        self._ops.flush()
+        if self.seq - self.snapshot_seq >= self.snapshot_every:
+            self.compact()
+
+    def log_append(self, messages):
+        ids = self._log_messages(messages)
+        self.context_ids.extend(ids)
+        self._log_op("append", ids=ids)
+
+    def log_prepend(self, messages):
+        ids = self._log_messages(messages)
+        self.context_ids[1:1] = ids
+        self._log_op("prepend", ids=ids)
+
+    def log_trim(self, num):
+        del self.context_ids[1:num]
+        self._log_op("trim", num=num)
+
+    def log_swap(self, message):
+        (new_id,) = self._log_messages([message])
+        self.context_ids[0] = new_id
+        self._log_op("swap", id=new_id)
+
+    def compact(self):
+        """Write a snapshot of the context window, and start a new operations file after it"""
+        self._write_snapshot(self.path, self.seq, self.context_ids, self.n_messages)
+        self._ops.close()
+        self.snapshot_seq = self.seq
+        self._ops = open(self._ops_file(self.snapshot_seq), "a", encoding="utf-8")
+
+    def checkpoint(self):
+        """Make everything logged so far durable, returns the sequence number to load this state with"""
+        # saving twice in a row (eg. the agent and then its persistence manager) is one checkpoint
+        if self._last_op != "save":
+            self._log_op("save")
+        for f in [self._history, self._index, self._ops]:
+            f.flush()
+            os.fsync(f.fileno())
+        return self.seq
+
+    def close(self):
+        self._history.close()
+        self._index.close()
+        self._ops.close()
+
+
+def load_context_messages(path, seq=None):
+    """The context window (plain message dicts) of a journal as of checkpoint seq, see MessageJournal.load"""
+    journal = MessageJournal(path)
+    try:
+        return [d["message"] for d in journal.load_context(seq)[0]]
+    finally:
+        journal.close()
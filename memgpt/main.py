@@ -24,6 +24,9 @@ from memgpt.persistence_manager import (
     InMemoryStateManager,
     InMemoryStateManagerWithPreloadedArchivalMemory,
     InMemoryStateManagerWithFaiss,
+    InMemoryStateManagerWithShards,
+    InMemoryStateManagerWithMmap,
+    SQLiteStateManager,
 )
 
 from memgpt.config import Config
@@ -66,7 +69,7 @@ def save(memgpt_agent, cfg):
     cfg.write_config()
 
 
-def load(memgpt_agent, filename):
+def load(memgpt_agent, filename, recall_summary_search=False, recover=False):
     if filename is not None:
         if filename[-5:] != ".json":
             filename += ".json"
@@ -99,10 +102,21 @@ def load(memgpt_agent, filename):
     # need to load persistence manager too
     filename = filename.replace(".json", ".persistence.pickle")
     try:
-        memgpt_agent.persistence_manager = InMemoryStateManager.load(
-            filename
-        )  # TODO(fixme):for different types of persistence managers that require different load/save methods
+        # the pickle restores the right persistence manager class, which reloads any state it keeps outside the pickle
+        replaced = memgpt_agent.persistence_manager
+        memgpt_agent.persistence_manager = type(replaced).load(filename)
+        replaced.close()
+        memgpt_agent.persistence_manager.link_messages(memgpt_agent.messages)
+        # run options aren't part of the saved state
+        memgpt_agent.persistence_manager.configure_recall(
+            restrict_search_to_summaries=recall_summary_search
+        )
         print(f"Loaded persistence manager from {filename}")
+        if recover:
+            # messages logged after the last save, before the previous run ended
+            recovered = memgpt_agent.persistence_manager.recover()
+            if recovered > 0:
+                print(f"Recovered {recovered} unsaved message operations")
     except Exception as e:
         print(
             f"/load warning: loading persistence manager from {filename} failed with: {e}"
@@ -145,6 +159,51 @@ def run(
         "--archival_storage_sqldb",
         help="Specify SQL database to pre-load into archival memory",
     ),
+    archival_index_type: str = typer.Option(
+        "flat",
+        "--archival_index_type",
+        help=f"Type of FAISS index to build when computing embeddings (one of {', '.join(utils.FAISS_INDEX_TYPES)})",
+    ),
+    archival_index_nprobe: int = typer.Option(
+        None,
+        "--archival_index_nprobe",
+        help="Number of IVF cells to visit per archival search (ivf-flat / ivf-pq indexes)",
+    ),
+    archival_index_ef_search: int = typer.Option(
+        None,
+        "--archival_index_ef_search",
+        help="Size of the HNSW candidate list per archival search (hnsw indexes)",
+    ),
+    archival_hybrid_search: bool = typer.Option(
+        False,
+        "--archival_hybrid_search",
+        help="Combine embedding search with keyword (BM25) search over archival memory",
+    ),
+    archival_shards: int = typer.Option(
+        0,
+        "--archival_shards",
+        help="Split a preloaded FAISS archive across this many worker processes for parallel search (0: don't shard)",
+    ),
+    recall_summary_search: bool = typer.Option(
+        False,
+        "--recall_summary_search",
+        help="Search conversation history hierarchically: summaries first, then only the messages they cover",
+    ),
+    sqlite_db: str = typer.Option(
+        None,
+        "--sqlite_db",
+        help="Keep messages, core memory versions and archival memory in this SQLite database instead of in memory",
+    ),
+    archival_storage_mmap_path: str = typer.Option(
+        None,
+        "--archival_storage_mmap_path",
+        help="Keep archival memory in this directory, memory-mapped instead of held in RAM (created if it doesn't exist)",
+    ),
+    embedding_model: str = typer.Option(
+        None,
+        "--embedding_model",
+        help="Embedding model for archival/recall search: an OpenAI model, 'hashing[-<dim>]' or 'sentence-transformers/<model>' (the last two run locally)",
+    ),
     use_azure_openai: bool = typer.Option(
         False,
         "--use_azure_openai",
@@ -165,6 +224,15 @@ def run(
             archival_storage_files_compute_embeddings,
             archival_storage_sqldb,
             use_azure_openai,
+            archival_index_type,
+            archival_index_nprobe,
+            archival_index_ef_search,
+            archival_hybrid_search,
+            embedding_model,
+            archival_shards,
+            recall_summary_search,
+            sqlite_db,
+            archival_storage_mmap_path,
         )
     )
 
@@ -181,6 +249,15 @@ async def main(
     archival_storage_files_compute_embeddings,
     archival_storage_sqldb,
     use_azure_openai,
+    archival_index_type="flat",
+    archival_index_nprobe=None,
+    archival_index_ef_search=None,
+    archival_hybrid_search=False,
+    embedding_model=None,
+    archival_shards=0,
+    recall_summary_search=False,
+    sqlite_db=None,
+    archival_storage_mmap_path=None,
 ):
     utils.DEBUG = debug
     logging.getLogger().setLevel(logging.CRITICAL)
@@ -246,6 +323,11 @@ async def main(
                 archival_storage_files=archival_storage_faiss_path,
                 archival_storage_index=archival_storage_faiss_path,
                 compute_embeddings=True,
+                archival_index_type=archival_index_type,
+                archival_index_nprobe=archival_index_nprobe,
+                archival_index_ef_search=archival_index_ef_search,
+                archival_hybrid_search=archival_hybrid_search,
+                embedding_model=embedding_model,
             )
         elif archival_storage_files_compute_embeddings:
             print(model)
@@ -258,6 +340,11 @@ async def main(
                 load_type="folder",
                 archival_storage_files=archival_storage_files_compute_embeddings,
                 compute_embeddings=True,
+                archival_index_type=archival_index_type,
+                archival_index_nprobe=archival_index_nprobe,
+                archival_index_ef_search=archival_index_ef_search,
+                archival_hybrid_search=archival_hybrid_search,
+                embedding_model=embedding_model,
             )
         elif archival_storage_sqldb:
             cfg = await Config.legacy_flags_init(
@@ -273,6 +360,7 @@ async def main(
                 model,
                 memgpt_persona,
                 human_persona,
+                embedding_model=embedding_model,
             )
     else:
         cfg = await Config.config_init()
@@ -317,9 +405,30 @@ async def main(
             )
             return
 
-    if cfg.index:
+    if sqlite_db:
+        persistence_manager = SQLiteStateManager(sqlite_db)
+        # preloaded files go into the database once, a reopened database has them already
+        if cfg.archival_storage_files and len(persistence_manager.archival_memory) == 0:
+            print(f"Loading {len(cfg.archival_database)} preloaded chunks into {sqlite_db} (archival search is keyword-based).")
+            await persistence_manager.archival_memory.insert_many([d["content"] for d in cfg.archival_database])
+    elif archival_storage_mmap_path:
+        persistence_manager = InMemoryStateManagerWithMmap(
+            archival_storage_mmap_path,
+            embedding_model=cfg.embedding_model,
+        )
+    elif cfg.index and archival_shards > 0:
+        persistence_manager = InMemoryStateManagerWithShards(
+            cfg.index,
+            cfg.archival_database,
+            n_shards=archival_shards,
+            embedding_model=cfg.embedding_model,
+        )
+    elif cfg.index:
         persistence_manager = InMemoryStateManagerWithFaiss(
-            cfg.index, cfg.archival_database
+            cfg.index,
+            cfg.archival_database,
+            hybrid_search=cfg.archival_hybrid_search,
+            embedding_model=cfg.embedding_model,
         )
     elif cfg.archival_storage_files:
         print(f"Preloaded {len(cfg.archival_database)} chunks into archival memory.")
@@ -346,6 +455,14 @@ async def main(
         memgpt.interface,
         persistence_manager,
     )
+    persistence_manager.configure_recall(restrict_search_to_summaries=recall_summary_search)
+    # preloaded files go into the archive once, a reopened archive has them already
+    if archival_storage_mmap_path and cfg.archival_storage_files and cfg.archival_database and len(persistence_manager.archival_memory) == 0:
+        print(f"Loading {len(cfg.archival_database)} preloaded chunks into {archival_storage_mmap_path}.")
+        await persistence_manager.archival_memory.insert_many(
+            [d["content"] for d in cfg.archival_database],
+            embeddings=[d["embedding"] for d in cfg.archival_database] if all("embedding" in d for d in cfg.archival_database) else None,
+        )
     print_messages = memgpt.interface.print_messages
     await print_messages(memgpt_agent.messages)
 
@@ -364,8 +481,7 @@ async def main(
             print(f"Database found! Loading database into archival memory")
             data_list = utils.read_database_as_list(cfg.archival_storage_files)
             user_message = f"Your archival memory has been loaded with a SQL database called {data_list[0]}, which contains schema {data_list[1]}. Remember to refer to this first while answering any user questions!"
-            for row in data_list:
-                await memgpt_agent.persistence_manager.archival_memory.insert(row)
+            await memgpt_agent.persistence_manager.archival_memory.insert_many(data_list)
             print(f"Database loaded into archival memory.")
 
     if cfg.agent_save_file:
@@ -373,7 +489,7 @@ async def main(
             f"Load in saved agent '{cfg.agent_save_file}'?"
         ).ask_async()
         if load_save_file:
-            load(memgpt_agent, cfg.agent_save_file)
+            load(memgpt_agent, cfg.agent_save_file, recall_summary_search, recover=True)
 
     # auto-exit for
     if "GITHUB_ACTIONS" in os.environ:
@@ -415,6 +531,8 @@ async def main(
                 if user_input.lower() == "/exit":
                     # autosave
                     save(memgpt_agent=memgpt_agent, cfg=cfg)
+                    # stops background work (eg. embedding recall messages) while the event loop is still running
+                    memgpt_agent.persistence_manager.close()
                     break
 
                 elif user_input.lower() == "/savechat":
@@ -442,7 +560,11 @@ async def main(
                 ):
                     command = user_input.strip().split()
                     filename = command[1] if len(command) > 1 else None
-                    load(memgpt_agent=memgpt_agent, filename=filename)
+                    load(
+                        memgpt_agent=memgpt_agent,
+                        filename=filename,
+                        recall_summary_search=recall_summary_search,
+                    )
                     continue
 
                 elif user_input.lower() == "/dump":
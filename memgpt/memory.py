@@ -1,13 +1,26 @@
 from abc import ABC, abstractmethod
-import datetime
-import re
+from array import array
+import asyncio
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import zlib
 import faiss
 import numpy as np
 
 from .constants import MESSAGE_SUMMARY_WARNING_TOKENS
-from .utils import cosine_similarity, get_local_time, printd, count_tokens
+from .utils import cosine_similarity, get_local_time, printd, count_tokens, normalize_embeddings, top_k_indices, LRUCache, tokenize, \
+    trigrams, EMBEDDING_DTYPES, quantize_embeddings, dequantize_embeddings, TimeIndex, timestamp_to_epoch, date_range_to_epochs, \
+    make_faiss_index, add_to_faiss_index, faiss_index_is_cosine, set_faiss_search_params, locked_file
 from .prompts.gpt_summarize import SYSTEM as SUMMARY_PROMPT_SYSTEM
-from .openai_tools import acompletions_with_backoff as acreate, async_get_embedding_with_backoff
+from .openai_tools import acompletions_with_backoff as acreate
+from .embeddings import DEFAULT_EMBEDDING_MODEL, get_embedding_provider, async_get_embedding, async_get_embeddings
+from .faiss_store import FaissIndexStore
 
 
 class CoreMemory(object):
@@ -126,14 +139,40 @@ async def summarize_messages(
     return reply
 
 
+def without_embedding(memory):
+    """Copy of a preloaded archival memory dict without its 'embedding' (kept in a matrix instead)"""
+    return {key: value for key, value in memory.items() if key != 'embedding'}
+
+
 class ArchivalMemory(ABC):
 
     @abstractmethod
     def insert(self, memory_string):
         pass
 
+    async def insert_many(self, memory_strings, embeddings=None):
+        """Bulk version of insert, implementations should override this to batch embedding + indexing"""
+        for i, memory_string in enumerate(memory_strings):
+            await self.insert(memory_string, embedding=None if embeddings is None else embeddings[i])
+
     @abstractmethod
-    def search(self, query_string, count=None, start=None):
+    def search(self, query_string, count=None, start=None, start_date=None, end_date=None):
+        """start_date/end_date ('YYYY-MM-DD', inclusive) restrict the search to memories inserted in that range"""
+        pass
+
+    def state_generation(self):
+        """Changes whenever the saved state does, memories are only ever added (see InMemoryStateManager.save)"""
+        return len(self)
+
+    def append_only_state(self):
+        """The parts of the pickled state that are only ever appended to, by attribute name
+
+        The persistence manager stores them in chunks, so saving only writes what was appended since the last save.
+        """
+        return {}
+
+    def close(self):
+        """Stop any background work (worker processes, tasks), the memory isn't used anymore"""
         pass
 
     @abstractmethod
@@ -149,8 +188,90 @@ class DummyArchivalMemory(ArchivalMemory):
     is essential enough not to be left only to the recall memory.
     """
 
-    def __init__(self, archival_memory_database=None):
+    def __init__(self, archival_memory_database=None, bm25_k1=1.2, bm25_b=0.75):
         self._archive = [] if archival_memory_database is None else archival_memory_database # consists of {'content': str} dicts
+        self.bm25_k1 = bm25_k1
+        self.bm25_b = bm25_b
+        self._init_index()
+        self._update_index()
+
+    def _init_index(self):
+        # inverted index for BM25: term -> (doc ids, term frequencies), doc ids are positions in self._archive
+        self._postings = {}
+        self._doc_lengths = array('i')
+        self._total_doc_length = 0
+
+    def _update_index(self):
+        """Index archive entries that aren't indexed yet (normally just the last insert)"""
+        for doc_id in range(len(self._doc_lengths), len(self._archive)):
+            terms = tokenize(self._archive[doc_id]['content'])
+            for term, tf in Counter(terms).items():
+                if term not in self._postings:
+                    self._postings[term] = (array('i'), array('i'))
+                doc_ids, tfs = self._postings[term]
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+            self._doc_lengths.append(len(terms))
+            self._total_doc_length += len(terms)
+
+    def _date_candidates(self, start_date=None, end_date=None):
+        """Positions (ascending) of the archive entries inside the date range, None for an unfiltered search
+
+        The time index is only built on the first filtered search, and after that catches up with new entries
+        (also ones appended to a shared archive list by someone else).
+        """
+        if start_date is None and end_date is None:
+            return None
+        start_epoch, end_epoch = date_range_to_epochs(start_date, end_date)
+        if self.__dict__.get('_time_index') is None:
+            self._time_index = TimeIndex()
+        self._time_index.add_timestamps([d['timestamp'] for d in self._archive[len(self._time_index):]])
+        return self._time_index.range(start_epoch, end_epoch)
+
+    def _bm25_scores(self, query_terms, candidates=None):
+        """BM25 scores of every document that contains at least one query term, returns (doc ids, scores)
+
+        With candidates (sorted doc ids), only postings of those documents get scored.
+        """
+        n_docs = len(self._doc_lengths)
+        avg_doc_length = max(self._total_doc_length / max(n_docs, 1), 1e-9)
+        doc_lengths = np.frombuffer(self._doc_lengths, dtype=np.int32)
+        all_doc_ids, all_scores = [], []
+        for term in set(query_terms):
+            if term not in self._postings:
+                continue
+            doc_ids, tfs = (np.frombuffer(a, dtype=np.int32) for a in self._postings[term])
+            # idf is a property of the whole collection, filtering doesn't change it
+            idf = math.log(1 + (n_docs - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            if candidates is not None:
+                keep = np.isin(doc_ids, candidates, assume_unique=True)
+                doc_ids, tfs = doc_ids[keep], tfs[keep]
+            norm = self.bm25_k1 * (1 - self.bm25_b + self.bm25_b * doc_lengths[doc_ids] / avg_doc_length)
+            all_doc_ids.append(doc_ids)
+            all_scores.append(idf * tfs * (self.bm25_k1 + 1) / (tfs + norm))
+        if len(all_doc_ids) == 0:
+            return np.empty(0, dtype=np.int32), np.empty(0)
+        # sum the per-term scores of each document
+        doc_ids, inverse = np.unique(np.concatenate(all_doc_ids), return_inverse=True)
+        return doc_ids, np.bincount(inverse, weights=np.concatenate(all_scores))
+
+    def __getstate__(self):
+        # the index is rebuilt from the archive on load, so saving doesn't rewrite it
+        state = self.__dict__.copy()
+        for key in ['_postings', '_doc_lengths', '_total_doc_length', '_time_index']:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        # pickled before the index existed
+        state.setdefault('bm25_k1', 1.2)
+        state.setdefault('bm25_b', 0.75)
+        self.__dict__.update(state)
+        self._init_index()
+        self._update_index()
+
+    def append_only_state(self):
+        return {'_archive': self._archive}
 
     def __len__(self):
         return len(self._archive)
@@ -172,32 +293,215 @@ class DummyArchivalMemory(ArchivalMemory):
             'timestamp': get_local_time(),
             'content': memory_string,
         })
+        self._update_index()
 
-    async def search(self, query_string, count=None, start=None):
-        """Simple text-based search"""
-        # in the dummy version, run an (inefficient) case-insensitive match search
-        # printd(f"query_string: {query_string}")
-        matches = [s for s in self._archive if query_string.lower() in s['content'].lower()]
-        # printd(f"archive_memory.search (text-based): search for query '{query_string}' returned the following results (limit 5):\n{[str(d['content']) d in matches[:5]]}")
-        printd(f"archive_memory.search (text-based): search for query '{query_string}' returned the following results (limit 5):\n{[matches[start:count]]}")
-
-        # start/count support paging through results
-        if start is not None and count is not None:
-            return matches[start:start+count], len(matches)
-        elif start is None and count is not None:
-            return matches[:count], len(matches)
-        elif start is not None and count is None:
-            return matches[start:], len(matches)
+    async def insert_many(self, memory_strings, embeddings=None):
+        if embeddings is not None:
+            raise ValueError('Basic text-based archival memory does not support embeddings')
+        timestamp = get_local_time()
+        self._archive.extend([{'timestamp': timestamp, 'content': memory_string} for memory_string in memory_strings])
+        self._update_index()
+
+    async def search(self, query_string, count=None, start=None, start_date=None, end_date=None):
+        """Text-based search, ranked with BM25 over an inverted index"""
+        self._update_index()
+        candidates = self._date_candidates(start_date, end_date)
+        query_terms = tokenize(query_string)
+        if len(query_terms) == 0:
+            # nothing to look up in the index (eg punctuation only), fall back to a case-insensitive match search
+            pool = self._archive if candidates is None else [self._archive[i] for i in candidates]
+            matches = [s for s in pool if query_string.lower() in s['content'].lower()]
+            total = len(matches)
+            start = 0 if start is None else start
+            matches = matches[start:] if count is None else matches[start:start+count]
         else:
-            return matches, len(matches)
+            # cost scales with the postings of the query terms, not with the size of the archive
+            doc_ids, scores = self._bm25_scores(query_terms, candidates)
+            total = len(doc_ids)
+            start = 0 if start is None else start
+            # only the requested page gets ranked
+            top = top_k_indices(scores, None if count is None else start + count)
+            matches = [self._archive[i] for i in doc_ids[top[start:]]]
+        printd(f"archive_memory.search (text-based): search for query '{query_string}' returned the following results (limit 5):\n{[d['content'] for d in matches[:5]]}")
+        return matches, total
+
+
+class EmbeddingMatrix(object):
+    """Contiguous matrix of L2-normalized embeddings, one row per stored item
+
+    Rows live in a preallocated buffer that doubles in size when it fills up (amortized O(1) appends),
+    so a query can be scored against every row with a single matrix-vector product.
+
+    Rows can be stored as float32, float16 (half the memory) or int8 with a per-row scale (a quarter of the memory).
+    With a `rescore_path`, the exact float32 rows are also appended to that file and the top candidates of a
+    compressed search get rescored against them (the file is memory-mapped, so only those rows are read).
+    """
+
+    # compressed rows are decompressed this many at a time while scoring, to bound the temporary float32 copy
+    SCORE_BLOCK_ROWS = 65536
+
+    def __init__(self, dim=None, initial_capacity=1024, dtype='float32', rescore_path=None):
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Unknown embedding dtype '{dtype}', expected one of {EMBEDDING_DTYPES}")
+        self.dim = dim
+        self.dtype = dtype
+        self._size = 0
+        self._data = None
+        self._scales = None
+        self.initial_capacity = initial_capacity
+        if dim is not None:
+            self._allocate(initial_capacity, dim)
+
+        self.rescore_path = rescore_path
+        self._originals = None
+        if self.rescore_path is not None:
+            open(self.rescore_path, 'wb').close()
+
+    def __len__(self):
+        return self._size
+
+    def _allocate(self, capacity, dim):
+        new_data = np.empty((capacity, dim), dtype=np.int8 if self.dtype == 'int8' else self.dtype)
+        new_scales = np.empty(capacity, dtype=np.float32) if self.dtype == 'int8' else None
+        if self._data is not None:
+            new_data[:self._size] = self._data[:self._size]
+            if new_scales is not None:
+                new_scales[:self._size] = self._scales[:self._size]
+        self._data, self._scales = new_data, new_scales
+
+    def _reserve(self, n_rows, dim):
+        if self._data is None:
+            self.dim = dim
+            self._allocate(max(self.initial_capacity, n_rows), dim)
+        elif dim != self.dim:
+            raise ValueError(f"Embedding dimension mismatch: expected {self.dim}, got {dim}")
+        elif n_rows > len(self._data):
+            new_capacity = max(len(self._data), 1)
+            while new_capacity < n_rows:
+                new_capacity *= 2
+            self._allocate(new_capacity, self.dim)
+
+    def append(self, embedding):
+        self.extend([embedding])
+
+    def extend(self, embeddings):
+        embeddings = normalize_embeddings(embeddings)
+        if embeddings.ndim != 2 or len(embeddings) == 0:
+            return
+        self._reserve(self._size + len(embeddings), embeddings.shape[1])
+        data, scales = quantize_embeddings(embeddings, self.dtype)
+        self._data[self._size:self._size + len(embeddings)] = data
+        if scales is not None:
+            self._scales[self._size:self._size + len(embeddings)] = scales
+        if self.rescore_path is not None:
+            with open(self.rescore_path, 'ab') as f:
+                f.write(embeddings.tobytes())
+        self._size += len(embeddings)
+
+    @property
+    def vectors(self):
+        """View (not a copy) of the filled rows, as stored (possibly compressed)"""
+        if self._data is None:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return self._data[:self._size]
+
+    def nbytes(self):
+        return self.vectors.nbytes + (0 if self._scales is None else self._scales[:self._size].nbytes)
+
+    def scores(self, query_embedding, rows=None):
+        """(Approximate, if compressed) cosine similarity of the query against every row, or only against `rows`"""
+        n_rows = self._size if rows is None else len(rows)
+        if n_rows == 0:
+            return np.empty(0, dtype=np.float32)
+        query_embedding = normalize_embeddings(query_embedding)
+        if self.dtype == 'float32':
+            return (self.vectors if rows is None else self._data[rows]) @ query_embedding
+        scores = np.empty(n_rows, dtype=np.float32)
+        for block_start in range(0, n_rows, self.SCORE_BLOCK_ROWS):
+            block_end = min(block_start + self.SCORE_BLOCK_ROWS, n_rows)
+            block = slice(block_start, block_end) if rows is None else rows[block_start:block_end]
+            block_scales = None if self._scales is None else self._scales[block]
+            scores[block_start:block_end] = dequantize_embeddings(self._data[block], block_scales) @ query_embedding
+        return scores
+
+    def _exact_rows(self, rows):
+        # (re)map the file whenever rows were appended since it was last mapped
+        if self._originals is None or len(self._originals) != self._size:
+            self._originals = np.memmap(self.rescore_path, dtype=np.float32, mode='r', shape=(self._size, self.dim))
+        return np.asarray(self._originals[rows])
+
+    def search(self, query_embedding, k=None, rescore_factor=4, rows=None):
+        """Top-k rows (best first) and their scores, rescoring compressed candidates exactly if possible
+
+        rows (sorted row numbers) restricts the search to those rows.
+        """
+        scores = self.scores(query_embedding, rows)
+        rows = np.arange(len(scores)) if rows is None else np.asarray(rows)
+        if k is None or self.dtype == 'float32' or self.rescore_path is None or len(scores) == 0:
+            top = top_k_indices(scores, k)
+            return rows[top], scores[top]
+        # sorted candidate rows make the reads from the file sequential
+        candidates = rows[np.sort(top_k_indices(scores, k * rescore_factor))]
+        exact_scores = self._exact_rows(candidates) @ normalize_embeddings(query_embedding)
+        top = top_k_indices(exact_scores, k)
+        return candidates[top], exact_scores[top]
+
+    def __getitem__(self, rows):
+        """A matrix of the rows in a slice, as stored (eg. the rows added since some point, see append_only_state)"""
+        if not isinstance(rows, slice):
+            raise TypeError(f"EmbeddingMatrix rows are selected with a slice, not {type(rows).__name__}")
+        piece = EmbeddingMatrix.__new__(EmbeddingMatrix)
+        piece.__dict__.update(self.__dict__)
+        piece._data = None if self._data is None else self.vectors[rows].copy()
+        piece._scales = None if self._scales is None else self._scales[:self._size][rows].copy()
+        piece._size = 0 if piece._data is None else len(piece._data)
+        piece._originals = None
+        return piece
+
+    def __iadd__(self, other):
+        """Append the rows of a matrix with the same dtype as they're stored (eg. the pieces of a matrix, see __getitem__)
+
+        Unlike extend, the exact rows aren't appended to the rescore file, it has them already.
+        """
+        if len(other) == 0:
+            return self
+        self._reserve(self._size + len(other), other.dim)
+        self._data[self._size:self._size + len(other)] = other.vectors
+        if self._scales is not None:
+            self._scales[self._size:self._size + len(other)] = other._scales[:len(other)]
+        self._size += len(other)
+        return self
+
+    def __getstate__(self):
+        # don't pickle the unused tail of the buffer
+        state = self.__dict__.copy()
+        state['_data'] = None if self._data is None else self.vectors.copy()
+        state['_scales'] = None if self._scales is None else self._scales[:self._size].copy()
+        state['_originals'] = None
+        return state
+
+    def __setstate__(self, state):
+        # matrices pickled before compression was supported are plain float32
+        state.setdefault('dtype', 'float32')
+        state.setdefault('_scales', None)
+        state.setdefault('rescore_path', None)
+        state.setdefault('_originals', None)
+        self.__dict__.update(state)
 
 
 class DummyArchivalMemoryWithEmbeddings(DummyArchivalMemory):
     """Same as dummy in-memory archival memory, but with bare-bones embedding support"""
 
-    def __init__(self, archival_memory_database=None, embedding_model='text-embedding-ada-002'):
+    def __init__(self, archival_memory_database=None, embedding_model=DEFAULT_EMBEDDING_MODEL, embedding_dtype='float32', rescore_path=None):
         self._archive = [] if archival_memory_database is None else archival_memory_database # consists of {'content': str} dicts
         self.embedding_model = embedding_model
+        # row i of the matrix is the (normalized) embedding of self._archive[i]
+        self._embeddings = EmbeddingMatrix(dtype=embedding_dtype, rescore_path=rescore_path)
+        if any('embedding' not in memory for memory in self._archive):
+            raise ValueError('All preloaded archival memories need an embedding')
+        self._embeddings.extend([memory['embedding'] for memory in self._archive])
+        # the embeddings live in the matrix, the archive keeps copies of the entries without them (the preloaded database isn't modified)
+        self._archive = [without_embedding(memory) for memory in self._archive]
 
     def __len__(self):
         return len(self._archive)
@@ -205,46 +509,59 @@ class DummyArchivalMemoryWithEmbeddings(DummyArchivalMemory):
     async def insert(self, memory_string, embedding=None):
         # Get the embedding
         if embedding is None:
-            embedding = await async_get_embedding_with_backoff(memory_string, model=self.embedding_model)
+            embedding = await async_get_embedding(memory_string, model=self.embedding_model)
         embedding_meta = {'model': self.embedding_model}
         printd(f"Got an embedding, type {type(embedding)}, len {len(embedding)}")
 
+        self._embeddings.append(embedding)
         self._archive.append({
             'timestamp': get_local_time(),
             'content': memory_string,
-            'embedding': embedding,
             'embedding_metadata': embedding_meta,
         })
 
-    async def search(self, query_string, count=None, start=None):
-        """Simple embedding-based search (inefficient, no caching)"""
+    async def insert_many(self, memory_strings, embeddings=None):
+        if embeddings is None:
+            embeddings = await async_get_embeddings(memory_strings, model=self.embedding_model)
+        timestamp = get_local_time()
+        self._embeddings.extend(embeddings)
+        self._archive.extend([{
+            'timestamp': timestamp,
+            'content': memory_string,
+            'embedding_metadata': {'model': self.embedding_model},
+        } for memory_string in memory_strings])
+
+    async def search(self, query_string, count=None, start=None, start_date=None, end_date=None):
+        """Embedding-based search, scored with a single matrix-vector product over the normalized embeddings"""
         # see: https://github.com/openai/openai-cookbook/blob/main/examples/Semantic_text_search_using_embeddings.ipynb
 
+        # with a date range, only the rows inside it get scored
+        candidates = self._date_candidates(start_date, end_date)
+        if candidates is not None and len(candidates) == 0:
+            return [], 0
+
         # query_embedding = get_embedding(query_string, model=self.embedding_model)
         # our wrapped version supports backoff/rate-limits
-        query_embedding = await async_get_embedding_with_backoff(query_string, model=self.embedding_model)
-        similarity_scores = [cosine_similarity(memory['embedding'], query_embedding) for memory in self._archive]
-
-        # Sort the archive based on similarity scores
-        sorted_archive_with_scores = sorted(
-            zip(self._archive, similarity_scores),
-            key=lambda pair: pair[1],  # Sort by the similarity score
-            reverse=True  # We want the highest similarity first
-        )
-        printd(f"archive_memory.search (vector-based): search for query '{query_string}' returned the following results (limit 5) and scores:\n{str([str(t[0]['content']) + '- score ' + str(t[1]) for t in sorted_archive_with_scores[:5]])}")
+        query_embedding = await async_get_embedding(query_string, model=self.embedding_model)
 
-        # Extract the sorted archive without the scores
-        matches = [item[0] for item in sorted_archive_with_scores]
+        # Only the requested page needs to be ranked, select it with a partial sort
+        start = 0 if start is None else start
+        top_indices, similarity_scores = self._embeddings.search(query_embedding, None if count is None else start + count, rows=candidates)
+        printd(f"archive_memory.search (vector-based): search for query '{query_string}' returned the following results (limit 5) and scores:\n{str([str(self._archive[i]['content']) + '- score ' + str(score) for i, score in zip(top_indices[:5], similarity_scores[:5])])}")
 
-        # start/count support paging through results
-        if start is not None and count is not None:
-            return matches[start:start+count], len(matches)
-        elif start is None and count is not None:
-            return matches[:count], len(matches)
-        elif start is not None and count is None:
-            return matches[start:], len(matches)
-        else:
-            return matches, len(matches)
+        matches = [self._archive[i] for i in top_indices[start:]]
+        return matches, len(self._archive) if candidates is None else len(candidates)
+
+    def append_only_state(self):
+        return {'_archive': self._archive, '_embeddings': self._embeddings}
+
+    def __setstate__(self, state):
+        # agents pickled before the embedding matrix existed kept a float list inside every archive entry
+        self.__dict__.update(state)
+        if '_embeddings' not in state:
+            self._embeddings = EmbeddingMatrix()
+            self._embeddings.extend([memory['embedding'] for memory in self._archive])
+            self._archive = [without_embedding(memory) for memory in self._archive]
 
 
 class DummyArchivalMemoryWithFaiss(DummyArchivalMemory):
@@ -259,16 +576,103 @@ class DummyArchivalMemoryWithFaiss(DummyArchivalMemory):
     is essential enough not to be left only to the recall memory.
     """
 
-    def __init__(self, index=None, archival_memory_database=None, embedding_model='text-embedding-ada-002', k=100):
+    def __init__(self, index=None, archival_memory_database=None, embedding_model=DEFAULT_EMBEDDING_MODEL, k=100, index_type='flat', nprobe=None, ef_search=None, cache_max_bytes=32*1024*1024, similarity_threshold=None):
         if index is None:
-            self.index = faiss.IndexFlatL2(1536)    # openai embedding vector size.
+            # an empty archive has nothing to train IVF cells (or sq8 ranges) on yet, so those start out as flat indexes
+            if index_type not in ['flat', 'sq-fp16', 'hnsw']:
+                printd(f"Can't train a '{index_type}' index on an empty archive, using a flat index instead")
+                index_type = 'flat'
+            # the provider knows its vector size, 1536 is the openai embedding vector size
+            self.index = make_faiss_index(get_embedding_provider(embedding_model).dim or 1536, index_type)
         else:
             self.index = index
+            embedding_dim = get_embedding_provider(embedding_model).dim
+            if embedding_dim is not None and embedding_dim != self.index.d:
+                raise ValueError(f"Index has {self.index.d}-dimensional vectors, but embedding model '{embedding_model}' produces {embedding_dim}-dimensional ones")
+        set_faiss_search_params(self.index, nprobe=nprobe, ef_search=ef_search)
+        # initial retrieval depth, deepened on demand when the agent pages past it
         self.k = k
+        # optional cosine similarity cutoff, results below it are never returned
+        self.similarity_threshold = similarity_threshold
         self._archive = [] if archival_memory_database is None else archival_memory_database # consists of {'content': str} dicts
         self.embedding_model = embedding_model
-        self.embeddings_dict = {}
-        self.search_results = {}
+        self._init_caches(cache_max_bytes)
+        self._init_store(None)
+
+    def _init_store(self, store_path, saved_count=0, generation=None, base=None):
+        # with a store directory (see checkpoint), pickling only records where the archive lives
+        self.store_path = store_path
+        self._store = None
+        # the store generation this archive was last checkpointed as (and its base), pinned in the pickle
+        self._store_generation = generation
+        self._store_base = base
+        # number of archive entries already in the store, and the vectors (as added to the index) of the ones after them
+        self._saved_count = saved_count
+        self._unsaved_embeddings = []
+
+    def _init_caches(self, cache_max_bytes):
+        # query embeddings don't depend on the archive contents, search results do:
+        # every insert bumps the generation, and results from older generations get recomputed on their next lookup
+        self.generation = 0
+        self.query_embedding_cache = LRUCache(max_bytes=cache_max_bytes // 2)
+        self.search_results_cache = LRUCache(max_bytes=cache_max_bytes // 2)
+
+    def checkpoint(self, store_path=None):
+        """Save the archive to its store directory (see FaissIndexStore)
+
+        The first checkpoint into a store writes the whole index, later ones only add the memories inserted since
+        (as a new generation on top of the one this archive was loaded from or last saved as). Returns the generation.
+        """
+        if store_path is not None and store_path != self.store_path:
+            self._init_store(store_path)
+        if self._store is None:
+            self._store = FaissIndexStore(self.store_path)
+        if self._store_generation is None:
+            generation = self._store.write_base(self.index, self._archive)
+        else:
+            unsaved = np.concatenate(self._unsaved_embeddings) if self._unsaved_embeddings else np.empty((0, self.index.d), dtype=np.float32)
+            generation = self._store.append_segment(self._store_generation, unsaved, self._archive[self._saved_count:])
+        self._store_generation = generation
+        self._store_base = self._store.read_manifest(generation)['base']
+        self._saved_count = len(self._archive)
+        self._unsaved_embeddings = []
+        return generation
+
+    def __getstate__(self):
+        if self.__dict__.get('store_path') is None:
+            return self.__dict__.copy()
+        if self._saved_count != len(self._archive):
+            raise RuntimeError(f"Archival memory has {len(self._archive) - self._saved_count} memories that aren't in its store yet, checkpoint() it before pickling")
+        # the index and archive are in the store now, caches get rebuilt
+        skip = ['index', '_archive', '_store', '_unsaved_embeddings', 'query_embedding_cache', 'search_results_cache', '_time_index']
+        state = {key: value for key, value in self.__dict__.items() if key not in skip}
+        state['cache_max_bytes'] = self.query_embedding_cache.max_bytes + self.search_results_cache.max_bytes
+        return state
+
+    def __setstate__(self, state):
+        if 'cache_max_bytes' in state:
+            # saved to a store directory: load the archive as of this checkpoint
+            cache_max_bytes = state.pop('cache_max_bytes')
+            if '_store_generation' not in state:
+                raise ValueError(f"Archival store {state['store_path']} was saved without pinned checkpoints, it can't be loaded as it was saved")
+            self.__dict__.update(state)
+            self._init_caches(cache_max_bytes)
+            self._init_store(state['store_path'], state['_saved_count'], state['_store_generation'], state['_store_base'])
+            self._store = FaissIndexStore(self.store_path)
+            # exactly the generation this pickle was checkpointed as, or an error if the store doesn't have it anymore
+            self.index, self._archive, manifest = self._store.load(self._store_generation)
+            if manifest['base'] != self._store_base or len(self._archive) != self._saved_count:
+                raise ValueError(f"Archival store {self.store_path} checkpoint {self._store_generation} isn't the one this state was saved with")
+            return
+        # agents pickled before the bounded caches existed carry unbounded dicts instead
+        self.__dict__.update(state)
+        if 'search_results_cache' not in state:
+            self.__dict__.pop('embeddings_dict', None)
+            self.__dict__.pop('search_results', None)
+            self._init_caches(32*1024*1024)
+        self.__dict__.setdefault('similarity_threshold', None)
+        if 'store_path' not in state:
+            self._init_store(None)
 
     def __len__(self):
         return len(self._archive)
@@ -276,7 +680,7 @@ class DummyArchivalMemoryWithFaiss(DummyArchivalMemory):
     async def insert(self, memory_string, embedding=None):
         if embedding is None:
             # Get the embedding
-            embedding = await async_get_embedding_with_backoff(memory_string, model=self.embedding_model)
+            embedding = await async_get_embedding(memory_string, model=self.embedding_model)
         print(f"Got an embedding, type {type(embedding)}, len {len(embedding)}")
 
         self._archive.append({
@@ -284,46 +688,580 @@ class DummyArchivalMemoryWithFaiss(DummyArchivalMemory):
             'timestamp': get_local_time(),
             'content': memory_string,
         })
-        embedding = np.array([embedding]).astype('float32')
-        self.index.add(embedding)
-
-    async def search(self, query_string, count=None, start=None):
-        """Simple embedding-based search (inefficient, no caching)"""
+        self._unsaved_embeddings.append(add_to_faiss_index(self.index, [embedding]))
+        self.generation += 1
+
+    async def insert_many(self, memory_strings, embeddings=None):
+        if embeddings is None:
+            embeddings = await async_get_embeddings(memory_strings, model=self.embedding_model)
+        timestamp = get_local_time()
+        self._archive.extend([{'timestamp': timestamp, 'content': memory_string} for memory_string in memory_strings])
+        self._unsaved_embeddings.append(add_to_faiss_index(self.index, embeddings))
+        self.generation += 1
+
+    async def _embed_query(self, query_string):
+        query_vector = self.query_embedding_cache.get(query_string)
+        if query_vector is None:
+            # our wrapped version supports backoff/rate-limits
+            query_embedding = await async_get_embedding(query_string, model=self.embedding_model)
+            query_vector = np.array([query_embedding], dtype=np.float32)
+            if faiss_index_is_cosine(self.index):
+                query_vector = normalize_embeddings(query_vector)
+            self.query_embedding_cache.put(query_string, query_vector, nbytes=query_vector.nbytes + len(query_string))
+        return query_vector
+
+    def _search_params(self, candidates):
+        """FAISS search parameters that restrict the search to the candidate ids, keeping the index's own search settings"""
+        selector = faiss.IDSelectorBatch(candidates.astype(np.int64))
+        ivf_index = faiss.try_extract_index_ivf(self.index)
+        if ivf_index is not None:
+            return faiss.SearchParametersIVF(sel=selector, nprobe=ivf_index.nprobe)
+        if hasattr(self.index, 'hnsw'):
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=self.index.hnsw.efSearch)
+        return faiss.SearchParameters(sel=selector)
+
+    def _retrieve(self, query_vector, depth, candidates=None):
+        """Retrieve the top-`depth` neighbors, returns (indices, similarities, exhausted)
+
+        `exhausted` means there is nothing left to retrieve past these results (whole index returned,
+        or the similarity threshold was crossed), ie. the number of results is the true total.
+        With candidates, only those ids are searched.
+        """
+        n_searchable = self.index.ntotal if candidates is None else len(candidates)
+        depth = min(depth, n_searchable)
+        if candidates is None:
+            distances, indices = self.index.search(query_vector, depth)
+        else:
+            distances, indices = self.index.search(query_vector, depth, params=self._search_params(candidates))
+        distances, indices = distances[0], indices[0]
+        # approximate indexes pad with -1 when the probed part of the index holds fewer than `depth` vectors
+        valid = indices >= 0
+        exhausted = depth >= n_searchable or not valid.all()
+        indices, distances = indices[valid], distances[valid]
+        if faiss_index_is_cosine(self.index):
+            similarities = distances
+        else:
+            # legacy L2 indexes: for unit-length (eg OpenAI) embeddings, cosine = 1 - d^2/2 (FAISS returns squared distances)
+            similarities = 1.0 - distances / 2.0
+        if self.similarity_threshold is not None:
+            above = similarities >= self.similarity_threshold
+            if not above.all():
+                exhausted = True
+                indices, similarities = indices[above], similarities[above]
+        return indices, similarities, exhausted
+
+    async def search(self, query_string, count=None, start=None, start_date=None, end_date=None):
+        """Embedding-based search, with query embeddings and result pages cached across calls
+
+        Retrieval starts at depth k and is deepened (doubling) only when a requested page goes past
+        what has been retrieved so far, so the first page stays cheap without capping how deep the agent can page.
+        A deeper search only appends the results that weren't retrieved yet, so pages already returned never change
+        (ties and approximate indexes can order results differently at different depths).
+        A date range is applied inside FAISS (as an id selector), so the retrieval depth isn't spent on filtered-out vectors.
+
+        The total is exact for flat and HNSW indexes (every searchable memory is a result) and with a similarity
+        threshold (retrieval deepens until it's crossed). Approximate (IVF) indexes can't reach every vector, so until
+        retrieval is exhausted their total is an upper bound: the number of searchable memories.
+        """
         # see: https://github.com/openai/openai-cookbook/blob/main/examples/Semantic_text_search_using_embeddings.ipynb
+        start = 0 if start is None else start
+        candidates = self._date_candidates(start_date, end_date)
+        n_searchable = self.index.ntotal if candidates is None else len(candidates)
+        if n_searchable == 0:
+            return [], 0
+        needed = n_searchable if count is None else start + count
+
+        cache_key = query_string if candidates is None else (query_string, start_date, end_date)
+        cached = self.search_results_cache.get(cache_key, generation=self.generation)
+        if cached is None or (len(cached[0]) < needed and not cached[2]):
+            query_vector = await self._embed_query(query_string)
+            depth = max(self.k, needed) if cached is None else max(needed, 2 * len(cached[0]))
+            indices, similarities, exhausted = self._retrieve(query_vector, depth, candidates)
+            # with a threshold, keep deepening until it's crossed so the reported total is exact
+            while self.similarity_threshold is not None and not exhausted:
+                depth *= 2
+                indices, similarities, exhausted = self._retrieve(query_vector, depth, candidates)
+            if cached is not None:
+                # the ranking returned so far stays a fixed prefix, followed by the newly retrieved ids
+                new = ~np.isin(indices, cached[0])
+                indices, similarities = np.concatenate([cached[0], indices[new]]), np.concatenate([cached[1], similarities[new]])
+            cached = (indices, similarities, exhausted)
+            self.search_results_cache.put(cache_key, cached, nbytes=indices.nbytes + similarities.nbytes + len(query_string), generation=self.generation)
+        printd(f"archive_memory.search (vector-based): query embedding cache {self.query_embedding_cache.stats()}, search results cache {self.search_results_cache.stats()}")
+
+        indices, similarities, exhausted = cached
+        # until retrieval is exhausted, every other (searchable) vector in the index can still be paged to (see above)
+        total = len(indices) if exhausted else n_searchable
+        page = indices[start:] if count is None else indices[start:start+count]
+        matches = [self._archive[idx] for idx in page if idx < len(self._archive)]
+        printd(f"archive_memory.search (vector-based): search for query '{query_string}' returned the following results ({start}--{start+len(matches)}/{total}) and scores:\n{str([(t['content'][:60], float(s)) for t, s in zip(matches[:5], similarities[start:start+5])])}")
+        return matches, total
+
+
+class DummyArchivalMemoryHybrid(ArchivalMemory):
+    """Hybrid archival memory: lexical (BM25) and vector search over the same archive, merged with reciprocal-rank fusion
+
+    Embeddings alone tend to miss exact identifiers (error codes, table names, ...) that a keyword search finds,
+    and keyword search misses paraphrases; fusing both rankings gets better first-page hits than either one.
+    """
 
-        # query_embedding = get_embedding(query_string, model=self.embedding_model)
-        # our wrapped version supports backoff/rate-limits
-        if query_string in self.embeddings_dict:
-            query_embedding = self.embeddings_dict[query_string]
-            search_result = self.search_results[query_string]
+    def __init__(self, vector_memory, rrf_k=60, fusion_depth=50):
+        # the lexical index is built over the vector memory's archive list, so inserts only have to go through the vector memory
+        self.vector_memory = vector_memory
+        self._archive = vector_memory._archive
+        self.lexical_memory = DummyArchivalMemory(archival_memory_database=self._archive)
+        self.rrf_k = rrf_k
+        self.fusion_depth = fusion_depth
+
+    def __len__(self):
+        return len(self._archive)
+
+    def __repr__(self) -> str:
+        return repr(self.lexical_memory)
+
+    def __getstate__(self):
+        # the archive is saved with the vector memory, the lexical index gets rebuilt over it on load
+        state = self.__dict__.copy()
+        del state['_archive'], state['lexical_memory']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._archive = self.vector_memory._archive
+        self.lexical_memory = DummyArchivalMemory(archival_memory_database=self._archive)
+
+    def append_only_state(self):
+        return self.vector_memory.append_only_state()
+
+    async def insert(self, memory_string, embedding=None):
+        await self.vector_memory.insert(memory_string, embedding=embedding)
+        self.lexical_memory._update_index()
+
+    async def insert_many(self, memory_strings, embeddings=None):
+        await self.vector_memory.insert_many(memory_strings, embeddings=embeddings)
+        self.lexical_memory._update_index()
+
+    async def search(self, query_string, count=None, start=None, start_date=None, end_date=None):
+        """Run lexical and vector search concurrently, then merge with reciprocal-rank fusion"""
+        start = 0 if start is None else start
+        depth = len(self._archive) if count is None else max(self.fusion_depth, start + count)
+        (lexical_matches, lexical_total), (vector_matches, vector_total) = await asyncio.gather(
+            self.lexical_memory.search(query_string, count=depth, start=0, start_date=start_date, end_date=end_date),
+            self.vector_memory.search(query_string, count=depth, start=0, start_date=start_date, end_date=end_date),
+        )
+
+        # archive entries are shared by both searches, so they can be matched up by identity
+        fused_scores = {}
+        memories = {}
+        for matches in [lexical_matches, vector_matches]:
+            for rank, memory in enumerate(matches):
+                fused_scores[id(memory)] = fused_scores.get(id(memory), 0.0) + 1.0 / (self.rrf_k + rank + 1)
+                memories[id(memory)] = memory
+        ranked = sorted(fused_scores, key=fused_scores.get, reverse=True)
+        printd(f"archive_memory.search (hybrid): search for query '{query_string}' fused {len(lexical_matches)} lexical and {len(vector_matches)} vector results")
+
+        matches = [memories[key] for key in ranked]
+        total = max(len(matches), lexical_total, vector_total)
+        if count is None:
+            return matches[start:], total
+        return matches[start:start+count], total
+
+
+class MmapArchivalMemory(ArchivalMemory):
+    """On-disk archival memory, memory-mapped instead of held in RAM
+
+    Layout of the archive directory:
+        meta.json        -- embedding dimension + model
+        embeddings.f32   -- one row of L2-normalized float32 per memory
+        contents.jsonl   -- one {'timestamp', 'content'} record per memory
+        epochs.f64       -- timestamp of each memory as a number (see timestamp_to_epoch), for date filters
+        offsets.i64      -- byte offset of each record in contents.jsonl
+        lock             -- held (exclusively) by an insert, and while the archive is recovered
+
+    Opening only maps the files, so it costs the same for 10 or 10M memories, and processes
+    serving the same archive share one copy of it through the OS page cache.
+    A memory is only counted once its offset is written (the last step of an insert), so readers never see a
+    partial insert. Anything an interrupted insert left behind in the other files is cut off when the archive is
+    opened, under the lock: the OS releases the lock of a process that died, so while it's held no other process
+    is in the middle of an insert, and only what a crashed one left behind gets cut off.
+    """
+
+    META_FILE = 'meta.json'
+    EMBEDDINGS_FILE = 'embeddings.f32'
+    CONTENTS_FILE = 'contents.jsonl'
+    EPOCHS_FILE = 'epochs.f64'
+    OFFSETS_FILE = 'offsets.i64'
+    LOCK_FILE = 'lock'
+
+    def __init__(self, path, embedding_model=DEFAULT_EMBEDDING_MODEL, dim=None):
+        self.path = path
+        self.embedding_model = embedding_model
+        self.dim = dim
+        os.makedirs(self.path, exist_ok=True)
+
+        with locked_file(self._file(self.LOCK_FILE)):
+            self._read_meta()
+            for filename in [self.EMBEDDINGS_FILE, self.CONTENTS_FILE, self.EPOCHS_FILE, self.OFFSETS_FILE]:
+                open(os.path.join(self.path, filename), 'ab').close()
+            self._recover()
+
+        # maps are (re)opened lazily, after inserts change the file sizes
+        self._embeddings = None
+        self._offsets = None
+        # built on the first date-filtered search
+        self._time_index = None
+
+    def _file(self, filename):
+        return os.path.join(self.path, filename)
+
+    def _read_meta(self):
+        meta_file = self._file(self.META_FILE)
+        if os.path.exists(meta_file):
+            with open(meta_file, 'rt') as f:
+                meta = json.load(f)
+            self.dim = meta['dim']
+            self.embedding_model = meta['embedding_model']
+
+    def _recover(self):
+        """Cut off whatever an insert that was interrupted before its offsets were (fully) written left behind (call with the lock held)"""
+        count = len(self)
+        os.truncate(self._file(self.OFFSETS_FILE), count * 8)
+        if self.dim is not None and os.path.getsize(self._file(self.EMBEDDINGS_FILE)) > count * self.dim * 4:
+            os.truncate(self._file(self.EMBEDDINGS_FILE), count * self.dim * 4)
+        if os.path.getsize(self._file(self.EPOCHS_FILE)) > count * 8:
+            os.truncate(self._file(self.EPOCHS_FILE), count * 8)
+        with open(self._file(self.CONTENTS_FILE), 'rb+') as f:
+            if count == 0:
+                f.truncate(0)
+            else:
+                f.seek(int(np.fromfile(self._file(self.OFFSETS_FILE), dtype=np.int64, count=1, offset=(count - 1) * 8)[0]))
+                f.truncate(f.tell() + len(f.readline()))
+
+    def __len__(self):
+        return os.path.getsize(self._file(self.OFFSETS_FILE)) // 8
+
+    def __repr__(self) -> str:
+        return \
+            f"\n### ARCHIVAL MEMORY ###" + \
+            f"\n{len(self)} memories stored in {self.path}"
+
+    def __getstate__(self):
+        # only the location is pickled, the archive itself stays on disk
+        return {'path': self.path, 'embedding_model': self.embedding_model, 'dim': self.dim}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _open_maps(self):
+        count = len(self)
+        if self._offsets is not None and len(self._offsets) == count:
+            return
+        if count == 0:
+            self._embeddings = np.empty((0, self.dim or 0), dtype=np.float32)
+            self._offsets = np.empty(0, dtype=np.int64)
         else:
-            query_embedding = await async_get_embedding_with_backoff(query_string, model=self.embedding_model)
-            _, indices = self.index.search(np.array([np.array(query_embedding, dtype=np.float32)]), self.k)
-            search_result = [self._archive[idx] if idx < len(self._archive) else "" for idx in indices[0]]
-            self.embeddings_dict[query_string] = query_embedding
-            self.search_results[query_string] = search_result
-
-        if start is not None and count is not None:
-            toprint = search_result[start:start+count]
+            self._embeddings = np.memmap(self._file(self.EMBEDDINGS_FILE), dtype=np.float32, mode='r', shape=(count, self.dim))
+            self._offsets = np.memmap(self._file(self.OFFSETS_FILE), dtype=np.int64, mode='r', shape=(count,))
+
+    def _read_memories(self, indices):
+        memories = []
+        with open(self._file(self.CONTENTS_FILE), 'rb') as f:
+            for i in indices:
+                f.seek(int(self._offsets[i]))
+                memories.append(json.loads(f.readline()))
+        return memories
+
+    async def insert(self, memory_string, embedding=None):
+        if embedding is None:
+            embedding = await async_get_embedding(memory_string, model=self.embedding_model)
+        self._append([memory_string], [embedding])
+
+    async def insert_many(self, memory_strings, embeddings=None):
+        if embeddings is None:
+            embeddings = await async_get_embeddings(memory_strings, model=self.embedding_model)
+        self._append(memory_strings, embeddings)
+
+    def _append(self, memory_strings, embeddings):
+        embeddings = normalize_embeddings(embeddings)
+        if len(memory_strings) == 0:
+            return
+        with locked_file(self._file(self.LOCK_FILE)):
+            self._append_locked(memory_strings, embeddings)
+
+    def _append_locked(self, memory_strings, embeddings):
+        # another process may have made the first insert since this one opened the archive
+        if self.dim is None:
+            self._read_meta()
+        self._backfill_epochs()
+
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+            with open(self._file(self.META_FILE), 'wt') as f:
+                json.dump({'dim': self.dim, 'embedding_model': self.embedding_model}, f)
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension mismatch: expected {self.dim}, got {embeddings.shape[1]}")
+
+        timestamp = get_local_time()
+        records = [(json.dumps({
+            'timestamp': timestamp,
+            'content': memory_string,
+        }) + '\n').encode('utf-8') for memory_string in memory_strings]
+        with open(self._file(self.EMBEDDINGS_FILE), 'ab') as f:
+            f.write(embeddings.tobytes())
+        with open(self._file(self.EPOCHS_FILE), 'ab') as f:
+            f.write(np.full(len(records), timestamp_to_epoch(timestamp), dtype=np.float64).tobytes())
+        with open(self._file(self.CONTENTS_FILE), 'ab') as f:
+            offset = f.tell()
+            f.write(b''.join(records))
+        offsets = offset + np.cumsum([0] + [len(record) for record in records[:-1]], dtype=np.int64)
+        # written last: the memories only count as inserted once their offsets are in
+        with open(self._file(self.OFFSETS_FILE), 'ab') as f:
+            f.write(offsets.tobytes())
+
+    def _backfill_epochs(self):
+        """Archives written before epochs.f64 existed get it filled in from the content records (once)"""
+        count = len(self)
+        n_epochs = os.path.getsize(self._file(self.EPOCHS_FILE)) // 8
+        if n_epochs < count:
+            self._open_maps()
+            epochs = [timestamp_to_epoch(d['timestamp']) for d in self._read_memories(range(n_epochs, count))]
+            with open(self._file(self.EPOCHS_FILE), 'ab') as f:
+                f.write(np.array(epochs, dtype=np.float64).tobytes())
+
+    def _date_candidates(self, start_date=None, end_date=None):
+        """Rows (ascending) of the memories inside the date range, None for an unfiltered search"""
+        if start_date is None and end_date is None:
+            return None
+        start_epoch, end_epoch = date_range_to_epochs(start_date, end_date)
+        if os.path.getsize(self._file(self.EPOCHS_FILE)) // 8 < len(self):
+            with locked_file(self._file(self.LOCK_FILE)):
+                self._backfill_epochs()
+        if self._time_index is None:
+            self._time_index = TimeIndex()
+        n_new = len(self) - len(self._time_index)
+        if n_new > 0:
+            self._time_index.add(np.fromfile(self._file(self.EPOCHS_FILE), dtype=np.float64, count=n_new, offset=len(self._time_index) * 8))
+        return self._time_index.range(start_epoch, end_epoch)
+
+    async def search(self, query_string, count=None, start=None, start_date=None, end_date=None):
+        """Embedding-based search over the memory-mapped embeddings"""
+        candidates = self._date_candidates(start_date, end_date)
+        self._open_maps()
+        total = len(self._offsets) if candidates is None else len(candidates)
+        if total == 0:
+            return [], 0
+
+        query_embedding = await async_get_embedding(query_string, model=self.embedding_model)
+        if candidates is None:
+            similarity_scores = self._embeddings @ normalize_embeddings(query_embedding)
         else:
-            if len(search_result) >= 5:
-                toprint = search_result[:5]
-            else:
-                toprint = search_result
-        printd(f"archive_memory.search (vector-based): search for query '{query_string}' returned the following results ({start}--{start+5}/{len(search_result)}) and scores:\n{str([t[:60] if len(t) > 60 else t for t in toprint])}")
+            # only the rows inside the date range are read from the file and scored
+            similarity_scores = self._embeddings[candidates] @ normalize_embeddings(query_embedding)
 
-        # Extract the sorted archive without the scores
-        matches = search_result
+        start = 0 if start is None else start
+        top_indices = top_k_indices(similarity_scores, None if count is None else start + count)
+        if candidates is not None:
+            top_indices = candidates[top_indices]
+        matches = self._read_memories(top_indices[start:])
+        printd(f"archive_memory.search (mmap vector-based): search for query '{query_string}' returned the following results (limit 5):\n{[d['content'] for d in matches[:5]]}")
+        return matches, total
 
-        # start/count support paging through results
-        if start is not None and count is not None:
-            return matches[start:start+count], len(matches)
-        elif start is None and count is not None:
-            return matches[:count], len(matches)
-        elif start is not None and count is None:
-            return matches[start:], len(matches)
+
+# Worker-process side of ShardedArchivalMemory: each worker process owns exactly one shard
+_shard = None
+
+
+def _shard_init(dtype):
+    global _shard
+    _shard = {
+        'memories': [],
+        'embeddings': EmbeddingMatrix(dtype=dtype),
+        'time_index': TimeIndex(),
+    }
+
+
+def _shard_insert(memories, embeddings):
+    _shard['embeddings'].extend(embeddings)
+    _shard['memories'].extend(memories)
+    _shard['time_index'].add_timestamps([d['timestamp'] for d in memories])
+    return len(_shard['memories'])
+
+
+def _shard_search(query_embedding, k, epoch_range):
+    """Top-k of this shard as (scores, memories, number of searchable memories)"""
+    rows = None if epoch_range is None else _shard['time_index'].range(*epoch_range)
+    if len(_shard['memories']) == 0 or (rows is not None and len(rows) == 0):
+        return [], [], 0
+    top, scores = _shard['embeddings'].search(query_embedding, k, rows=rows)
+    total = len(_shard['memories']) if rows is None else len(rows)
+    return scores.tolist(), [_shard['memories'][i] for i in top], total
+
+
+def _shard_dump():
+    return _shard['memories'], _shard['embeddings'].vectors.astype(np.float32)
+
+
+class ShardedArchivalMemory(ArchivalMemory):
+    """Archival memory partitioned into shards, each held (and searched) by its own worker process
+
+    Searches fan out to every shard in parallel and the per-shard top-k lists are merged,
+    so a large archive is scanned on all cores while the agent's event loop only waits on the results.
+    Inserts are embedded once (batched) in the main process and routed to a shard by a hash of their content.
+    """
+
+    def __init__(self, archival_memory_database=None, embeddings=None, n_shards=None, embedding_model=DEFAULT_EMBEDDING_MODEL, embedding_dtype='float32'):
+        self.n_shards = n_shards or os.cpu_count() or 1
+        self.embedding_model = embedding_model
+        self.embedding_dtype = embedding_dtype
+        self._start_workers()
+
+        archival_memory_database = [] if archival_memory_database is None else archival_memory_database
+        if embeddings is None and any('embedding' not in memory for memory in archival_memory_database):
+            raise ValueError('All preloaded archival memories need an embedding')
+        if embeddings is None:
+            embeddings = [memory['embedding'] for memory in archival_memory_database]
+        self._route([without_embedding(memory) for memory in archival_memory_database], embeddings)
+
+    def _start_workers(self):
+        # spawn: forking a process that runs an event loop (and holds sqlite / http connections) isn't safe
+        context = multiprocessing.get_context('spawn')
+        # one single-process pool per shard, so a shard's state always lives in the same process
+        self._executors = [
+            ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_shard_init, initargs=(self.embedding_dtype,))
+            for _ in range(self.n_shards)
+        ]
+        self._shard_sizes = [0] * self.n_shards
+
+    def _shard_of(self, memory_string):
+        return zlib.crc32(memory_string.encode('utf-8')) % self.n_shards
+
+    def _route(self, memories, embeddings):
+        """Send memories (+ their embeddings) to their shards, blocks until every shard has them"""
+        if len(memories) == 0:
+            return
+        embeddings = normalize_embeddings(embeddings)
+        shard_ids = np.array([self._shard_of(memory['content']) for memory in memories])
+        futures = {}
+        for shard_id in np.unique(shard_ids):
+            rows = np.flatnonzero(shard_ids == shard_id)
+            futures[shard_id] = self._executors[shard_id].submit(_shard_insert, [memories[i] for i in rows], embeddings[rows])
+        for shard_id, future in futures.items():
+            self._shard_sizes[shard_id] = future.result()
+
+    def __len__(self):
+        return sum(self._shard_sizes)
+
+    def __repr__(self) -> str:
+        return \
+            f"\n### ARCHIVAL MEMORY ###" + \
+            f"\n{len(self)} memories stored across {self.n_shards} shards"
+
+    def __getstate__(self):
+        # gather the shards back, the worker processes themselves can't be pickled
+        memories, embeddings = [], []
+        for executor in self._executors:
+            shard_memories, shard_embeddings = executor.submit(_shard_dump).result()
+            memories.extend(shard_memories)
+            embeddings.append(shard_embeddings)
+        state = {key: value for key, value in self.__dict__.items() if key not in ['_executors', '_shard_sizes']}
+        state['_memories'] = memories
+        state['_embeddings'] = np.concatenate(embeddings) if memories else None
+        return state
+
+    def __setstate__(self, state):
+        memories, embeddings = state.pop('_memories'), state.pop('_embeddings')
+        self.__dict__.update(state)
+        self._start_workers()
+        if memories:
+            self._route(memories, embeddings)
+
+    def close(self):
+        for executor in self._executors:
+            executor.shutdown()
+
+    async def _run_on_shards(self, shard_ids, fn, *args_per_shard):
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[
+            loop.run_in_executor(self._executors[shard_id], fn, *args)
+            for shard_id, args in zip(shard_ids, zip(*args_per_shard))
+        ])
+
+    async def insert(self, memory_string, embedding=None):
+        await self.insert_many([memory_string], embeddings=None if embedding is None else [embedding])
+
+    async def insert_many(self, memory_strings, embeddings=None):
+        if len(memory_strings) == 0:
+            return
+        if embeddings is None:
+            embeddings = await async_get_embeddings(memory_strings, model=self.embedding_model)
+        embeddings = normalize_embeddings(embeddings)
+        timestamp = get_local_time()
+        memories = [{'timestamp': timestamp, 'content': memory_string} for memory_string in memory_strings]
+
+        shard_ids = np.array([self._shard_of(memory_string) for memory_string in memory_strings])
+        targets = np.unique(shard_ids).tolist()
+        rows = [np.flatnonzero(shard_ids == shard_id) for shard_id in targets]
+        sizes = await self._run_on_shards(
+            targets, _shard_insert,
+            [[memories[i] for i in shard_rows] for shard_rows in rows],
+            [embeddings[shard_rows] for shard_rows in rows],
+        )
+        for shard_id, size in zip(targets, sizes):
+            self._shard_sizes[shard_id] = size
+
+    async def search(self, query_string, count=None, start=None, start_date=None, end_date=None):
+        """Scatter the query embedding to every shard, gather each shard's top-k, merge into the global top-k"""
+        start = 0 if start is None else start
+        epoch_range = None if start_date is None and end_date is None else date_range_to_epochs(start_date, end_date)
+        if len(self) == 0:
+            return [], 0
+
+        query_embedding = normalize_embeddings(await async_get_embedding(query_string, model=self.embedding_model))
+        # a shard can't hold more than start+count of the global top start+count
+        k = None if count is None else start + count
+        results = await self._run_on_shards(
+            range(self.n_shards), _shard_search,
+            [query_embedding] * self.n_shards, [k] * self.n_shards, [epoch_range] * self.n_shards,
+        )
+        # per-shard results are sorted already, so merging them is a k-way merge
+        merged = heapq.merge(*[zip(scores, memories) for scores, memories, _ in results], key=lambda pair: -pair[0])
+        ranked = [memory for _, memory in itertools.islice(merged, k)]
+        total = sum(shard_total for _, _, shard_total in results)
+        matches = ranked[start:]
+        printd(f"archive_memory.search (sharded, {self.n_shards} shards): search for query '{query_string}' returned the following results (limit 5):\n{[d['content'] for d in matches[:5]]}")
+        return matches, total
+
+
+class SQLiteArchivalMemory(ArchivalMemory):
+    """Archival memory in the archival table of an agent's sqlite database (see SQLiteStore), searched with FTS5"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.call(self.store.count_archival)
+
+    def __repr__(self) -> str:
+        archive = self.store.call(self.store.all_archival)
+        if len(archive) == 0:
+            memory_str = "<empty>"
         else:
-            return matches, len(matches)
+            memory_str = "\n".join([d['content'] for d in archive])
+        return \
+            f"\n### ARCHIVAL MEMORY ###" + \
+            f"\n{memory_str}"
+
+    async def insert(self, memory_string, embedding=None):
+        await self.insert_many([memory_string], None if embedding is None else [embedding])
+
+    async def insert_many(self, memory_strings, embeddings=None):
+        if embeddings is not None:
+            raise ValueError('SQLite archival memory does not support embeddings')
+        timestamp = get_local_time()
+        await self.store.run(self.store.insert_archival, [{'timestamp': timestamp, 'content': memory_string} for memory_string in memory_strings])
+
+    async def search(self, query_string, count=None, start=None, start_date=None, end_date=None):
+        return await self.store.run(self.store.search_archival, query_string, count, start, start_date, end_date)
 
 
 class RecallMemory(ABC):
@@ -336,6 +1274,18 @@ class RecallMemory(ABC):
     def date_search(self, query_string, count=None, start=None):
         pass
 
+    def state_generation(self):
+        """Changes whenever the saved state does, messages are only ever added (see InMemoryStateManager.save)"""
+        return len(self)
+
+    def append_only_state(self):
+        """The parts of the pickled state that are only ever appended to, see ArchivalMemory.append_only_state"""
+        return {}
+
+    def close(self):
+        """Stop any background work (eg. embedding new messages), the memory isn't used anymore"""
+        pass
+
     @abstractmethod
     def __repr__(self) -> str:
         pass
@@ -351,12 +1301,197 @@ class DummyRecallMemory(RecallMemory):
     effectively allowing it to 'remember' prior engagements with a user.
     """
 
+    # messages with these roles are never returned by searches
+    UNSEARCHABLE_ROLES = ['system', 'function']
+    # memory budget of the ranked results kept for paging (see text_search)
+    RESULTS_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
     def __init__(self, message_database=None, restrict_search_to_summaries=False):
         self._message_logs = [] if message_database is None else message_database  # consists of full message dicts
 
-        # If true, the pool of messages that can be queried are the automated summaries only
-        # (generated when the conversation window needs to be shortened)
+        # If true, searches are hierarchical: first the automated summaries (generated when the conversation window
+        # needs to be shortened) are searched, then only the messages covered by the matching summaries
+        # (and the ones no summary covers yet), so the cost depends on the number of summaries and the size of
+        # the matching spans rather than on the length of the history
         self.restrict_search_to_summaries = restrict_search_to_summaries
+        # (position of a summary message, start, end) of the [start, end) span of the log it summarizes, see add_summary
+        self._summaries = []
+
+        self._init_search_index()
+
+    def _init_search_index(self):
+        # positions in self._message_logs, by role, so searches only ever look at searchable messages
+        self._role_positions = {}
+        # trigram of the lowercased content -> positions (ascending) of the searchable messages containing it
+        self._trigram_postings = {}
+        # epoch timestamps of the searchable messages, for date searches
+        self._date_index = TimeIndex()
+        # (mode, query, ...) -> ranked result positions, so later pages of a search don't rerun it
+        self._results_cache = LRUCache(max_bytes=self.RESULTS_CACHE_MAX_BYTES)
+        # self._message_logs[:self._n_indexed] are indexed
+        self._n_indexed = 0
+        # trigram of the lowercased content of a summary -> indices (ascending) in self._summaries of the summaries containing it
+        self._summary_postings = {}
+        # self._summaries[:self._n_summaries_indexed] are indexed
+        self._n_summaries_indexed = 0
+
+    def index_new_messages(self):
+        """Index messages appended to the message log since the last call (the log is append-only)"""
+        if '_trigram_postings' not in self.__dict__:
+            # pickled without the index (see __getstate__), or before it existed
+            self._init_search_index()
+        for position in range(self._n_indexed, len(self._message_logs)):
+            message = self._message_logs[position]['message']
+            role = message['role']
+            if role not in self._role_positions:
+                self._role_positions[role] = array('i')
+            self._role_positions[role].append(position)
+            if role in self.UNSEARCHABLE_ROLES:
+                continue
+            self._date_index.add([timestamp_to_epoch(self._message_logs[position]['timestamp'])], positions=[position])
+            if message['content'] is not None:
+                for trigram in trigrams(message['content'].lower()):
+                    if trigram not in self._trigram_postings:
+                        self._trigram_postings[trigram] = array('i')
+                    self._trigram_postings[trigram].append(position)
+        self._n_indexed = len(self._message_logs)
+
+    def _searchable_positions(self):
+        """Positions (ascending) of all messages with a searchable role"""
+        self.index_new_messages()
+        views = [np.frombuffer(positions, dtype=np.int32) for role, positions in self._role_positions.items() if role not in self.UNSEARCHABLE_ROLES]
+        if len(views) == 0:
+            return np.empty(0, dtype=np.int32)
+        return views[0] if len(views) == 1 else np.sort(np.concatenate(views))
+
+    @staticmethod
+    def _intersect_postings(postings, query_trigrams):
+        """The entries (ascending) in the postings of every one of the query trigrams"""
+        if any(trigram not in postings for trigram in query_trigrams):
+            return np.empty(0, dtype=np.int32)
+        # intersect the rarest postings first, so the intermediate results stay small
+        lists = sorted((np.frombuffer(postings[trigram], dtype=np.int32) for trigram in query_trigrams), key=len)
+        candidates = lists[0]
+        for entries in lists[1:]:
+            if len(candidates) == 0:
+                break
+            candidates = np.intersect1d(candidates, entries, assume_unique=True)
+        return candidates
+
+    def _substring_candidates(self, query_lower):
+        """Positions (ascending) of the searchable messages that could contain query_lower: the ones with all its trigrams"""
+        query_trigrams = trigrams(query_lower)
+        if len(query_trigrams) == 0:
+            # too short to have trigrams, every searchable message is a candidate
+            return self._searchable_positions()
+        self.index_new_messages()
+        return self._intersect_postings(self._trigram_postings, query_trigrams)
+
+    def positions_of(self, messages):
+        """Positions in the log of recently logged messages (the dicts under 'message'), scanning back from the end"""
+        wanted = {id(message) for message in messages}
+        positions = []
+        for position in range(len(self._message_logs) - 1, -1, -1):
+            if len(positions) == len(wanted):
+                break
+            if id(self._message_logs[position]['message']) in wanted:
+                positions.append(position)
+        return positions[::-1]
+
+    def add_summary(self, summary_position, span_start, span_end):
+        """Link the summary message at summary_position to the span [span_start, span_end) of the log it summarizes"""
+        if '_summaries' not in self.__dict__:
+            # pickled before summaries were tracked
+            self._summaries = []
+        self._summaries.append((summary_position, span_start, span_end))
+
+    def _index_new_summaries(self):
+        """Index the summaries added since the last call (their messages are in the log by then)"""
+        if '_summary_postings' not in self.__dict__:
+            # pickled before summaries had their own index
+            self._summary_postings, self._n_summaries_indexed = {}, 0
+        for i in range(self._n_summaries_indexed, len(self._summaries)):
+            content = self._message_logs[self._summaries[i][0]]['message']['content']
+            for trigram in trigrams((content or '').lower()):
+                if trigram not in self._summary_postings:
+                    self._summary_postings[trigram] = array('i')
+                self._summary_postings[trigram].append(i)
+        self._n_summaries_indexed = len(self._summaries)
+
+    def _matching_summaries(self, query_lower):
+        """The summaries containing query_lower, found through their own trigram index (independent of the history length)"""
+        self._index_new_summaries()
+        query_trigrams = trigrams(query_lower)
+        candidates = self._intersect_postings(self._summary_postings, query_trigrams) if query_trigrams else range(len(self._summaries))
+        matching = []
+        for i in candidates:
+            content = self._message_logs[self._summaries[i][0]]['message']['content']
+            if content is not None and query_lower in content.lower():
+                matching.append(self._summaries[i])
+        return matching
+
+    def _hierarchical_candidates(self, query_lower):
+        """Positions (ascending) a hierarchical search checks: the messages in the spans of the matching summaries
+        (and the summaries themselves), plus the ones no summary covers yet
+        """
+        scopes = self._search_scopes(self._matching_summaries(query_lower))
+        n_scoped = sum(end - start for start, end in scopes)
+        query_trigrams = trigrams(query_lower)
+        if query_trigrams:
+            self.index_new_messages()
+            if any(trigram not in self._trigram_postings for trigram in query_trigrams):
+                return np.empty(0, dtype=np.int32)
+            rarest = min((self._trigram_postings[trigram] for trigram in query_trigrams), key=len)
+            if len(rarest) < n_scoped:
+                # fewer messages have the query's rarest trigram than the scopes hold, those are cheaper to filter
+                return self._positions_in_scopes(np.frombuffer(rarest, dtype=np.int32), scopes)
+        return np.array([
+            position for start, end in scopes for position in range(start, end)
+            if self._message_logs[position]['message']['role'] not in self.UNSEARCHABLE_ROLES
+        ], dtype=np.int32)
+
+    def _search_scopes(self, matching_summaries):
+        """Sorted, disjoint [start, end) ranges of the log a hierarchical search drills into:
+        the matching summaries and their spans, plus everything no summary covers
+        """
+        covered = sorted((start, end) for _, start, end in self._summaries)
+        uncovered, position = [], 0
+        for start, end in covered:
+            if start > position:
+                uncovered.append((position, start))
+            position = max(position, end)
+        uncovered.append((position, len(self._message_logs)))
+        scopes = []
+        matching_spans = [(start, end) for _, start, end in matching_summaries] + [(position, position + 1) for position, _, _ in matching_summaries]
+        for start, end in sorted(matching_spans + uncovered):
+            if scopes and start <= scopes[-1][1]:
+                scopes[-1] = (scopes[-1][0], max(scopes[-1][1], end))
+            elif end > start:
+                scopes.append((start, end))
+        return scopes
+
+    @staticmethod
+    def _positions_in_scopes(positions, scopes):
+        """The positions (ascending) that fall inside one of the scopes (see _search_scopes)"""
+        if len(scopes) == 0:
+            return np.empty(0, dtype=np.int32)
+        starts, ends = np.array(scopes, dtype=np.int64).T
+        scope = np.searchsorted(starts, positions, side='right') - 1
+        return positions[(scope >= 0) & (positions < ends[np.maximum(scope, 0)])]
+
+    def __getstate__(self):
+        # the search index is rebuilt on the first search after loading, instead of bloating the pickle
+        state = self.__dict__.copy()
+        if state.get('message_log_is_journaled'):
+            # the persistence manager restores the log from its journal
+            state.pop('_message_logs')
+        for key in ['_role_positions', '_trigram_postings', '_date_index', '_results_cache', '_n_indexed', '_summary_postings', '_n_summaries_indexed']:
+            state.pop(key, None)
+        return state
+
+    def append_only_state(self):
+        # the message log is restored from the persistence manager's journal (or pickled with it)
+        return {'_summaries': self._summaries} if '_summaries' in self.__dict__ else {}
 
     def __len__(self):
         return len(self._message_logs)
@@ -390,114 +1525,267 @@ class DummyRecallMemory(RecallMemory):
     async def insert(self, message):
         raise NotImplementedError('This should be handled by the PersistenceManager, recall memory is just a search layer on top')
 
-    async def text_search(self, query_string, count=None, start=None):
-        # in the dummy version, run an (inefficient) case-insensitive match search
-        message_pool = [d for d in self._message_logs if d['message']['role'] not in ['system', 'function']]
+    def _results_generation(self):
+        # cached results are dropped as soon as a new message is logged
+        return len(self._message_logs)
 
-        printd(f"recall_memory.text_search: searching for {query_string} (c={count}, s={start}) in {len(self._message_logs)} total messages")
-        matches = [d for d in message_pool if d['message']['content'] is not None and query_string.lower() in d['message']['content'].lower()]
-        printd(f"recall_memory - matches:\n{matches[start:start+count]}")
+    def state_generation(self):
+        # the search index (and embeddings) only grow with the log
+        return self._results_generation()
 
-        # start/count support paging through results
-        if start is not None and count is not None:
-            return matches[start:start+count], len(matches)
-        elif start is None and count is not None:
-            return matches[:count], len(matches)
-        elif start is not None and count is None:
-            return matches[start:], len(matches)
+    def _matching_positions(self, query_string):
+        """Positions (ascending) of the searchable messages containing query_string (case-insensitive)"""
+        query_lower = query_string.lower()
+        if self.restrict_search_to_summaries and self.__dict__.get('_summaries'):
+            # summaries first, then only the spans of the ones that match
+            candidates = self._hierarchical_candidates(query_lower)
         else:
-            return matches, len(matches)
+            # only messages containing every trigram of the query get checked
+            candidates = self._substring_candidates(query_lower)
 
-    def _validate_date_format(self, date_str):
-        """Validate the given date string in the format 'YYYY-MM-DD'."""
-        try:
-            datetime.datetime.strptime(date_str, '%Y-%m-%d')
-            return True
-        except ValueError:
-            return False
+        printd(f"recall_memory.text_search: searching for {query_string} in {len(candidates)} of {len(self._message_logs)} total messages")
+        return np.array([
+            i for i in candidates
+            if self._message_logs[i]['message']['content'] is not None and query_lower in self._message_logs[i]['message']['content'].lower()
+        ], dtype=np.int32)
 
-    def _extract_date_from_timestamp(self, timestamp):
-        """Extracts and returns the date from the given timestamp."""
-        # Extracts the date (ignoring the time and timezone)
-        match = re.match(r"(\d{4}-\d{2}-\d{2})", timestamp)
-        return match.group(1) if match else None
+    async def text_search(self, query_string, count=None, start=None):
+        # paging through the results of a query only runs the search once (until new messages arrive)
+        self.index_new_messages()
+        cache_key = ('text', query_string, self.restrict_search_to_summaries)
+        positions = self._results_cache.get(cache_key, generation=self._results_generation())
+        if positions is None:
+            positions = self._matching_positions(query_string)
+            self._results_cache.put(cache_key, positions, nbytes=positions.nbytes + len(query_string), generation=self._results_generation())
+
+        # start/count support paging through results
+        start = start or 0
+        page = positions[start:] if count is None else positions[start:start+count]
+        matches = [self._message_logs[i] for i in page]
+        printd(f"recall_memory - matches:\n{matches}")
+        return matches, len(positions)
 
     async def date_search(self, start_date, end_date, count=None, start=None):
-        message_pool = [d for d in self._message_logs if d['message']['role'] not in ['system', 'function']]
+        # validates the dates, and covers the whole end_date day (the time of day is ignored)
+        start_epoch, end_epoch = date_range_to_epochs(start_date, end_date)
 
-        # First, validate the start_date and end_date format
-        if not self._validate_date_format(start_date) or not self._validate_date_format(end_date):
-            raise ValueError("Invalid date format. Expected format: YYYY-MM-DD")
+        # binary search in the date index, only the requested page of matches gets looked up
+        self.index_new_messages()
+        positions, total = self._date_index.page(start_epoch, end_epoch, start=start, count=count)
+        return [self._message_logs[i] for i in positions], total
 
-        # Convert dates to datetime objects for comparison
-        start_date_dt = datetime.datetime.strptime(start_date, '%Y-%m-%d')
-        end_date_dt = datetime.datetime.strptime(end_date, '%Y-%m-%d')
 
-        # Next, match items inside self._message_logs
-        matches = [
-            d for d in message_pool
-            if start_date_dt <= datetime.datetime.strptime(self._extract_date_from_timestamp(d['timestamp']), '%Y-%m-%d') <= end_date_dt
-        ]
+class DummyRecallMemoryWithEmbeddings(DummyRecallMemory):
+    """Same as dummy recall memory, but searched by embedding similarity
 
-        # start/count support paging through results
-        if start is not None and count is not None:
-            return matches[start:start+count], len(matches)
-        elif start is None and count is not None:
-            return matches[:count], len(matches)
-        elif start is not None and count is None:
-            return matches[start:], len(matches)
-        else:
-            return matches, len(matches)
+    Each searchable message gets its own row in an EmbeddingMatrix (so duplicate texts don't collide),
+    and row i is the embedding of self._message_logs[self._row_positions[i]].
+    New messages are queued for embedding as they are appended, and embedded in batches by a background task,
+    so searches only have to embed the query. Messages that aren't embedded yet are left out of search results.
 
+    Embeddings are stored normalized and (optionally) compressed, see quantize_embeddings.
+    """
 
-class DummyRecallMemoryWithEmbeddings(DummyRecallMemory):
-    """Lazily manage embeddings by keeping a string->embed dict"""
+    # recall memories pickled before compression was supported
+    embedding_dtype = 'float32'
+    # messages embedded per request by the background task
+    EMBEDDING_BATCH_SIZE = 64
+    # how many of the summaries most similar to the query a hierarchical search drills into
+    SUMMARY_SEARCH_TOP_K = 3
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, embedding_model=DEFAULT_EMBEDDING_MODEL, embedding_dtype='float32', **kwargs):
         super().__init__(*args, **kwargs)
-        self.embeddings = dict()
-        self.embedding_model = 'text-embedding-ada-002'
+        self.embedding_model = embedding_model
+        self.embedding_dtype = embedding_dtype
         self.only_use_preloaded_embeddings = False
+        self._init_embeddings()
+
+    def _init_embeddings(self):
+        self._embeddings = EmbeddingMatrix(dtype=self.embedding_dtype)
+        # row -> position in self._message_logs
+        self._row_positions = array('i')
+        # positions of the messages waiting for the background task, ascending
+        self._pending_positions = deque()
+        # self._message_logs[:self._n_queued] have been embedded, queued or skipped
+        self._n_queued = 0
+        self._embedding_task = None
+
+    def index_new_messages(self):
+        super().index_new_messages()
+        if self.only_use_preloaded_embeddings:
+            return
+        for position in range(self._n_queued, len(self._message_logs)):
+            message = self._message_logs[position]['message']
+            if message['role'] not in self.UNSEARCHABLE_ROLES and message['content'] is not None:
+                self._pending_positions.append(position)
+        self._n_queued = len(self._message_logs)
+        self._start_embedding_task()
+
+    def _start_embedding_task(self):
+        if not self._pending_positions:
+            return
+        task = self.__dict__.get('_embedding_task')
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # appended outside of the event loop, the next search starts the task
+            return
+        if task is not None and not task.done() and task.get_loop() is loop:
+            return
+        self._embedding_task = loop.create_task(self._embed_pending())
+
+    async def _embed_pending(self):
+        while self._pending_positions:
+            positions = list(itertools.islice(self._pending_positions, self.EMBEDDING_BATCH_SIZE))
+            message_strs = [self._message_logs[position]['message']['content'] for position in positions]
+            # repeated messages (eg. "hi") only get embedded once
+            unique_strs = list(dict.fromkeys(message_strs))
+            try:
+                embeddings = await async_get_embeddings(unique_strs, model=self.embedding_model)
+            except Exception as e:
+                # the batch stays queued, and is retried on the next append or search
+                printd(f"recall_memory: embedding {len(positions)} messages failed, will retry: {e}")
+                return
+            embeddings = dict(zip(unique_strs, embeddings))
+            self._embeddings.extend(np.array([embeddings[message_str] for message_str in message_strs]))
+            self._row_positions.extend(positions)
+            for _ in positions:
+                self._pending_positions.popleft()
+            printd(f"recall_memory: embedded {len(positions)} messages, {len(self._pending_positions)} still queued")
+
+    async def wait_for_embeddings(self):
+        """Block until every message appended so far is embedded (or embedding failed)"""
+        self.index_new_messages()
+        task = self.__dict__.get('_embedding_task')
+        if task is not None and not task.done():
+            await task
+
+    def close(self):
+        # a batch is only dequeued once it's embedded, so nothing is lost: the queue is pickled, and embedded after loading
+        task = self.__dict__.get('_embedding_task')
+        if task is not None and not task.done():
+            task.cancel()
+        self._embedding_task = None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        # the queue is kept, so pending messages are embedded after loading
+        state.pop('_embedding_task', None)
+        return state
+
+    def append_only_state(self):
+        sequences = super().append_only_state()
+        if '_embeddings' in self.__dict__:
+            sequences.update(_embeddings=self._embeddings, _row_positions=self._row_positions)
+        return sequences
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'embeddings' in state:
+            # pickled with a message string -> embedding dict, move the embeddings into a matrix
+            embeddings = self.__dict__.pop('embeddings')
+            self._init_embeddings()
+            rows = []
+            for position, d in enumerate(self._message_logs):
+                message_str = d['message']['content']
+                if d['message']['role'] in self.UNSEARCHABLE_ROLES or message_str is None:
+                    continue
+                if message_str in embeddings:
+                    rows.append(self._decompress_embedding(embeddings[message_str]))
+                    self._row_positions.append(position)
+                elif not self.only_use_preloaded_embeddings:
+                    self._pending_positions.append(position)
+            self._embeddings.extend(np.array(rows, dtype=np.float32))
+            self._n_queued = len(self._message_logs)
+
+    @staticmethod
+    def _decompress_embedding(embedding):
+        if isinstance(embedding, tuple):
+            data, scale = embedding
+            return dequantize_embeddings(data) if scale is None else dequantize_embeddings(data[None], np.array([scale]))[0]
+        # raw list of floats (preloaded, or pickled before compression was supported)
+        return normalize_embeddings(embedding)
+
+    def _results_generation(self):
+        # the background task embedding more messages changes the results too
+        return (len(self._message_logs), len(self._embeddings))
 
     async def text_search(self, query_string, count=None, start=None):
-        # in the dummy version, run an (inefficient) case-insensitive match search
-        message_pool = [d for d in self._message_logs if d['message']['role'] not in ['system', 'function']]
-
-        # first, go through and make sure we have all the embeddings we need
-        message_pool_filtered = []
-        for d in message_pool:
-            message_str = d['message']['content']
-            if self.only_use_preloaded_embeddings:
-                if message_str not in self.embeddings:
-                    printd(f"recall_memory.text_search -- '{message_str}' was not in embedding dict, skipping.")
-                else:
-                    message_pool_filtered.append(d)
-            elif message_str not in self.embeddings:
-                printd(f"recall_memory.text_search -- '{message_str}' was not in embedding dict, computing now")
-                self.embeddings[message_str] = await async_get_embedding_with_backoff(message_str, model=self.embedding_model)
-                message_pool_filtered.append(d)
-
-       # our wrapped version supports backoff/rate-limits
-        query_embedding = await async_get_embedding_with_backoff(query_string, model=self.embedding_model)
-        similarity_scores = [cosine_similarity(self.embeddings[d['message']['content']], query_embedding) for d in message_pool_filtered]
-
-        # Sort the archive based on similarity scores
-        sorted_archive_with_scores = sorted(
-            zip(message_pool_filtered, similarity_scores),
-            key=lambda pair: pair[1],  # Sort by the similarity score
-            reverse=True  # We want the highest similarity first
-        )
-        printd(f"recall_memory.text_search (vector-based): search for query '{query_string}' returned the following results (limit 5) and scores:\n{str([str(t[0]['message']['content']) + '- score ' + str(t[1]) for t in sorted_archive_with_scores[:5]])}")
+        # score every searchable message that is already embedded (this also queues and starts embedding new ones)
+        self.index_new_messages()
+        if self._pending_positions:
+            printd(f"recall_memory.text_search -- {len(self._pending_positions)} messages are not embedded yet, skipping them")
+
+        # only the rows up to the requested page need to be ranked, a later page deepens the cached ranking
+        start = start or 0
+        needed = None if count is None else start + count
+        cache_key = ('embedding', query_string, self.restrict_search_to_summaries)
+        cached = self._results_cache.get(cache_key, generation=self._results_generation())
+        if cached is None or (len(cached[0]) < cached[1] and (needed is None or len(cached[0]) < needed)):
+           # our wrapped version supports backoff/rate-limits
+            query_embedding = await async_get_embedding(query_string, model=self.embedding_model)
+            searched_rows = None
+            if self.restrict_search_to_summaries and self.__dict__.get('_summaries'):
+                searched_rows = self._rows_under_matching_summaries(query_embedding)
+            total = len(self._embeddings) if searched_rows is None else len(searched_rows)
+            depth = needed if cached is None or needed is None else max(needed, 2 * len(cached[0]))
+            rows, scores = self._embeddings.search(query_embedding, k=depth, rows=searched_rows)
+            positions = np.frombuffer(self._row_positions, dtype=np.int32)[rows]
+            printd(f"recall_memory.text_search (vector-based): search for query '{query_string}' returned the following results (limit 5) and scores:\n{str([str(self._message_logs[i]['message']['content']) + '- score ' + str(score) for i, score in zip(positions[:5], scores[:5])])}")
+            cached = (positions, total)
+            self._results_cache.put(cache_key, cached, nbytes=positions.nbytes + len(query_string), generation=self._results_generation())
+        positions, total = cached
+
+        # start/count support paging through results, every searched message is a (ranked) match
+        page = positions[start:] if count is None else positions[start:start+count]
+        return [self._message_logs[i] for i in page], total
+
+    def _rows_under_matching_summaries(self, query_embedding):
+        """Rows (ascending) in the spans of the summaries most similar to the query, plus the rows no summary covers"""
+        row_positions = np.frombuffer(self._row_positions, dtype=np.int32)
+        # summaries that aren't embedded yet can't be matched
+        summary_positions = np.array([summary[0] for summary in self._summaries])
+        summary_rows = np.minimum(np.searchsorted(row_positions, summary_positions), max(len(row_positions) - 1, 0))
+        embedded = np.flatnonzero(row_positions[summary_rows] == summary_positions) if len(row_positions) else []
+        matching_summaries = []
+        if len(embedded):
+            best = top_k_indices(self._embeddings.scores(query_embedding, summary_rows[embedded]), self.SUMMARY_SEARCH_TOP_K)
+            matching_summaries = [self._summaries[i] for i in np.asarray(embedded)[best]]
+        # rows are in position order, so each scope is a contiguous run of rows
+        bounds = np.searchsorted(row_positions, np.array(self._search_scopes(matching_summaries), dtype=np.int64).reshape(-1, 2))
+        return np.concatenate([np.arange(lo, hi) for lo, hi in bounds] + [np.empty(0, dtype=np.int64)])
+
+
+class SQLiteRecallMemory(RecallMemory):
+    """Recall memory over the messages table of an agent's sqlite database (see SQLiteStore)
+
+    Messages are logged by SQLiteStateManager, text search uses an FTS5 trigram index and date search an index on the timestamps.
+    """
 
-        # Extract the sorted archive without the scores
-        matches = [item[0] for item in sorted_archive_with_scores]
+    def __init__(self, store):
+        self.store = store
+        # hierarchical search isn't supported, the flag is kept so callers can set it on any recall memory
+        self.restrict_search_to_summaries = False
 
-        # start/count support paging through results
-        if start is not None and count is not None:
-            return matches[start:start+count], len(matches)
-        elif start is None and count is not None:
-            return matches[:count], len(matches)
-        elif start is not None and count is None:
-            return matches[start:], len(matches)
-        else:
-            return matches, len(matches)
+    def __len__(self):
+        return self.store.call(self.store.count_messages)
+
+    def __repr__(self) -> str:
+        role_counts = self.store.call(self.store.role_counts)
+        known_roles = ['system', 'user', 'assistant', 'function']
+        memory_str = f"Statistics:" + \
+                     f"\n{sum(role_counts.values())} total messages" + \
+                     "".join([f"\n{role_counts.get(role, 0)} {role}" for role in known_roles]) + \
+                     f"\n{sum(n for role, n in role_counts.items() if role not in known_roles)} other"
+        return \
+            f"\n### RECALL MEMORY ###" + \
+            f"\n{memory_str}"
+
+    async def insert(self, message):
+        raise NotImplementedError('This should be handled by the PersistenceManager, recall memory is just a search layer on top')
+
+    async def text_search(self, query_string, count=None, start=None):
+        return await self.store.run(self.store.search_messages, query_string, count, start)
+
+    async def date_search(self, start_date, end_date, count=None, start=None):
+        return await self.store.run(self.store.search_messages_by_date, start_date, end_date, count, start)
@@ -3,7 +3,10 @@ import random
 import os
 import time
 
+import numpy as np
+
 from .local_llm.chat_completion_proxy import get_chat_completion
+from .embedding_cache import get_embeddings_cached
 
 HOST = os.getenv("OPENAI_API_BASE")
 HOST_TYPE = os.getenv("BACKEND_TYPE")  # default None == ChatCompletion
@@ -133,8 +136,32 @@ async def acreate_embedding_with_backoff(**kwargs):
 
 async def async_get_embedding_with_backoff(text, model="text-embedding-ada-002"):
     """To get text embeddings, import/call this function
-    It specifies defaults + handles rate-limiting + is async"""
-    text = text.replace("\n", " ")
-    response = await acreate_embedding_with_backoff(input=[text], model=model)
-    embedding = response["data"][0]["embedding"]
-    return embedding
+    It specifies defaults + handles rate-limiting + is async (and cached, see async_get_embeddings_with_backoff)"""
+    return (await async_get_embeddings_with_backoff([text], model=model))[0]
+
+
+async def async_get_embeddings_with_backoff(texts, model="text-embedding-ada-002", batch_size=256, concurrency=4):
+    """Batched version of async_get_embedding_with_backoff
+    Sends `batch_size` texts per request, with at most `concurrency` requests in flight,
+    and returns the embeddings in the same order as `texts`
+    Texts in the embedding cache (see embedding_cache.py) aren't sent again, and each distinct text is only sent once"""
+    embeddings = await get_embeddings_cached(
+        model, texts, lambda missing: request_embeddings(missing, model=model, batch_size=batch_size, concurrency=concurrency)
+    )
+    # cached embeddings come back as float32 arrays, the API's as lists of floats
+    return [embedding.tolist() if isinstance(embedding, np.ndarray) else embedding for embedding in embeddings]
+
+
+async def request_embeddings(texts, model="text-embedding-ada-002", batch_size=256, concurrency=4):
+    """Embeddings of texts from the API, without the cache (see async_get_embeddings_with_backoff)"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def embed_batch(batch):
+        async with semaphore:
+            response = await acreate_embedding_with_backoff(input=[text.replace("\n", " ") for text in batch], model=model)
+        # the API doesn't guarantee the order of the returned embeddings
+        return [d["embedding"] for d in sorted(response["data"], key=lambda d: d["index"])]
+
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = await asyncio.gather(*[embed_batch(batch) for batch in batches])
+    return [embedding for batch_embeddings in results for embedding in batch_embeddings]
@@ -1,8 +1,61 @@
 from abc import ABC, abstractmethod
+from functools import partial
+import io
+import os
 import pickle
 
-from .memory import DummyRecallMemory, DummyRecallMemoryWithEmbeddings, DummyArchivalMemory, DummyArchivalMemoryWithEmbeddings, DummyArchivalMemoryWithFaiss
-from .utils import get_local_time, printd
+from .memory import DummyRecallMemory, DummyRecallMemoryWithEmbeddings, DummyArchivalMemory, DummyArchivalMemoryWithEmbeddings, DummyArchivalMemoryWithFaiss, DummyArchivalMemoryHybrid, MmapArchivalMemory, ShardedArchivalMemory, \
+    SQLiteRecallMemory, SQLiteArchivalMemory, CoreMemory
+from .utils import get_local_time, printd, faiss_index_vectors
+from .embeddings import DEFAULT_EMBEDDING_MODEL
+from .sqlite_store import SQLiteStore
+from .journal import MessageJournal
+from .checkpoint_store import CheckpointStore
+from .faiss_store import FaissIndexStore
+
+
+class _PartPickler(pickle.Pickler):
+    """Pickles a memory part, with the sequences it only appends to (see append_only_state) in chunks of the checkpoint store
+
+    saved_chunks maps the id of a sequence to (the sequence, the store, its chunks) as of the last save or load,
+    so only what was appended since then gets written.
+    """
+
+    def __init__(self, file, store, part, saved_chunks):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.store = store
+        self.sequences = {id(sequence): name for name, sequence in part.append_only_state().items()}
+        self.saved_chunks = saved_chunks
+        # keys of the chunks the pickle refers to
+        self.chunk_keys = []
+
+    def persistent_id(self, obj):
+        if id(obj) not in self.sequences:
+            return None
+        saved = self.saved_chunks.get(id(obj))
+        chunks = saved[2] if saved is not None and saved[0] is obj and saved[1] == self.store.path else []
+        chunks = self.store.put_chunks(obj, chunks)
+        self.saved_chunks[id(obj)] = (obj, self.store.path, chunks)
+        self.chunk_keys.extend(key for key, _ in chunks)
+        return ('chunks', self.sequences[id(obj)], chunks)
+
+
+class _PartUnpickler(pickle.Unpickler):
+    """Loads a memory part pickled by _PartPickler"""
+
+    def __init__(self, file, store, saved_chunks):
+        super().__init__(file)
+        self.store = store
+        self.saved_chunks = saved_chunks
+        self.loaded = {}
+
+    def persistent_load(self, pid):
+        _, name, chunks = pid
+        if name not in self.loaded:
+            sequence = self.store.get_chunks(chunks)
+            self.saved_chunks[id(sequence)] = (sequence, self.store.path, chunks)
+            self.loaded[name] = sequence
+        return self.loaded[name]
 
 
 class PersistenceManager(ABC):
@@ -27,18 +80,46 @@ class PersistenceManager(ABC):
     def update_memory(self, new_memory):
         pass
 
+    def link_messages(self, messages):
+        """Share the agent's in-context message list, the agent updates it in place after each of the calls above"""
+        self.messages = messages
+
+    def close(self):
+        """Release the files the manager keeps open, once it's replaced (eg. by loading a saved state)"""
+        pass
+
+    def recover(self):
+        """Crash recovery, right after loading the latest checkpoint: bring back the changes made after it that weren't saved
+
+        Returns the number of recovered operations, nothing is recorded by default.
+        """
+        return 0
+
+    def configure_recall(self, **options):
+        """Set recall memory search options of this run (eg. restrict_search_to_summaries), they aren't restored by load"""
+        for key, value in options.items():
+            setattr(self.recall_memory, key, value)
+
 
 class InMemoryStateManager(PersistenceManager):
-    """In-memory state manager has nothing to manage, all agents are held in-memory"""
+    """In-memory state manager has nothing to manage, all agents are held in-memory
+
+    self.messages is the agent's own list of in-context messages (see link_messages), the message calls
+    only record the changes to it (in the recall log and the journal).
+    """
 
     recall_memory_cls = DummyRecallMemory
     archival_memory_cls = DummyArchivalMemory
+    # saved to the checkpoint store next to the pickle, and loaded on first use after resuming (see save)
+    lazy_parts = ['recall_memory', 'archival_memory']
 
     def __init__(self):
         # Memory held in-state useful for debugging stateful versions
         self.memory = None
         self.messages = []
         self.all_messages = []
+        # started by the first save (see save)
+        self.journal = None
 
     @staticmethod
     def load(filename):
@@ -46,13 +127,171 @@ class InMemoryStateManager(PersistenceManager):
             return pickle.load(f)
 
     def save(self, filename):
+        """Pickle the state, with the messages recorded in an append-only journal next to the first save
+
+        Every later message operation is appended to the journal as it happens, so saving doesn't rewrite the history.
+        Recall and archival memory are pickled to the checkpoint store (see CheckpointStore), and only again once their
+        state_generation changed, so resuming only has to read the core memory and the context window: the recall log,
+        recall memory and archival memory are loaded when they're first used. What they only append to (archival
+        memories, embeddings, summaries) is stored in chunks, so pickling them again only writes what was added since.
+        """
+        if self.__dict__.get('journal') is None:
+            positions = {id(d['message']): position for position, d in enumerate(self.all_messages)}
+            context_ids = [positions[id(msg)] for msg in self.messages]
+            self.journal = MessageJournal.create(os.path.splitext(filename)[0] + '.journal', self.all_messages, context_ids)
+            # recall memory searches the same list, it gets it back from the journal too
+            self.recall_memory.message_log_is_journaled = True
+        self.journal_seq = self.journal.checkpoint()
+        store = CheckpointStore.next_to(filename)
+        part_files = dict(self.__dict__.get('_part_files', {}))
+        part_generations = dict(self.__dict__.get('_part_generations', {}))
+        for name in self.lazy_parts:
+            elsewhere = name in part_files and os.path.dirname(os.path.dirname(part_files[name])) != store.path
+            if elsewhere:
+                # in the store of another directory, it's copied to this one
+                getattr(self, name)
+            # a part that wasn't loaded since resuming, or didn't change since the last save, keeps pointing at the file it's in
+            if name in self.__dict__:
+                generation = self.__dict__[name].state_generation()
+                if name not in part_files or part_generations.get(name) != generation or elsewhere:
+                    part_files[name] = store.file(self._save_part(store, name))
+                    part_generations[name] = generation
+        self._part_files = part_files
+        self._part_generations = part_generations
         with open(filename, 'wb') as fh:
             pickle.dump(self, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        # the parts (and their chunks) are kept for as long as this checkpoint is
+        store.pin(filename, [store.key_of(part_file) for part_file in part_files.values()])
+        store.collect_garbage()
+
+    def _save_part(self, store, name):
+        """Pickle a part to the store, returns its key"""
+        data = io.BytesIO()
+        pickler = _PartPickler(data, store, self.__dict__[name], self.__dict__.setdefault('_saved_chunks', {}))
+        pickler.dump(self.__dict__[name])
+        return store.put_bytes(data.getvalue(), children=pickler.chunk_keys)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_loaders', None)
+        state.pop('_recall_options', None)
+        state.pop('_journal_path', None)
+        state.pop('_saved_chunks', None)
+        if state.get('journal') is not None:
+            # the messages are in the journal, the pickle only records where and how far into it this save is
+            state['journal'] = self.journal.path
+            state.pop('messages', None)
+            state.pop('all_messages', None)
+        for name in state.get('_part_files', {}):
+            state.pop(name, None)
+        if '_part_files' in state:
+            # the archival memory's database, it's saved with it
+            state.pop('archival_memory_db', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._loaders = {name: partial(self._load_part, name, part_file) for name, part_file in state.get('_part_files', {}).items()}
+        if isinstance(state.get('journal'), str):
+            self._journal_path = state['journal']
+            self.journal = MessageJournal(state['journal'])
+            # exactly as saved, anything logged after the save is only brought back by recover
+            context, context_ids, n_messages, seq = self.journal.load_context(self.journal_seq)
+            self.messages = [d['message'] for d in context]
+            self._loaders['all_messages'] = partial(self._load_message_log, self.journal, n_messages, context_ids)
+            if seq != self.journal.seq:
+                # changes made from here on go to a new journal, started by the next save
+                self.journal.close()
+                self.journal = None
+            if 'recall_memory' in state:
+                # pickled along with the state (before it had its own file)
+                self.recall_memory._message_logs = self.all_messages
+        elif self.__dict__.get('messages') and 'timestamp' in self.messages[0]:
+            # pickled before the window was shared with the agent, when it held timestamped copies
+            self.messages = [d['message'] for d in self.messages]
+
+    def __getattr__(self, name):
+        # only called for attributes that aren't set, ie. the parts of a resumed state that weren't used yet
+        loaders = self.__dict__.get('_loaders')
+        if not loaders or name not in loaders:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        printd(f"InMemoryStateManager loading {name}")
+        value = loaders.pop(name)()
+        self.__dict__[name] = value
+        return value
+
+    def _load_part(self, name, part_file):
+        store = CheckpointStore(os.path.dirname(os.path.dirname(part_file)))
+        with open(part_file, 'rb') as fh:
+            part = _PartUnpickler(fh, store, self.__dict__.setdefault('_saved_chunks', {})).load()
+        if getattr(part, 'message_log_is_journaled', False):
+            part._message_logs = self.all_messages
+        if name == 'recall_memory':
+            for key, value in self.__dict__.get('_recall_options', {}).items():
+                setattr(part, key, value)
+        return part
+
+    def recover(self):
+        # operations logged after the last save of the journal (the process ended before saving again) belong to this
+        # checkpoint if it's that save, their messages go into the shared window in place
+        if self.__dict__.get('journal') is not None or self.__dict__.get('_journal_path') is None:
+            return 0
+        journal = MessageJournal(self._journal_path)
+        if journal.saved_seq != self.journal_seq:
+            # an older checkpoint, what was logged after it was saved in later ones
+            journal.close()
+            return 0
+        context, context_ids, n_messages, seq = journal.load_context()
+        printd(f"InMemoryStateManager.recover: replaying {seq - self.journal_seq} operations logged after checkpoint {self.journal_seq}")
+        self.journal = journal
+        self.messages[:] = [d['message'] for d in context]
+        if 'all_messages' in self.__dict__:
+            self.all_messages[:] = self._load_message_log(journal, n_messages, context_ids)
+        else:
+            self._loaders['all_messages'] = partial(self._load_message_log, journal, n_messages, context_ids)
+        return seq - self.journal_seq
+
+    def _load_message_log(self, journal, n_messages, context_ids):
+        """The recall log, read from the journal on first use"""
+        if journal is self.__dict__.get('journal'):
+            # still being logged to, so it has the messages logged after resuming too
+            n_messages, context_ids = journal.n_messages, journal.context_ids
+        all_messages = journal.read_history(n_messages)
+        assert len(context_ids) == len(self.messages), f"{len(context_ids)} context ids for {len(self.messages)} messages"
+        # the log holds the agent's in-context message objects (recall memory finds them by identity)
+        for position, message in zip(context_ids, self.messages):
+            all_messages[position]['message'] = message
+        return all_messages
+
+    def _message_log_loaded(self):
+        # otherwise the log is read from the journal on first use, and it has the new messages by then
+        return 'all_messages' in self.__dict__ or self.__dict__.get('journal') is None
+
+    def link_messages(self, messages):
+        own = self.__dict__.get('messages')
+        if own is not None and own is not messages and own == messages:
+            # a restored agent has equal copies of the messages, it takes the ones in the recall log (they're found by identity)
+            messages[:] = own
+        self.messages = messages
+
+    def configure_recall(self, **options):
+        # a recall memory that wasn't loaded since resuming gets them when it's loaded (see _load_part)
+        self._recall_options = options
+        if 'recall_memory' in self.__dict__ or 'recall_memory' not in self.__dict__.get('_loaders', {}):
+            super().configure_recall(**options)
+
+    def close(self):
+        if self.__dict__.get('journal') is not None:
+            self.journal.close()
+        # parts that weren't loaded since resuming have nothing running
+        for name in self.lazy_parts:
+            if name in self.__dict__:
+                self.__dict__[name].close()
 
     def init(self, agent):
         printd(f"Initializing InMemoryStateManager with agent object")
         self.all_messages = [{'timestamp': get_local_time(), 'message': msg} for msg in agent.messages.copy()]
-        self.messages = [{'timestamp': get_local_time(), 'message': msg} for msg in agent.messages.copy()]
+        self.link_messages(agent.messages)
         self.memory = agent.memory
         printd(f"InMemoryStateManager.all_messages.len = {len(self.all_messages)}")
         printd(f"InMemoryStateManager.messages.len = {len(self.messages)}")
@@ -64,31 +303,50 @@ class InMemoryStateManager(PersistenceManager):
 
     def trim_messages(self, num):
         # printd(f"InMemoryStateManager.trim_messages")
-        self.messages = [self.messages[0]] + self.messages[num:]
+        # the trimmed messages get summarized, and the summary is prepended next (see prepend_to_messages)
+        positions = self.recall_memory.positions_of(self.messages[1:num])
+        self.summarized_span = (positions[0], positions[-1] + 1) if positions else None
+        if self.__dict__.get('journal') is not None:
+            self.journal.log_trim(num)
 
     def prepend_to_messages(self, added_messages):
         # first tag with timestamps
         added_messages = [{'timestamp': get_local_time(), 'message': msg} for msg in added_messages]
 
         printd(f"InMemoryStateManager.prepend_to_message")
-        self.messages = [self.messages[0]] + added_messages + self.messages[1:]
-        self.all_messages.extend(added_messages)
+        if self._message_log_loaded():
+            self.all_messages.extend(added_messages)
+            self.recall_memory.index_new_messages()
+        if self.__dict__.get('journal') is not None:
+            self.journal.log_prepend(added_messages)
+
+        # link the summary to the messages it replaced, for hierarchical recall search
+        if getattr(self, 'summarized_span', None) is not None:
+            for position in range(len(self.all_messages) - len(added_messages), len(self.all_messages)):
+                self.recall_memory.add_summary(position, *self.summarized_span)
+            self.summarized_span = None
 
     def append_to_messages(self, added_messages):
         # first tag with timestamps
         added_messages = [{'timestamp': get_local_time(), 'message': msg} for msg in added_messages]
 
         printd(f"InMemoryStateManager.append_to_messages")
-        self.messages = self.messages + added_messages
-        self.all_messages.extend(added_messages)
+        if self._message_log_loaded():
+            self.all_messages.extend(added_messages)
+            self.recall_memory.index_new_messages()
+        if self.__dict__.get('journal') is not None:
+            self.journal.log_append(added_messages)
 
     def swap_system_message(self, new_system_message):
         # first tag with timestamps
         new_system_message = {'timestamp': get_local_time(), 'message': new_system_message}
 
         printd(f"InMemoryStateManager.swap_system_message")
-        self.messages[0] = new_system_message
-        self.all_messages.append(new_system_message)
+        if self._message_log_loaded():
+            self.all_messages.append(new_system_message)
+            self.recall_memory.index_new_messages()
+        if self.__dict__.get('journal') is not None:
+            self.journal.log_swap(new_system_message)
 
     def update_memory(self, new_memory):
         printd(f"InMemoryStateManager.update_memory")
@@ -105,7 +363,7 @@ class InMemoryStateManagerWithPreloadedArchivalMemory(InMemoryStateManager):
     def init(self, agent):
         print(f"Initializing InMemoryStateManager with agent object")
         self.all_messages = [{'timestamp': get_local_time(), 'message': msg} for msg in agent.messages.copy()]
-        self.messages = [{'timestamp': get_local_time(), 'message': msg} for msg in agent.messages.copy()]
+        self.link_messages(agent.messages)
         self.memory = agent.memory
         print(f"InMemoryStateManager.all_messages.len = {len(self.all_messages)}")
         print(f"InMemoryStateManager.messages.len = {len(self.messages)}")
@@ -117,28 +375,273 @@ class InMemoryStateManagerWithEmbeddings(InMemoryStateManager):
     archival_memory_cls = DummyArchivalMemoryWithEmbeddings
     recall_memory_cls = DummyRecallMemoryWithEmbeddings
 
+    def __init__(self, hybrid_search=False, embedding_dtype='float32', rescore_path=None, embedding_model=DEFAULT_EMBEDDING_MODEL):
+        super().__init__()
+        # see memgpt/embeddings.py, local models avoid an API call per insert / search
+        self.embedding_model = embedding_model
+        # if True, archival search fuses embedding search with keyword (BM25) search
+        self.hybrid_search = hybrid_search
+        # 'float16' or 'int8' keep archival + recall embeddings compressed in memory,
+        # rescore_path (optional) keeps exact float32 copies on disk to rescore the top archival candidates
+        self.embedding_dtype = embedding_dtype
+        self.rescore_path = rescore_path
+
+    def init(self, agent):
+        printd(f"Initializing InMemoryStateManagerWithEmbeddings with agent object")
+        self.all_messages = [{'timestamp': get_local_time(), 'message': msg} for msg in agent.messages.copy()]
+        self.link_messages(agent.messages)
+        self.memory = agent.memory
+        printd(f"InMemoryStateManagerWithEmbeddings.all_messages.len = {len(self.all_messages)}")
+        printd(f"InMemoryStateManagerWithEmbeddings.messages.len = {len(self.messages)}")
+
+        # Persistence manager also handles DB-related state
+        self.recall_memory = self.recall_memory_cls(message_database=self.all_messages, embedding_model=self.embedding_model, embedding_dtype=self.embedding_dtype)
+        self.archival_memory_db = []
+        self.archival_memory = self.archival_memory_cls(archival_memory_database=self.archival_memory_db, embedding_model=self.embedding_model, embedding_dtype=self.embedding_dtype, rescore_path=self.rescore_path)
+        if self.hybrid_search:
+            self.archival_memory = DummyArchivalMemoryHybrid(self.archival_memory)
+
 
 class InMemoryStateManagerWithFaiss(InMemoryStateManager):
     archival_memory_cls = DummyArchivalMemoryWithFaiss
     recall_memory_cls = DummyRecallMemoryWithEmbeddings
 
-    def __init__(self, archival_index, archival_memory_db, a_k=100):
+    def __init__(self, archival_index, archival_memory_db, a_k=100, a_similarity_threshold=None, hybrid_search=False, embedding_dtype='float32', embedding_model=DEFAULT_EMBEDDING_MODEL):
         super().__init__()
+        # has to be the model the archival index was built with
+        self.embedding_model = embedding_model
         self.archival_index = archival_index
         self.archival_memory_db = archival_memory_db
         self.a_k = a_k
+        self.a_similarity_threshold = a_similarity_threshold
+        # if True, archival search fuses FAISS search with keyword (BM25) search
+        self.hybrid_search = hybrid_search
+        # recall embeddings storage, archival compression is chosen via the index type (e.g. sq-fp16, sq8, ivf-pq)
+        self.embedding_dtype = embedding_dtype
+        # directory the archival index is checkpointed to, next to the first save, and the generation last saved there
+        self.archival_store_path = None
+        self.archival_store_generation = None
 
-    def save(self, _filename):
-        raise NotImplementedError
+    def save(self, filename):
+        """Pickle the state, with archival memory checkpointed to its own store directory
+
+        The store is shared by all later saves, which only write the archival memories inserted since the previous one.
+        Each save pins its generation of the store to the pickle, and the generations of checkpoints that were deleted
+        since get deleted from the store.
+        """
+        if self.__dict__.get('archival_store_path') is None:
+            self.archival_store_path = os.path.splitext(filename)[0] + '.archival'
+        # not loaded since resuming means nothing was inserted since the last checkpoint
+        if 'archival_memory' in self.__dict__:
+            vector_memory = getattr(self.archival_memory, 'vector_memory', self.archival_memory)
+            self.archival_store_generation = vector_memory.checkpoint(self.archival_store_path)
+        super().save(filename)
+        if self.__dict__.get('archival_store_generation') is not None:
+            store = FaissIndexStore(self.archival_store_path)
+            store.pin(filename, self.archival_store_generation)
+            store.collect_garbage(keep=[self.archival_store_generation])
 
     def init(self, agent):
         print(f"Initializing InMemoryStateManager with agent object")
         self.all_messages = [{'timestamp': get_local_time(), 'message': msg} for msg in agent.messages.copy()]
-        self.messages = [{'timestamp': get_local_time(), 'message': msg} for msg in agent.messages.copy()]
+        self.link_messages(agent.messages)
         self.memory = agent.memory
         print(f"InMemoryStateManager.all_messages.len = {len(self.all_messages)}")
         print(f"InMemoryStateManager.messages.len = {len(self.messages)}")
 
         # Persistence manager also handles DB-related state
-        self.recall_memory = self.recall_memory_cls(message_database=self.all_messages)
-        self.archival_memory = self.archival_memory_cls(index=self.archival_index, archival_memory_database=self.archival_memory_db, k=self.a_k)
+        self.recall_memory = self.recall_memory_cls(message_database=self.all_messages, embedding_model=self.embedding_model, embedding_dtype=self.embedding_dtype)
+        self.archival_memory = self.archival_memory_cls(index=self.archival_index, archival_memory_database=self.archival_memory_db, embedding_model=self.embedding_model, k=self.a_k, similarity_threshold=self.a_similarity_threshold)
+        if self.hybrid_search:
+            self.archival_memory = DummyArchivalMemoryHybrid(self.archival_memory)
+        # archival memory owns the index and database from here on (and saves them to its store, not the pickle)
+        self.archival_index = None
+        self.archival_memory_db = None
+
+
+class InMemoryStateManagerWithMmap(InMemoryStateManager):
+    """Archival memory lives in a memory-mapped directory instead of the pickle
+
+    Saving/loading the state manager only records the archive's path, so resuming
+    doesn't scale with the size of archival memory.
+    """
+    archival_memory_cls = MmapArchivalMemory
+    recall_memory_cls = DummyRecallMemoryWithEmbeddings
+
+    def __init__(self, archival_memory_path, embedding_dtype='float32', embedding_model=DEFAULT_EMBEDDING_MODEL):
+        super().__init__()
+        self.archival_memory_path = archival_memory_path
+        # only used for a new archive, an existing one keeps the model it was created with
+        self.embedding_model = embedding_model
+        # recall embeddings storage, archival embeddings are on disk already
+        self.embedding_dtype = embedding_dtype
+
+    def init(self, agent):
+        printd(f"Initializing InMemoryStateManagerWithMmap with agent object")
+        self.all_messages = [{'timestamp': get_local_time(), 'message': msg} for msg in agent.messages.copy()]
+        self.link_messages(agent.messages)
+        self.memory = agent.memory
+        printd(f"InMemoryStateManagerWithMmap.all_messages.len = {len(self.all_messages)}")
+        printd(f"InMemoryStateManagerWithMmap.messages.len = {len(self.messages)}")
+
+        # Persistence manager also handles DB-related state
+        self.recall_memory = self.recall_memory_cls(message_database=self.all_messages, embedding_model=self.embedding_model, embedding_dtype=self.embedding_dtype)
+        self.archival_memory = self.archival_memory_cls(self.archival_memory_path, embedding_model=self.embedding_model)
+
+
+class InMemoryStateManagerWithShards(InMemoryStateManager):
+    """Archival memory is split across worker processes (see ShardedArchivalMemory)
+
+    A preloaded FAISS index only serves as the source of the embeddings, the shards search them directly.
+    """
+    archival_memory_cls = ShardedArchivalMemory
+    recall_memory_cls = DummyRecallMemoryWithEmbeddings
+
+    def __init__(self, archival_index=None, archival_memory_db=None, n_shards=None, embedding_dtype='float32', embedding_model=DEFAULT_EMBEDDING_MODEL):
+        super().__init__()
+        self.archival_index = archival_index
+        self.archival_memory_db = [] if archival_memory_db is None else archival_memory_db
+        self.n_shards = n_shards
+        self.embedding_dtype = embedding_dtype
+        self.embedding_model = embedding_model
+
+    def init(self, agent):
+        printd(f"Initializing InMemoryStateManagerWithShards with agent object")
+        self.all_messages = [{'timestamp': get_local_time(), 'message': msg} for msg in agent.messages.copy()]
+        self.link_messages(agent.messages)
+        self.memory = agent.memory
+        printd(f"InMemoryStateManagerWithShards.all_messages.len = {len(self.all_messages)}")
+        printd(f"InMemoryStateManagerWithShards.messages.len = {len(self.messages)}")
+
+        # Persistence manager also handles DB-related state
+        self.recall_memory = self.recall_memory_cls(message_database=self.all_messages, embedding_model=self.embedding_model, embedding_dtype=self.embedding_dtype)
+        embeddings = None if self.archival_index is None else faiss_index_vectors(self.archival_index)
+        self.archival_memory = self.archival_memory_cls(
+            archival_memory_database=self.archival_memory_db,
+            embeddings=embeddings,
+            n_shards=self.n_shards,
+            embedding_model=self.embedding_model,
+            embedding_dtype=self.embedding_dtype,
+        )
+        # the shards hold everything now (and FAISS indexes can't be pickled on save)
+        self.archival_index = None
+        self.archival_memory_db = None
+
+
+class SQLiteStateManager(PersistenceManager):
+    """State lives in a sqlite database (see SQLiteStore) instead of in memory
+
+    Every change is written to the database as it happens (one indexed insert per message), on a background thread,
+    so saving only records the database path, the ids of the context window and the core memory version, and neither
+    saving nor memory use grows with the length of the history.
+    """
+    recall_memory_cls = SQLiteRecallMemory
+    archival_memory_cls = SQLiteArchivalMemory
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.memory = None
+        # the agent's in-context messages (see link_messages)
+        self.messages = []
+        # ids (positions in the recall log) of self.messages
+        self.message_ids = []
+        # id of the core memory version in self.memory
+        self.memory_version = None
+        self._open()
+
+    def _open(self):
+        self.store = SQLiteStore(self.db_path)
+        self.recall_memory = self.recall_memory_cls(self.store)
+        self.archival_memory = self.archival_memory_cls(self.store)
+        # the next message and core memory version ids
+        self.n_messages = self.store.call(self.store.count_messages)
+        self.n_memory_versions = self.store.call(self.store.count_memory_versions)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    def close(self):
+        self.store.close()
+
+    def save(self, filename):
+        self.store.flush()
+        with open(filename, 'wb') as fh:
+            pickle.dump(self, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def __getstate__(self):
+        # everything is in the database already, the checkpoint is which of it was current
+        return {'db_path': self.db_path, 'message_ids': list(self.message_ids), 'memory_version': self.memory_version}
+
+    def __setstate__(self, state):
+        self.memory_version = None
+        self.__dict__.update(state)
+        self._open()
+        if 'message_ids' in state:
+            context = self.store.call(self.store.get_messages, self.message_ids)
+            # later changes (eg. after loading an older checkpoint) continue from this window
+            self.store.submit(self.store.set_context, list(self.message_ids))
+        else:
+            # pickled before checkpoints recorded their window, the latest one
+            self.message_ids, context = self.store.call(self.store.get_context)
+        self.messages = [d['message'] for d in context]
+        memory = self.store.call(self.store.get_memory, self.memory_version)
+        self.memory = None if memory is None else CoreMemory.load(memory)
+
+    def link_messages(self, messages):
+        assert len(messages) == len(self.message_ids), f"{len(messages)} messages for {len(self.message_ids)} message ids"
+        super().link_messages(messages)
+
+    def _log(self, added_messages):
+        """Tag messages with timestamps and ids, and queue them for the recall log (with the current context window)"""
+        # the agent strips the raw API response off its messages after this call, it isn't stored either
+        added_messages = [
+            {'timestamp': get_local_time(), 'message': {key: value for key, value in msg.items() if key not in ['api_response', 'api_args']}}
+            for msg in added_messages
+        ]
+        added_ids = list(range(self.n_messages, self.n_messages + len(added_messages)))
+        self.n_messages += len(added_messages)
+        return added_messages, added_ids
+
+    def init(self, agent):
+        printd(f"Initializing SQLiteStateManager with agent object")
+        added_messages, self.message_ids = self._log(agent.messages)
+        self.store.submit(self.store.append_messages, self.message_ids[0], added_messages, list(self.message_ids))
+        self.link_messages(agent.messages)
+        self.update_memory(agent.memory)
+        printd(f"SQLiteStateManager.n_messages = {self.n_messages}")
+        printd(f"SQLiteStateManager.messages.len = {len(self.messages)}")
+
+    def trim_messages(self, num):
+        del self.message_ids[1:num]
+        self.store.submit(self.store.set_context, list(self.message_ids))
+
+    def prepend_to_messages(self, added_messages):
+        if len(added_messages) == 0:
+            return
+        added_messages, added_ids = self._log(added_messages)
+        printd(f"SQLiteStateManager.prepend_to_message")
+        self.message_ids[1:1] = added_ids
+        self.store.submit(self.store.append_messages, added_ids[0], added_messages, list(self.message_ids))
+
+    def append_to_messages(self, added_messages):
+        if len(added_messages) == 0:
+            return
+        added_messages, added_ids = self._log(added_messages)
+        printd(f"SQLiteStateManager.append_to_messages")
+        self.message_ids.extend(added_ids)
+        self.store.submit(self.store.append_messages, added_ids[0], added_messages, list(self.message_ids))
+
+    def swap_system_message(self, new_system_message):
+        (new_system_message,), (new_id,) = self._log([new_system_message])
+        printd(f"SQLiteStateManager.swap_system_message")
+        self.message_ids[0] = new_id
+        self.store.submit(self.store.append_messages, new_id, [new_system_message], list(self.message_ids))
+
+    def update_memory(self, new_memory):
+        printd(f"SQLiteStateManager.update_memory")
+        self.memory = new_memory
+        self.memory_version = self.n_memory_versions
+        self.n_memory_versions += 1
+        self.store.submit(self.store.add_memory_version, self.memory_version, new_memory.to_dict())
@@ -4,30 +4,57 @@ from tqdm import tqdm
 import numpy as np
 import argparse
 import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../../../"))
+from memgpt.utils import FAISS_INDEX_TYPES, make_faiss_index, train_faiss_index, add_to_faiss_index
+
+
+def read_embedding_file(embedding_file):
+    with open(embedding_file, 'rt', encoding='utf-8') as file:
+        embeddings = []
+        for line in tqdm(file):
+            # Parse each JSON line
+            data = json.loads(line)
+            embeddings.append(data)
+    return np.array(embeddings).astype('float32')
+
 
 def build_index(embedding_files: str,
-                index_name: str):
+                index_name: str,
+                index_type: str = 'flat',
+                nlist: int = None,
+                pq_m: int = 64,
+                hnsw_m: int = 32,
+                train_sample_size: int = 100000):
 
-    index = faiss.IndexFlatL2(1536)
     file_list = sorted(glob(embedding_files))
 
+    # IVF indexes are trained on a sample taken from the first embedding files
+    train_sample = []
+    n_sampled = 0
+    for embedding_file in file_list:
+        if n_sampled >= train_sample_size:
+            break
+        data = read_embedding_file(embedding_file)
+        train_sample.append(data[:train_sample_size - n_sampled])
+        n_sampled += len(train_sample[-1])
+    train_sample = np.concatenate(train_sample)
+
+    index = make_faiss_index(train_sample.shape[1], index_type, n_vectors=n_sampled, nlist=nlist, pq_m=pq_m, hnsw_m=hnsw_m)
+    train_faiss_index(index, train_sample, train_sample_size)
+    del train_sample
+
     for embedding_file in file_list:
         print(embedding_file)
-        with open(embedding_file, 'rt', encoding='utf-8') as file:
-            embeddings = []
-            l = 0
-            for line in tqdm(file):
-                # Parse each JSON line
-                data = json.loads(line)
-                embeddings.append(data)
-                l += 1
-            data = np.array(embeddings).astype('float32')
-            print(data.shape)
-            try:
-                index.add(data)
-            except Exception as e:
-                print(data)
-                raise e
+        data = read_embedding_file(embedding_file)
+        print(data.shape)
+        try:
+            add_to_faiss_index(index, data)
+        except Exception as e:
+            print(data)
+            raise e
 
     faiss.write_index(index, index_name)
 
@@ -37,9 +64,19 @@ if __name__ ==  '__main__':
 
     parser.add_argument('--embedding_files', type=str, help='embedding_filepaths glob expression')
     parser.add_argument('--output_index_file', type=str, help='output filepath')
-    args = parser.parse_args()    
+    parser.add_argument('--index_type', type=str, default='flat', choices=FAISS_INDEX_TYPES, help='type of FAISS index to build')
+    parser.add_argument('--nlist', type=int, default=None, help='number of IVF cells (default: ~4*sqrt(#training vectors))')
+    parser.add_argument('--pq_m', type=int, default=64, help='number of PQ sub-quantizers (ivf-pq only, must divide the embedding dimension)')
+    parser.add_argument('--hnsw_m', type=int, default=32, help='number of neighbors per HNSW graph node (hnsw only)')
+    parser.add_argument('--train_sample_size', type=int, default=100000, help='number of embeddings to train IVF indexes on')
+    args = parser.parse_args()
 
     build_index(
         embedding_files=args.embedding_files,
-        index_name=args.output_index_file
-    )
\ No newline at end of file
+        index_name=args.output_index_file,
+        index_type=args.index_type,
+        nlist=args.nlist,
+        pq_m=args.pq_m,
+        hnsw_m=args.hnsw_m,
+        train_sample_size=args.train_sample_size,
+    )
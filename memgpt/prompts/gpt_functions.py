@@ -245,6 +245,14 @@ FUNCTIONS_CHAINING = {
                     "type": "string",
                     "description": "String to search for.",
                 },
+                "start_date": {
+                    "type": "string",
+                    "description": "Optional: only search memories saved on or after this date, in the format 'YYYY-MM-DD'.",
+                },
+                "end_date": {
+                    "type": "string",
+                    "description": "Optional: only search memories saved on or before this date, in the format 'YYYY-MM-DD'.",
+                },
                 "page": {
                     "type": "integer",
                     "description": "Allows you to page through results. Only use on a follow-up query. Defaults to 0 (first page).",
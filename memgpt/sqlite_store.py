@@ -0,0 +1,251 @@
+"""SQLite storage of an agent's state, used by SQLiteStateManager
+
+One database (in WAL mode) holds the in-context window, the full recall log, every core memory version
+and the archival memories. Appending a message is one indexed insert, so the cost of persisting state
+doesn't grow with the length of the history.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+
+from .utils import get_local_time, printd, timestamp_to_epoch, date_range_to_epochs, tokenize
+
+
+SCHEMA = [
+    # the recall log, id is the position of the message in the log
+    "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, timestamp TEXT, epoch REAL, role TEXT, content TEXT, message TEXT)",
+    "CREATE INDEX IF NOT EXISTS messages_epoch ON messages (epoch, id)",
+    # the in-context messages, in order (slot 0 is the system message)
+    "CREATE TABLE IF NOT EXISTS context (slot INTEGER PRIMARY KEY, message_id INTEGER)",
+    # every version of core memory, the last one is current
+    "CREATE TABLE IF NOT EXISTS memory_versions (id INTEGER PRIMARY KEY, timestamp TEXT, memory TEXT)",
+    "CREATE TABLE IF NOT EXISTS archival (id INTEGER PRIMARY KEY, timestamp TEXT, epoch REAL, content TEXT)",
+    "CREATE INDEX IF NOT EXISTS archival_epoch ON archival (epoch, id)",
+]
+
+# full-text indexes, kept in sync with their tables by triggers (rows are never updated or deleted)
+FTS5_SCHEMA = [
+    # trigrams support case-insensitive substring queries, like the in-memory recall search
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (content, content='messages', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages WHEN new.content IS NOT NULL BEGIN "
+    "INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content); END",
+    # words, ranked with bm25, like the in-memory archival search
+    "CREATE VIRTUAL TABLE IF NOT EXISTS archival_fts USING fts5 (content, content='archival', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS archival_fts_insert AFTER INSERT ON archival BEGIN "
+    "INSERT INTO archival_fts (rowid, content) VALUES (new.id, new.content); END",
+]
+
+# messages with these roles are never returned by recall searches
+UNSEARCHABLE_ROLES = ("system", "function")
+
+
+def _fts5_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+class SQLiteStore(object):
+    """An agent's state in a sqlite database
+
+    Every statement runs on one worker thread, in submission order: writes made from the synchronous
+    persistence manager calls are queued there without blocking (submit), and searches await their result
+    from the event loop (run), so a search always sees the writes made before it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memgpt-sqlite")
+        self._conn = None
+        self.has_fts5 = False
+        # the first failed background write, raised by the next flush
+        self._error = None
+        self.call(self._connect)
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            self._conn.execute(statement)
+        try:
+            for statement in FTS5_SCHEMA:
+                self._conn.execute(statement)
+            self.has_fts5 = True
+        except sqlite3.OperationalError as e:
+            # sqlite built without FTS5 (or older than 3.34, without the trigram tokenizer), searches scan instead
+            print(f"SQLite full-text search isn't available, recall/archival searches will scan the database: {e}")
+
+    # running statements on the worker thread
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) on the worker thread without waiting for it"""
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._report_error)
+        return future
+
+    def _report_error(self, future):
+        if future.exception() is not None:
+            print(f"SQLite persistence failed: {future.exception()}")
+            if self._error is None:
+                self._error = future.exception()
+
+    def call(self, fn, *args):
+        """fn(*args) on the worker thread, blocking until it's done"""
+        return self._executor.submit(fn, *args).result()
+
+    async def run(self, fn, *args):
+        """fn(*args) on the worker thread, without blocking the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def flush(self):
+        """Wait until every queued write is done, raises if one of them failed since the last flush"""
+        self.call(lambda: None)
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"SQLite persistence failed, the database is missing changes: {error}") from error
+
+    def close(self):
+        # a failed write was reported when it happened
+        self.call(lambda: None)
+        self.call(self._conn.close)
+        self._executor.shutdown()
+
+    def _transaction(self, statements):
+        self._conn.execute("BEGIN")
+        try:
+            for sql, rows in statements:
+                self._conn.executemany(sql, rows)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    # messages (the recall log) and the context window
+
+    def count_messages(self):
+        return self._conn.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM messages").fetchone()[0]
+
+    def append_messages(self, first_id, messages, context_ids=None):
+        """Log messages ({'timestamp', 'message'} dicts) as ids first_id, first_id + 1, ..., and optionally replace the context window"""
+        rows = [
+            (first_id + i, d["timestamp"], timestamp_to_epoch(d["timestamp"]), d["message"]["role"], d["message"].get("content"), json.dumps(d["message"]))
+            for i, d in enumerate(messages)
+        ]
+        statements = [("INSERT INTO messages (id, timestamp, epoch, role, content, message) VALUES (?, ?, ?, ?, ?, ?)", rows)]
+        if context_ids is not None:
+            statements += self._context_statements(context_ids)
+        self._transaction(statements)
+
+    def set_context(self, context_ids):
+        self._transaction(self._context_statements(context_ids))
+
+    @staticmethod
+    def _context_statements(context_ids):
+        # the window is small (it has to fit in the LLM context), rewriting it is cheap
+        return [("DELETE FROM context", [()]), ("INSERT INTO context (slot, message_id) VALUES (?, ?)", list(enumerate(context_ids)))]
+
+    def get_messages(self, ids):
+        """{'timestamp', 'message'} dicts of the messages with these ids, in the same order"""
+        found = {}
+        for i in range(0, len(ids), 500):
+            batch = ids[i : i + 500]
+            placeholders = ",".join("?" * len(batch))
+            for id, timestamp, message in self._conn.execute(f"SELECT id, timestamp, message FROM messages WHERE id IN ({placeholders})", batch):
+                found[id] = {"timestamp": timestamp, "message": json.loads(message)}
+        return [found[id] for id in ids]
+
+    def get_context(self):
+        """The message ids and messages of the context window"""
+        ids = [row[0] for row in self._conn.execute("SELECT message_id FROM context ORDER BY slot")]
+        return ids, self.get_messages(ids)
+
+    def role_counts(self):
+        return dict(self._conn.execute("SELECT role, COUNT(*) FROM messages GROUP BY role").fetchall())
+
+    def search_messages(self, query_string, count=None, start=None):
+        """Case-insensitive substring search over the searchable messages, in log order, returns (page, total)"""
+        query_lower = query_string.lower()
+        placeholders = ",".join("?" * len(UNSEARCHABLE_ROLES))
+        if self.has_fts5 and len(query_lower) >= 3:
+            # the trigram index narrows it down to the messages containing every trigram of the query
+            rows = self._conn.execute(
+                f"SELECT m.id, m.content FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                f"WHERE messages_fts MATCH ? AND m.role NOT IN ({placeholders}) ORDER BY m.id",
+                (_fts5_phrase(query_lower),) + UNSEARCHABLE_ROLES,
+            )
+        else:
+            rows = self._conn.execute(
+                f"SELECT id, content FROM messages WHERE content IS NOT NULL AND role NOT IN ({placeholders}) ORDER BY id", UNSEARCHABLE_ROLES
+            )
+        # the index folds case a little differently than python, so the matches are checked the same way the in-memory search does
+        ids = [id for id, content in rows if query_lower in content.lower()]
+        start = start or 0
+        page = ids[start:] if count is None else ids[start : start + count]
+        return self.get_messages(page), len(ids)
+
+    def search_messages_by_date(self, start_date, end_date, count=None, start=None):
+        """Searchable messages from start_date through end_date ('YYYY-MM-DD'), in time order, returns (page, total)"""
+        start_epoch, end_epoch = date_range_to_epochs(start_date, end_date)
+        placeholders = ",".join("?" * len(UNSEARCHABLE_ROLES))
+        where = f"epoch >= ? AND epoch < ? AND role NOT IN ({placeholders})"
+        args = (start_epoch, end_epoch) + UNSEARCHABLE_ROLES
+        total = self._conn.execute(f"SELECT COUNT(*) FROM messages WHERE {where}", args).fetchone()[0]
+        rows = self._conn.execute(
+            f"SELECT timestamp, message FROM messages WHERE {where} ORDER BY epoch, id LIMIT ? OFFSET ?",
+            args + (-1 if count is None else count, start or 0),
+        )
+        return [{"timestamp": timestamp, "message": json.loads(message)} for timestamp, message in rows], total
+
+    # core memory
+
+    def count_memory_versions(self):
+        return self._conn.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM memory_versions").fetchone()[0]
+
+    def add_memory_version(self, id, memory):
+        self._conn.execute("INSERT INTO memory_versions (id, timestamp, memory) VALUES (?, ?, ?)", (id, get_local_time(), json.dumps(memory)))
+
+    def get_memory(self, id=None):
+        """Core memory version id (default: the latest) as a CoreMemory.to_dict() dict, None if there is none"""
+        if id is None:
+            row = self._conn.execute("SELECT memory FROM memory_versions ORDER BY id DESC LIMIT 1").fetchone()
+        else:
+            row = self._conn.execute("SELECT memory FROM memory_versions WHERE id = ?", (id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    # archival memory
+
+    def count_archival(self):
+        return self._conn.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM archival").fetchone()[0]
+
+    def insert_archival(self, memories):
+        first_id = self.count_archival()
+        rows = [(first_id + i, d["timestamp"], timestamp_to_epoch(d["timestamp"]), d["content"]) for i, d in enumerate(memories)]
+        self._transaction([("INSERT INTO archival (id, timestamp, epoch, content) VALUES (?, ?, ?, ?)", rows)])
+
+    def all_archival(self):
+        return [{"timestamp": timestamp, "content": content} for timestamp, content in self._conn.execute("SELECT timestamp, content FROM archival ORDER BY id")]
+
+    def search_archival(self, query_string, count=None, start=None, start_date=None, end_date=None):
+        """Word search over archival memory, best (bm25) matches first, returns (page, total)"""
+        where, args = "", ()
+        if start_date is not None or end_date is not None:
+            where, args = " AND a.epoch >= ? AND a.epoch < ?", date_range_to_epochs(start_date, end_date)
+        limit = (-1 if count is None else count, start or 0)
+        query_terms = tokenize(query_string)
+        if self.has_fts5 and len(query_terms) > 0:
+            match = " OR ".join(_fts5_phrase(term) for term in dict.fromkeys(query_terms))
+            source = "archival_fts JOIN archival a ON a.id = archival_fts.rowid WHERE archival_fts MATCH ?"
+            total = self._conn.execute(f"SELECT COUNT(*) FROM {source}{where}", (match,) + args).fetchone()[0]
+            rows = self._conn.execute(f"SELECT a.timestamp, a.content FROM {source}{where} ORDER BY bm25(archival_fts), a.id LIMIT ? OFFSET ?", (match,) + args + limit)
+            matches = [{"timestamp": timestamp, "content": content} for timestamp, content in rows]
+        else:
+            # nothing to look up in the index (eg punctuation only), fall back to a case-insensitive match search
+            rows = self._conn.execute(f"SELECT a.timestamp, a.content FROM archival a WHERE 1{where} ORDER BY a.id", args)
+            matches = [{"timestamp": timestamp, "content": content} for timestamp, content in rows if query_string.lower() in content.lower()]
+            total = len(matches)
+            matches = matches[limit[1] :] if count is None else matches[limit[1] : limit[1] + count]
+        printd(f"archive_memory.search (sqlite): search for query '{query_string}' returned the following results (limit 5):\n{[d['content'] for d in matches[:5]]}")
+        return matches, total
@@ -1,4 +1,8 @@
-from datetime import datetime
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 import asyncio
 import csv
@@ -6,15 +10,17 @@ import difflib
 import demjson3 as demjson
 import numpy as np
 import json
+import math
 import pytz
 import os
+import re
 import faiss
 import tiktoken
 import glob
 import sqlite3
 import fitz
 from tqdm import tqdm
-from memgpt.openai_tools import async_get_embedding_with_backoff
+from memgpt.embeddings import DEFAULT_EMBEDDING_MODEL, get_embedding_provider, async_get_embeddings
 from memgpt.constants import MEMGPT_DIR
 
 
@@ -36,6 +42,256 @@ def cosine_similarity(a, b):
     return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
 
+def normalize_embeddings(embeddings):
+    """L2-normalize a vector (or each row of a matrix) as float32, so dot products are cosine similarities"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+# Storage formats for (normalized) embeddings, see quantize_embeddings
+EMBEDDING_DTYPES = ["float32", "float16", "int8"]
+
+
+def quantize_embeddings(embeddings, dtype="float32"):
+    """Compress a matrix of embeddings for storage, returns (data, scales)
+
+    float16 halves the memory, int8 (symmetric scalar quantization, with one float32 scale per row) quarters it.
+    scales is None unless dtype is int8.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype == "float32":
+        return embeddings, None
+    elif dtype == "float16":
+        return embeddings.astype(np.float16), None
+    elif dtype == "int8":
+        scales = np.abs(embeddings).max(axis=-1) / 127.0
+        scales[scales == 0] = 1.0
+        data = np.round(embeddings / scales[..., None]).astype(np.int8)
+        return data, scales.astype(np.float32)
+    else:
+        raise ValueError(f"Unknown embedding dtype '{dtype}', expected one of {EMBEDDING_DTYPES}")
+
+
+def dequantize_embeddings(data, scales=None):
+    """Inverse of quantize_embeddings, returns float32"""
+    embeddings = np.asarray(data, dtype=np.float32)
+    if scales is not None:
+        embeddings = embeddings * scales[..., None]
+    return embeddings
+
+
+def top_k_indices(scores, k=None):
+    """Indices of the k highest scores, best first
+
+    Uses a partial selection (argpartition) so only the k winners get sorted, not the whole array.
+    """
+    n = len(scores)
+    if k is None or k >= n:
+        return np.argsort(-scores, kind="stable")
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    threshold = scores[np.argpartition(-scores, k - 1)[k - 1]]
+    # ties at the cutoff go to the lowest indices, so the result is always a prefix of the full (stable) sort
+    above = np.flatnonzero(scores > threshold)
+    top = np.concatenate([above, np.flatnonzero(scores == threshold)[: k - len(above)]])
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+class LRUCache(object):
+    """Least-recently-used cache bounded by a byte budget
+
+    Entries can be tagged with a generation (e.g. a version counter of the data they were computed from):
+    a lookup with a different generation counts as a miss and drops the stale entry, so the caller recomputes it.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (generation, value, nbytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, generation=None):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != generation:
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, nbytes, generation=None):
+        if key in self._entries:
+            self._remove(key)
+        if nbytes > self.max_bytes:
+            return
+        self._entries[key] = (generation, value, nbytes)
+        self.current_bytes += nbytes
+        while self.current_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+
+    def _remove(self, key):
+        _, _, nbytes = self._entries.pop(key)
+        self.current_bytes -= nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def tokenize(text):
+    """Lowercased word tokens, used for lexical (BM25) search"""
+    return re.findall(r"\w+", text.lower())
+
+
+def trigrams(text):
+    """Distinct 3-character substrings of text, used for substring search"""
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+TIMESTAMP_REGEX = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})(?:[ T](\d{1,2}):(\d{2})(?::(\d{2}))?(?:\s*([AaPp][Mm]))?)?"
+)
+EPOCH = datetime(1970, 1, 1)
+
+
+def timestamp_to_epoch(timestamp):
+    """Seconds since 1970 of a timestamp's wall-clock time (eg from get_local_time), -inf if it can't be parsed
+
+    The timezone is ignored, so that timestamps compare the same way their dates read (as in date_search).
+    """
+    match = TIMESTAMP_REGEX.match(timestamp or "")
+    if match is None:
+        return float("-inf")
+    year, month, day, hour, minute, second, am_pm = match.groups()
+    hour, minute, second = int(hour or 0), int(minute or 0), int(second or 0)
+    if am_pm is not None:
+        hour = hour % 12 + (12 if am_pm.lower() == "pm" else 0)
+    try:
+        return (datetime(int(year), int(month), int(day), hour, minute, second) - EPOCH).total_seconds()
+    except ValueError:
+        return float("-inf")
+
+
+def date_range_to_epochs(start_date=None, end_date=None):
+    """[start, end) epoch bounds covering the 'YYYY-MM-DD' dates start_date through end_date (either can be None)"""
+    try:
+        start_dt = None if start_date is None else datetime.strptime(start_date, "%Y-%m-%d")
+        end_dt = None if end_date is None else datetime.strptime(end_date, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError("Invalid date format. Expected format: YYYY-MM-DD")
+    # unparsable timestamps are stored as -inf, an open start still excludes them
+    start_epoch = -1e18 if start_dt is None else (start_dt - EPOCH).total_seconds()
+    end_epoch = float("inf") if end_dt is None else (end_dt + timedelta(days=1) - EPOCH).total_seconds()
+    return start_epoch, end_epoch
+
+
+class TimeIndex(object):
+    """Positions of entries sorted by their timestamp, for time-range filters
+
+    Entries are added in position order (0, 1, 2, ... unless given), and since timestamps normally only go up,
+    adding is an append; an out-of-order timestamp is inserted in place.
+    A range lookup is two binary searches plus a sort of the positions in the range.
+    """
+
+    def __init__(self):
+        self._epochs = array("d")
+        self._positions = array("i")
+        # True as long as every entry was appended, ie. positions are ascending too
+        self._in_order = True
+
+    def __len__(self):
+        return len(self._positions)
+
+    def add(self, epochs, positions=None):
+        for j, epoch in enumerate(epochs):
+            position = len(self._positions) if positions is None else positions[j]
+            if len(self._epochs) == 0 or epoch >= self._epochs[-1]:
+                self._epochs.append(epoch)
+                self._positions.append(position)
+            else:
+                i = bisect_left(self._epochs, epoch)
+                self._epochs.insert(i, epoch)
+                self._positions.insert(i, position)
+                self._in_order = False
+
+    def add_timestamps(self, timestamps):
+        self.add([timestamp_to_epoch(timestamp) for timestamp in timestamps])
+
+    def range(self, start_epoch, end_epoch):
+        """Positions (ascending) of the entries with start_epoch <= epoch < end_epoch"""
+        lo = bisect_left(self._epochs, start_epoch)
+        hi = bisect_left(self._epochs, end_epoch)
+        return np.sort(np.frombuffer(self._positions, dtype=np.int32)[lo:hi])
+
+    def page(self, start_epoch, end_epoch, start=None, count=None):
+        """A page of range(start_epoch, end_epoch), and the size of the whole range
+
+        While entries were added in order the page is sliced straight out of the index, O(log n + page size).
+        """
+        lo = bisect_left(self._epochs, start_epoch)
+        hi = max(lo, bisect_left(self._epochs, end_epoch))
+        start = start or 0
+        stop = hi - lo if count is None else min(start + count, hi - lo)
+        if self._in_order:
+            positions = np.frombuffer(self._positions, dtype=np.int32)[lo + start : lo + max(start, stop)]
+        else:
+            positions = self.range(start_epoch, end_epoch)[start:stop]
+        return positions, hi - lo
+
+
+@contextmanager
+def locked_file(path):
+    """Hold an exclusive lock on path (created if missing) for the duration of the block, across processes
+
+    The OS releases the lock when its holder dies, so a process holding it knows no other one is in the middle of a write.
+    """
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 attempts, keep waiting
+                    pass
+        else:
+            import fcntl
+
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
 def united_diff(str1, str2):
     lines1 = str1.splitlines(True)
     lines2 = str2.splitlines(True)
@@ -87,9 +343,118 @@ def parse_json(string):
         raise e
 
 
-def prepare_archival_index(folder):
+# Index types for archival FAISS indexes, see make_faiss_index
+FAISS_INDEX_TYPES = ["flat", "sq-fp16", "sq8", "ivf-flat", "ivf-pq", "hnsw"]
+
+
+def default_faiss_nlist(n_vectors):
+    """Number of IVF cells, ~4*sqrt(n), with at least 39 training points per cell (FAISS' own minimum)"""
+    if not n_vectors:
+        return 1
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39, 65536))
+
+
+def make_faiss_index(dim=1536, index_type="flat", n_vectors=None, nlist=None, pq_m=64, hnsw_m=32):
+    """Create an empty inner-product FAISS index of the given type
+
+    Vectors added to (and queried against) these indexes should be L2-normalized,
+    so that inner-product scores are cosine similarities.
+    IVF and sq8 indexes need to be trained (see train_faiss_index) before vectors are added.
+    """
+    if index_type == "flat":
+        factory_string = "Flat"
+    elif index_type == "sq-fp16":
+        # float16 scalar quantization: exact scan, half the memory of flat
+        factory_string = "SQfp16"
+    elif index_type == "sq8":
+        # int8 scalar quantization: exact scan, a quarter of the memory of flat (needs training, for the value ranges)
+        factory_string = "SQ8"
+    elif index_type == "ivf-flat":
+        factory_string = f"IVF{nlist or default_faiss_nlist(n_vectors)},Flat"
+    elif index_type == "ivf-pq":
+        if dim % pq_m != 0:
+            raise ValueError(f"PQ sub-quantizer count ({pq_m}) must divide the embedding dimension ({dim})")
+        factory_string = f"IVF{nlist or default_faiss_nlist(n_vectors)},PQ{pq_m}"
+    elif index_type == "hnsw":
+        factory_string = f"HNSW{hnsw_m},Flat"
+    else:
+        raise ValueError(f"Unknown FAISS index type '{index_type}', expected one of {FAISS_INDEX_TYPES}")
+    return faiss.index_factory(dim, factory_string, faiss.METRIC_INNER_PRODUCT)
+
+
+def faiss_index_is_cosine(index):
+    """Inner-product indexes hold normalized vectors (cosine), legacy IndexFlatL2 indexes hold raw ones"""
+    return index.metric_type == faiss.METRIC_INNER_PRODUCT
+
+
+def train_faiss_index(index, embeddings, train_sample_size=100000, seed=0):
+    """Train an (IVF) index on a random sample of the embeddings, no-op for indexes that don't need training"""
+    if index.is_trained:
+        return
+    data = normalize_embeddings(embeddings)
+    if len(data) > train_sample_size:
+        rng = np.random.default_rng(seed)
+        data = data[rng.choice(len(data), train_sample_size, replace=False)]
+    print(f"Training FAISS index on {len(data)} vectors")
+    index.train(np.ascontiguousarray(data))
+
+
+def add_to_faiss_index(index, embeddings):
+    """Add embeddings to an index (normalized first for cosine indexes), returns the vectors as added"""
+    data = np.asarray(embeddings, dtype=np.float32)
+    if faiss_index_is_cosine(index):
+        data = normalize_embeddings(data)
+    data = np.ascontiguousarray(data)
+    index.add(data)
+    return data
+
+
+def set_faiss_search_params(index, nprobe=None, ef_search=None):
+    """Set the recall/latency knobs of approximate indexes (ignored by index types that don't have them)"""
+    ivf_index = faiss.try_extract_index_ivf(index)
+    if nprobe is not None and ivf_index is not None:
+        ivf_index.nprobe = nprobe
+    if ef_search is not None and hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search
+
+
+def faiss_index_vectors(index):
+    """Every vector stored in an index, in id order (decoded, so approximate for compressed index types)"""
+    ivf_index = faiss.try_extract_index_ivf(index)
+    if ivf_index is not None:
+        # IVF lists are keyed by cell, the direct map makes vectors retrievable by id
+        ivf_index.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def build_faiss_index(embeddings, index_type="flat", nlist=None, pq_m=64, hnsw_m=32, train_sample_size=100000):
+    """Build (and train, if needed) a cosine FAISS index over a matrix of embeddings"""
+    data = np.asarray(embeddings, dtype=np.float32)
+    index = make_faiss_index(data.shape[1], index_type, n_vectors=len(data), nlist=nlist, pq_m=pq_m, hnsw_m=hnsw_m)
+    train_faiss_index(index, data, train_sample_size)
+    add_to_faiss_index(index, data)
+    return index
+
+
+ARCHIVAL_INDEX_INFO_FILE = "index_info.json"
+
+
+def read_archival_index_info(folder):
+    """Embedding model + dimension an archival index folder was built with
+
+    Folders built before this was recorded were always embedded with the OpenAI default model.
+    """
+    info_file = os.path.join(folder, ARCHIVAL_INDEX_INFO_FILE)
+    if os.path.exists(info_file):
+        with open(info_file, "rt") as f:
+            return json.load(f)
+    return {"embedding_model": DEFAULT_EMBEDDING_MODEL, "embedding_dim": None}
+
+
+def prepare_archival_index(folder, nprobe=None, ef_search=None):
     index_file = os.path.join(folder, "all_docs.index")
     index = faiss.read_index(index_file)
+    set_faiss_search_params(index, nprobe=nprobe, ef_search=ef_search)
 
     archival_database_file = os.path.join(folder, "all_docs.jsonl")
     archival_database = []
@@ -225,35 +590,27 @@ def chunk_files_for_jsonl(files, tkns_per_chunk=300, model="gpt-4"):
     return ret
 
 
-async def process_chunk(i, chunk, model):
-    try:
-        return i, await async_get_embedding_with_backoff(chunk["content"], model=model)
-    except Exception as e:
-        print(chunk)
-        raise e
-
-
-async def process_concurrently(archival_database, model, concurrency=10):
-    # Create a semaphore to limit the number of concurrent tasks
-    semaphore = asyncio.Semaphore(concurrency)
-
-    async def bounded_process_chunk(i, chunk):
-        async with semaphore:
-            return await process_chunk(i, chunk, model)
-
-    # Create a list of tasks for chunks
-    embedding_data = [0 for _ in archival_database]
-    tasks = [
-        bounded_process_chunk(i, chunk) for i, chunk in enumerate(archival_database)
-    ]
-
-    for future in tqdm(
-        asyncio.as_completed(tasks),
-        total=len(archival_database),
+async def process_concurrently(archival_database, model, concurrency=10, batch_size=256):
+    """Embed the contents of archival_database entries, batch_size texts per request and concurrency requests at a time"""
+    texts = [chunk["content"] for chunk in archival_database]
+    embedding_data = []
+    # hand the batches out in groups so progress can be reported as they complete
+    group_size = batch_size * concurrency
+    for i in tqdm(
+        range(0, len(texts), group_size),
+        total=math.ceil(len(texts) / group_size),
         desc="Processing file chunks",
     ):
-        i, result = await future
-        embedding_data[i] = result
+        embedding_data.extend(
+            (
+                await async_get_embeddings(
+                    texts[i : i + group_size],
+                    model=model,
+                    batch_size=batch_size,
+                    concurrency=concurrency,
+                )
+            ).tolist()
+        )
 
     return embedding_data
 
@@ -262,7 +619,8 @@ async def prepare_archival_index_from_files_compute_embeddings(
     glob_pattern,
     tkns_per_chunk=300,
     model="gpt-4",
-    embeddings_model="text-embedding-ada-002",
+    embeddings_model=DEFAULT_EMBEDDING_MODEL,
+    index_type="flat",
 ):
     files = sorted(glob.glob(glob_pattern))
     save_dir = os.path.join(
@@ -271,13 +629,15 @@ async def prepare_archival_index_from_files_compute_embeddings(
         + get_local_time().replace(" ", "_").replace(":", "_"),
     )
     os.makedirs(save_dir, exist_ok=True)
-    total_tokens = total_bytes(glob_pattern) / 3
-    price_estimate = total_tokens / 1000 * 0.0001
-    confirm = input(
-        f"Computing embeddings over {len(files)} files. This will cost ~${price_estimate:.2f}. Continue? [y/n] "
-    )
-    if confirm != "y":
-        raise Exception("embeddings were not computed")
+    # local embedding models are free to run, only ask before spending money on the API
+    if not get_embedding_provider(embeddings_model).is_local:
+        total_tokens = total_bytes(glob_pattern) / 3
+        price_estimate = total_tokens / 1000 * 0.0001
+        confirm = input(
+            f"Computing embeddings over {len(files)} files. This will cost ~${price_estimate:.2f}. Continue? [y/n] "
+        )
+        if confirm != "y":
+            raise Exception("embeddings were not computed")
 
     # chunk the files, make embeddings
     archival_database = chunk_files(files, tkns_per_chunk, model)
@@ -299,16 +659,26 @@ async def prepare_archival_index_from_files_compute_embeddings(
             f.write("\n")
 
     # make the faiss index
-    index = faiss.IndexFlatL2(1536)
     data = np.array(embedding_data).astype("float32")
     try:
-        index.add(data)
+        index = build_faiss_index(data, index_type=index_type)
     except Exception as e:
         print(data)
         raise e
     index_file = os.path.join(save_dir, "all_docs.index")
     print(f"Saving faiss index {index_file}")
     faiss.write_index(index, index_file)
+
+    # queries against the index have to be embedded with the same model
+    with open(os.path.join(save_dir, ARCHIVAL_INDEX_INFO_FILE), "w") as f:
+        json.dump(
+            {
+                "embedding_model": embeddings_model,
+                "embedding_dim": int(data.shape[1]),
+                "index_type": index_type,
+            },
+            f,
+        )
     return save_dir
 
 
@@ -0,0 +1,82 @@
+import asyncio
+import re
+import zlib
+
+import numpy as np
+import openai
+import pytest
+
+import memgpt.embedding_cache
+
+
+EMBEDDING_DIM = 1536
+
+
+def fake_embedding(text, dim=EMBEDDING_DIM):
+    """Bag of words, every word gets its own (hashed) dimension, so texts that share words are similar"""
+    embedding = np.zeros(dim, dtype=np.float32)
+    for word in re.findall(r"\w+", text.lower()):
+        embedding[zlib.crc32(word.encode("utf-8")) % dim] += 1.0
+    return embedding.tolist()
+
+
+@pytest.fixture(autouse=True)
+def embedding_requests(monkeypatch):
+    """Answers embedding API calls locally, returns the list of texts of every request made"""
+    requests = []
+
+    async def acreate(input, model, **kwargs):
+        requests.append(list(input))
+        return {"data": [{"index": i, "embedding": fake_embedding(text)} for i, text in enumerate(input)]}
+
+    monkeypatch.setattr(openai.Embedding, "acreate", staticmethod(acreate))
+    return requests
+
+
+@pytest.fixture(autouse=True)
+def embedding_cache(monkeypatch):
+    """Every test gets its own empty embedding cache, instead of the one in the user's home directory"""
+    cache = memgpt.embedding_cache.EmbeddingCache(":memory:")
+    monkeypatch.setattr(memgpt.embedding_cache, "_embedding_cache", cache)
+    monkeypatch.setattr(memgpt.embedding_cache, "_embedding_cache_disabled", False)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def run_main(monkeypatch):
+    """Runs the CLI's main() up to the point where it would ask for input, returns the agent it made"""
+    import memgpt.constants as constants
+    import memgpt.main
+    from memgpt.personas import personas
+
+    monkeypatch.setenv("GITHUB_ACTIONS", "1")
+    monkeypatch.delenv("AZURE_OPENAI_DEPLOYMENT", raising=False)
+    agents = []
+    use_preset = memgpt.main.presets.use_preset
+
+    def capture(*args, **kwargs):
+        agents.append(use_preset(*args, **kwargs))
+        return agents[-1]
+
+    monkeypatch.setattr(memgpt.main.presets, "use_preset", capture)
+
+    def run(**options):
+        args = dict(
+            persona=personas.DEFAULT,
+            human=None,
+            model=constants.DEFAULT_MEMGPT_MODEL,
+            first=True,
+            debug=False,
+            no_verify=True,
+            archival_storage_faiss_path=None,
+            archival_storage_files=None,
+            archival_storage_files_compute_embeddings=None,
+            archival_storage_sqldb=None,
+            use_azure_openai=False,
+        )
+        args.update(options)
+        asyncio.run(memgpt.main.main(**args))
+        return agents[-1]
+
+    return run
@@ -0,0 +1,165 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import memgpt.memory
+from memgpt.agent import AgentAsync
+from memgpt.memory import DummyArchivalMemory, DummyArchivalMemoryWithFaiss, MmapArchivalMemory
+from memgpt.prompts.gpt_functions import FUNCTIONS_CHAINING
+from memgpt.utils import TimeIndex, date_range_to_epochs, timestamp_to_epoch
+
+from .test_insert_many import archival_memories
+
+
+# (timestamp, content), in insertion order
+DATED = [
+    ("2023-10-01 09:00:00 AM PDT-0700", "cat notes from the first"),
+    ("2023-10-02 11:30:00 PM PDT-0700", "cat notes late on the second"),
+    ("2023-10-03 12:15:00 AM PDT-0700", "cat notes just after midnight on the third"),
+    ("2023-10-05 01:00:00 PM PDT-0700", "cat notes from the fifth"),
+]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Inserts get the timestamps of DATED, in order"""
+    timestamps = iter([timestamp for timestamp, _ in DATED])
+    monkeypatch.setattr(memgpt.memory, "get_local_time", lambda: next(timestamps))
+
+
+def insert_dated(memory):
+    for _, content in DATED:
+        asyncio.run(memory.insert(content))
+
+
+def search(memory, query="cat notes", **kwargs):
+    results, total = asyncio.run(memory.search(query, **kwargs))
+    return sorted(r["content"] for r in results), total
+
+
+def test_timestamp_to_epoch():
+    assert timestamp_to_epoch("2023-10-02 11:30:00 PM PDT-0700") - timestamp_to_epoch("2023-10-02") == (23 * 60 + 30) * 60
+    assert timestamp_to_epoch("2023-10-02 12:05:00 AM PDT-0700") == timestamp_to_epoch("2023-10-02") + 5 * 60
+    assert timestamp_to_epoch("2023-10-02 12:05:00 PM") == timestamp_to_epoch("2023-10-02 12:05")
+    assert timestamp_to_epoch("2023-10-02T13:00:00") == timestamp_to_epoch("2023-10-02 01:00:00 PM")
+    for unparsable in ["yesterday", "", None, "2023-02-30"]:
+        assert timestamp_to_epoch(unparsable) == float("-inf")
+
+
+def test_date_range_to_epochs():
+    start, end = date_range_to_epochs("2023-10-02", "2023-10-02")
+    # the end date is included, up to midnight
+    assert start == timestamp_to_epoch("2023-10-02") and end == timestamp_to_epoch("2023-10-03")
+    start, end = date_range_to_epochs()
+    assert float("-inf") < start < timestamp_to_epoch("1900-01-01") and end == float("inf")
+    with pytest.raises(ValueError, match="YYYY-MM-DD"):
+        date_range_to_epochs("10/02/2023")
+
+
+def test_time_index():
+    index = TimeIndex()
+    index.add([10.0, 20.0, 30.0])
+    # out of order entries are inserted in place
+    index.add([15.0, 20.0, 5.0])
+    assert len(index) == 6
+    assert list(index.range(10.0, 20.0)) == [0, 3]
+    assert list(index.range(20.0, 31.0)) == [1, 2, 4]
+    assert list(index.range(0.0, 100.0)) == list(range(6))
+    assert list(index.range(40.0, 50.0)) == []
+    assert list(TimeIndex().range(0.0, 100.0)) == []
+
+
+def dated_memories(tmp_path):
+    memories = archival_memories(tmp_path)
+    memories["faiss-hnsw"] = lambda: DummyArchivalMemoryWithFaiss(index_type="hnsw")
+    return memories
+
+
+KINDS = ["text", "embeddings", "faiss", "faiss-hnsw", "mmap", "hybrid"]
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_date_filtered_search(kind, tmp_path, clock):
+    memory = dated_memories(tmp_path)[kind]()
+    insert_dated(memory)
+    assert search(memory, start_date="2023-10-02", end_date="2023-10-03") == (
+        ["cat notes just after midnight on the third", "cat notes late on the second"],
+        2,
+    )
+    assert search(memory, start_date="2023-10-03") == (["cat notes from the fifth", "cat notes just after midnight on the third"], 2)
+    assert search(memory, end_date="2023-10-01") == (["cat notes from the first"], 1)
+    assert search(memory)[1] == 4
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_date_filtered_paging(kind, tmp_path, clock):
+    memory = dated_memories(tmp_path)[kind]()
+    insert_dated(memory)
+    first, total = search(memory, count=1, start=0, start_date="2023-10-02")
+    second, _ = search(memory, count=1, start=1, start_date="2023-10-02")
+    third, _ = search(memory, count=1, start=2, start_date="2023-10-02")
+    assert total == 3
+    assert sorted(first + second + third) == sorted(content for _, content in DATED[1:])
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_empty_date_range(kind, tmp_path, clock):
+    memory = dated_memories(tmp_path)[kind]()
+    assert search(memory, start_date="2023-10-01") == ([], 0)
+    insert_dated(memory)
+    assert search(memory, start_date="2023-10-04", end_date="2023-10-04") == ([], 0)
+    assert search(memory, start_date="2023-10-05", end_date="2023-10-01") == ([], 0)
+    with pytest.raises(ValueError):
+        search(memory, start_date="October 4th")
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_index_catches_up_with_inserts(kind, tmp_path, monkeypatch):
+    timestamps = iter([DATED[0][0], DATED[3][0], DATED[1][0]])
+    monkeypatch.setattr(memgpt.memory, "get_local_time", lambda: next(timestamps))
+    memory = dated_memories(tmp_path)[kind]()
+    asyncio.run(memory.insert("cat notes one"))
+    asyncio.run(memory.insert("cat notes two"))
+    assert search(memory, start_date="2023-10-02") == (["cat notes two"], 1)
+    # a memory saved with an earlier timestamp than the last one
+    asyncio.run(memory.insert("cat notes three"))
+    assert search(memory, start_date="2023-10-02") == (["cat notes three", "cat notes two"], 2)
+    assert search(memory, end_date="2023-10-02") == (["cat notes one", "cat notes three"], 2)
+
+
+def test_shared_archive_list_appends_are_filtered():
+    archive = [{"timestamp": DATED[0][0], "content": DATED[0][1]}]
+    memory = DummyArchivalMemory(archival_memory_database=archive)
+    assert search(memory, start_date="2023-10-01")[1] == 1
+    archive.append({"timestamp": DATED[3][0], "content": DATED[3][1]})
+    archive.append({"timestamp": "some day", "content": "cat notes from an unknown day"})
+    assert search(memory, start_date="2023-10-05") == (["cat notes from the fifth"], 1)
+    # unparsable timestamps are only found without a date filter
+    assert search(memory, end_date="2023-10-05")[1] == 2
+    assert search(memory)[1] == 3
+
+
+def test_mmap_reopen_and_backfill(tmp_path, clock):
+    path = str(tmp_path / "archive")
+    insert_dated(MmapArchivalMemory(path))
+    reopened = MmapArchivalMemory(path)
+    assert search(reopened, start_date="2023-10-05")[1] == 1
+    # archives written before the epochs file existed get it filled in on the first filtered search
+    os.truncate(os.path.join(path, MmapArchivalMemory.EPOCHS_FILE), 0)
+    old = MmapArchivalMemory(path)
+    assert search(old, start_date="2023-10-02", end_date="2023-10-02") == (["cat notes late on the second"], 1)
+    assert os.path.getsize(os.path.join(path, MmapArchivalMemory.EPOCHS_FILE)) == len(DATED) * 8
+
+
+def test_agent_function(clock):
+    memory = DummyArchivalMemory()
+    insert_dated(memory)
+    agent = SimpleNamespace(persistence_manager=SimpleNamespace(archival_memory=memory))
+    results = asyncio.run(AgentAsync.archival_memory_search(agent, "cat notes", start_date="2023-10-05"))
+    assert results.startswith("Showing 1 of 1 results")
+    assert "cat notes from the fifth" in results
+    assert asyncio.run(AgentAsync.archival_memory_search(agent, "cat notes", start_date="2023-11-01")) == "No results found."
+    parameters = FUNCTIONS_CHAINING["archival_memory_search"]["parameters"]
+    assert {"start_date", "end_date"} <= set(parameters["properties"]) and "start_date" not in parameters["required"]
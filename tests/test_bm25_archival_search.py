@@ -0,0 +1,95 @@
+import asyncio
+import pickle
+
+import pytest
+
+from memgpt.memory import DummyArchivalMemory
+from memgpt.utils import tokenize
+
+
+def memory_with(contents):
+    memory = DummyArchivalMemory()
+    for content in contents:
+        asyncio.run(memory.insert(content))
+    return memory
+
+
+def search(memory, query, **kwargs):
+    matches, total = asyncio.run(memory.search(query, **kwargs))
+    return [m["content"] for m in matches], total
+
+
+def test_tokenize():
+    assert tokenize("Hello, World! it's 2023") == ["hello", "world", "it", "s", "2023"]
+    assert tokenize("?!") == []
+
+
+def test_rare_terms_weigh_more():
+    memory = memory_with(["cats and dogs", "cats and birds", "cats and fish", "dogs only"])
+    assert search(memory, "cats birds")[0][0] == "cats and birds"
+
+
+def test_term_frequency_and_length_normalization():
+    memory = memory_with(["dogs dogs dogs", "dogs", "a very long text that mentions dogs once among many other words"])
+    contents, total = search(memory, "dogs")
+    assert total == 3
+    assert contents[0] == "dogs dogs dogs"
+    assert contents[-1].startswith("a very long text")
+
+
+def test_matches_any_term_and_pages():
+    memory = memory_with(["red apple", "green apple", "red car", "blue sky"])
+    contents, total = search(memory, "red apple")
+    assert total == 3
+    assert contents[0] == "red apple"
+    assert sorted(contents[1:]) == ["green apple", "red car"]
+    page, _ = search(memory, "red apple", count=2, start=1)
+    assert page == contents[1:3]
+    assert search(memory, "red apple", count=2, start=5) == ([], 3)
+
+
+def test_case_insensitive():
+    memory = memory_with(["The Quick Brown Fox"])
+    assert search(memory, "QUICK fox") == (["The Quick Brown Fox"], 1)
+
+
+def test_no_match():
+    memory = memory_with(["red apple"])
+    assert search(memory, "submarine") == ([], 0)
+
+
+def test_empty_archive():
+    assert search(DummyArchivalMemory(), "anything") == ([], 0)
+
+
+def test_punctuation_only_query_falls_back_to_substring_match():
+    memory = memory_with(["what?!", "nothing here", "really?!"])
+    assert search(memory, "?!") == (["what?!", "really?!"], 2)
+
+
+def test_preloaded_database_and_later_appends_are_indexed():
+    database = [{"content": "red apple"}, {"content": "green apple"}]
+    memory = DummyArchivalMemory(database)
+    assert search(memory, "apple")[1] == 2
+    # the preloaded list is the archive, entries appended to it get indexed on the next search
+    database.append({"content": "apple pie"})
+    assert search(memory, "pie") == (["apple pie"], 1)
+
+
+def test_embeddings_are_rejected():
+    with pytest.raises(ValueError):
+        asyncio.run(DummyArchivalMemory().insert("red apple", embedding=[1.0]))
+
+
+def test_reload_and_old_pickles():
+    memory = memory_with(["red apple", "green apple", "red car"])
+    loaded = pickle.loads(pickle.dumps(memory))
+    assert search(loaded, "red") == search(memory, "red")
+    asyncio.run(loaded.insert("red rose"))
+    assert search(loaded, "rose") == (["red rose"], 1)
+
+    # pickled before the index existed
+    for key in ["_postings", "_doc_lengths", "_total_doc_length", "bm25_k1", "bm25_b"]:
+        memory.__dict__.pop(key)
+    old = pickle.loads(pickle.dumps(memory))
+    assert search(old, "red") == search(memory_with(["red apple", "green apple", "red car"]), "red")
@@ -0,0 +1,254 @@
+import asyncio
+import json
+import os
+import shutil
+from types import SimpleNamespace
+
+import pytest
+
+from memgpt.checkpoint_store import CheckpointStore
+from memgpt.persistence_manager import InMemoryStateManager
+
+
+def blobs(store):
+    """The blob files of a store, by key"""
+    found = {}
+    for prefix in os.listdir(store.path):
+        if os.path.isdir(os.path.join(store.path, prefix)):
+            for filename in os.listdir(os.path.join(store.path, prefix)):
+                if "." not in filename:
+                    found[prefix + filename] = store.file(prefix + filename)
+    return found
+
+
+def blobs_containing(store, text):
+    found = []
+    for key, filename in blobs(store).items():
+        with open(filename, "rb") as f:
+            if text.encode("utf-8") in f.read():
+                found.append(key)
+    return found
+
+
+def test_equal_values_are_stored_once(tmp_path):
+    store = CheckpointStore(str(tmp_path / "store"))
+    value = {"name": "send_message", "parameters": {"message": "string", "heartbeat": "boolean"}}
+    key = store.put(value)
+    assert store.put(dict(value)) == key
+    assert list(blobs(store)) == [key]
+    assert store.get(key) == value
+    # the order of the keys is kept, so a different order is a different value
+    reordered = {"parameters": {"heartbeat": "boolean", "message": "string"}, "name": "send_message"}
+    other = store.put(reordered)
+    assert other != key
+    assert json.dumps(store.get(other)) == json.dumps(reordered)
+    assert store.key_of(store.file(key)) == key
+
+
+def test_chunks_only_store_what_was_appended(tmp_path):
+    store = CheckpointStore(str(tmp_path / "store"))
+    sequence = list(range(10))
+    chunks = store.put_chunks(sequence)
+    assert store.get_chunks(chunks) == sequence
+    before = set(blobs(store))
+    sequence.append(10)
+    chunks = store.put_chunks(sequence, chunks)
+    assert store.get_chunks(chunks) == sequence
+    # one new chunk, with only the new item
+    new = set(blobs(store)) - before
+    assert len(new) == 1 and store.get_chunks([[new.pop(), 1]]) == [10]
+    # nothing appended, nothing written
+    assert store.put_chunks(sequence, chunks) == chunks
+    with pytest.raises(ValueError):
+        store.put_chunks(sequence[:5], chunks)
+
+
+def test_an_empty_sequence_keeps_its_type(tmp_path):
+    store = CheckpointStore(str(tmp_path / "store"))
+    chunks = store.put_chunks([])
+    assert store.get_chunks(chunks) == []
+    chunks = store.put_chunks(["a"], chunks)
+    assert store.get_chunks(chunks) == ["a"]
+
+
+def test_chunks_are_merged(tmp_path, monkeypatch):
+    monkeypatch.setattr(CheckpointStore, "CHUNK_MAX_ITEMS", 16)
+    store = CheckpointStore(str(tmp_path / "store"))
+    sequence, chunks = [], []
+    for i in range(200):
+        sequence.append(i)
+        chunks = store.put_chunks(sequence, chunks)
+        # size-tiered: few chunks, none bigger than the limit
+        assert sum(count for _, count in chunks) == len(sequence)
+        assert all(count <= 16 for _, count in chunks)
+        assert len(chunks) <= len(sequence) // 16 + 5
+    assert store.get_chunks(chunks) == sequence
+
+
+def test_garbage_is_what_no_checkpoint_uses(tmp_path):
+    store = CheckpointStore.next_to(str(tmp_path / "first.json"))
+    assert store.path == str(tmp_path / "store")
+    only_first, shared, only_second, child = [store.put(value) for value in ["only first", "shared", "only second", "child"]]
+    parent = store.put_bytes(b"parent", children=[child])
+    for name, keys in [("first.json", [only_first, shared]), ("second.json", [shared, only_second, parent])]:
+        (tmp_path / name).write_text("{}")
+        store.pin(str(tmp_path / name), keys)
+    # nothing was deleted or overwritten yet
+    assert store.collect_garbage() == 0
+    os.remove(tmp_path / "first.json")
+    assert store.collect_garbage() == 1
+    assert set(blobs(store)) == {shared, only_second, parent, child}
+    # an overwritten checkpoint lets go of what it used before, but not of the blobs its blobs use
+    store.pin(str(tmp_path / "second.json"), [parent])
+    assert store.collect_garbage() == 2
+    assert set(blobs(store)) == {parent, child}
+    assert store.collect_garbage() == 0
+
+
+def test_nothing_is_deleted_next_to_checkpoints_that_werent_pinned(tmp_path):
+    store = CheckpointStore.next_to(str(tmp_path / "first.json"))
+    key = store.put("used by the old checkpoint")
+    (tmp_path / "first.json").write_text("{}")
+    store.pin(str(tmp_path / "first.json"), [])
+    # saved before checkpoints were pinned
+    (tmp_path / "old.json").write_text("{}")
+    os.remove(tmp_path / "first.json")
+    assert store.collect_garbage() == 0
+    assert key in blobs(store)
+    # and once it's gone, the garbage still gets collected
+    os.remove(tmp_path / "old.json")
+    assert store.collect_garbage() == 1
+
+
+def test_agent_checkpoints_are_manifests(tmp_path, run_main):
+    agent = run_main()
+    agent.append_to_messages([{"role": "user", "content": "before the first save"}])
+    first = str(tmp_path / "first.json")
+    agent.save_to_json_file(first)
+    store = CheckpointStore.next_to(first)
+    with open(first) as f:
+        manifest = f.read()
+    assert agent.system not in manifest and "before the first save" not in manifest
+    saved_messages = [dict(msg) for msg in agent.messages]
+
+    # saving the same state again writes no new blobs
+    before = set(blobs(store))
+    agent.save_to_json_file(str(tmp_path / "second.json"))
+    assert set(blobs(store)) == before
+    agent.append_to_messages([{"role": "user", "content": "after the first save"}])
+    agent.save_to_json_file(str(tmp_path / "third.json"))
+    assert len(set(blobs(store)) - before) == 1
+
+    agent.load_from_json_file_inplace(first)
+    assert agent.messages == saved_messages
+    agent.load_from_json_file_inplace(str(tmp_path / "third.json"))
+    assert agent.messages[-1]["content"] == "after the first save"
+
+
+def test_checkpoints_saved_before_the_store_still_load(tmp_path, run_main):
+    agent = run_main()
+    filename = str(tmp_path / "old.json")
+    with open(filename, "w") as f:
+        json.dump(agent.to_dict(), f)
+    system, saved_messages = agent.system, [dict(msg) for msg in agent.messages]
+    agent.append_to_messages([{"role": "user", "content": "not saved"}])
+    agent.load_from_json_file_inplace(filename)
+    assert agent.system == system and agent.messages == saved_messages
+
+
+def test_deleting_a_checkpoint_frees_what_only_it_used(tmp_path, run_main):
+    agent = run_main()
+    first = str(tmp_path / "first.json")
+    agent.save_to_json_file(first)
+    saved_messages = [dict(msg) for msg in agent.messages]
+    agent.append_to_messages([{"role": "user", "content": "only in the second checkpoint"}])
+    second = str(tmp_path / "second.json")
+    agent.save_to_json_file(second)
+    store = CheckpointStore.next_to(first)
+    assert len(blobs_containing(store, "only in the second checkpoint")) == 1
+    os.remove(second)
+    # branch off the first checkpoint, the next save collects the garbage
+    agent.load_from_json_file_inplace(first)
+    agent.save_to_json_file(str(tmp_path / "branch.json"))
+    assert blobs_containing(store, "only in the second checkpoint") == []
+    agent.load_from_json_file_inplace(first)
+    assert agent.messages == saved_messages
+
+
+def archive_manager(n_memories):
+    manager = InMemoryStateManager()
+    manager.init(SimpleNamespace(messages=[{"role": "system", "content": "system prompt"}], memory=None))
+    for i in range(n_memories):
+        asyncio.run(manager.archival_memory.insert(f"memory <{i}>"))
+    return manager
+
+
+def archive_of(manager):
+    return [d["content"] for d in manager.archival_memory._archive]
+
+
+@pytest.fixture
+def saved_parts(monkeypatch):
+    """Records the names of the memory parts pickled to the store"""
+    names = []
+    save_part = InMemoryStateManager._save_part
+
+    def record(self, store, name):
+        names.append(name)
+        return save_part(self, store, name)
+
+    monkeypatch.setattr(InMemoryStateManager, "_save_part", record)
+    return names
+
+
+def test_unchanged_parts_are_not_pickled_again(tmp_path, saved_parts):
+    manager = archive_manager(3)
+    manager.save(str(tmp_path / "first.persistence.pickle"))
+    assert sorted(saved_parts) == ["archival_memory", "recall_memory"]
+    saved_parts.clear()
+    manager.save(str(tmp_path / "second.persistence.pickle"))
+    assert saved_parts == []
+    asyncio.run(manager.archival_memory.insert("memory <3>"))
+    manager.save(str(tmp_path / "third.persistence.pickle"))
+    assert saved_parts == ["archival_memory"]
+    manager.close()
+
+
+def test_appended_memories_only_write_new_chunks(tmp_path):
+    manager = archive_manager(200)
+    first = str(tmp_path / "first.persistence.pickle")
+    manager.save(first)
+    store = CheckpointStore.next_to(first)
+    before = set(blobs(store))
+    asyncio.run(manager.archival_memory.insert("memory <200>"))
+    second = str(tmp_path / "second.persistence.pickle")
+    manager.save(second)
+    new = set(blobs(store)) - before
+    assert new and all(key not in blobs_containing(store, "memory <0>") for key in new)
+    manager.close()
+    # both checkpoints load, with the archive as it was saved
+    for filename, n_memories in [(first, 200), (second, 201)]:
+        loaded = InMemoryStateManager.load(filename)
+        try:
+            assert archive_of(loaded) == [f"memory <{i}>" for i in range(n_memories)]
+            assert asyncio.run(loaded.archival_memory.search("<7>"))[1] == 1
+        finally:
+            loaded.close()
+
+
+def test_saving_into_another_directory_copies_the_parts(tmp_path):
+    manager = archive_manager(5)
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    manager.save(str(tmp_path / "a" / "agent.persistence.pickle"))
+    manager.close()
+    loaded = InMemoryStateManager.load(str(tmp_path / "a" / "agent.persistence.pickle"))
+    copy = str(tmp_path / "b" / "agent.persistence.pickle")
+    loaded.save(copy)
+    loaded.close()
+    shutil.rmtree(tmp_path / "a" / "store")
+    loaded = InMemoryStateManager.load(copy)
+    try:
+        assert archive_of(loaded) == [f"memory <{i}>" for i in range(5)]
+    finally:
+        loaded.close()
@@ -0,0 +1,148 @@
+import asyncio
+import sqlite3
+
+import numpy as np
+
+import memgpt.embedding_cache
+from memgpt.embedding_cache import EmbeddingCache, get_embedding_cache, get_embeddings_cached, normalize_text, set_embedding_cache
+from memgpt.embeddings import DEFAULT_EMBEDDING_MODEL, async_get_embedding, async_get_embeddings
+from memgpt.memory import DummyArchivalMemoryWithEmbeddings
+from memgpt.openai_tools import async_get_embedding_with_backoff, async_get_embeddings_with_backoff
+
+from .conftest import fake_embedding
+
+
+def vector(seed, dim=8):
+    return np.random.default_rng(seed).normal(size=dim).astype(np.float32)
+
+
+def test_normalize_text():
+    assert normalize_text("  the\tcat \n sat ") == "the cat sat"
+    # composed and decomposed forms of the same character
+    assert normalize_text("café") == normalize_text("café")
+
+
+def test_put_and_get(embedding_cache):
+    embedding_cache.put("model-a", "the cat", vector(0))
+    np.testing.assert_array_equal(embedding_cache.get("model-a", "  the   cat "), vector(0))
+    assert embedding_cache.get("model-b", "the cat") is None
+    assert embedding_cache.get("model-a", "the dog") is None
+    assert embedding_cache.stats()["hits"] == 1 and embedding_cache.stats()["misses"] == 2
+
+
+def test_get_many_keeps_order(embedding_cache):
+    embedding_cache.put_many("m", ["a", "c"], [vector(0), vector(2)])
+    found = embedding_cache.get_many("m", ["c", "b", "a"])
+    np.testing.assert_array_equal(found[0], vector(2))
+    assert found[1] is None
+    np.testing.assert_array_equal(found[2], vector(0))
+
+
+def test_replacing_an_entry_doesnt_count_twice(embedding_cache):
+    embedding_cache.put("m", "a", vector(0))
+    embedding_cache.put("m", "a", vector(1))
+    assert len(embedding_cache) == 1
+    assert embedding_cache.stats()["bytes"] == vector(1).nbytes
+    np.testing.assert_array_equal(embedding_cache.get("m", "a"), vector(1))
+
+
+def test_evicts_least_recently_used():
+    cache = EmbeddingCache(":memory:", max_bytes=10 * vector(0).nbytes)
+    for i in range(10):
+        cache.put("m", f"text {i}", vector(i))
+    # reading an entry makes it recently used
+    assert cache.get("m", "text 0") is not None
+    cache.put("m", "text 10", vector(10))
+    assert cache.stats()["bytes"] <= 0.9 * cache.max_bytes
+    assert cache.get("m", "text 0") is not None
+    assert cache.get("m", "text 1") is None
+    assert cache.get("m", "text 10") is not None
+
+
+def test_reopen(tmp_path):
+    path = str(tmp_path / "cache" / "embeddings.db")
+    cache = EmbeddingCache(path)
+    cache.put_many("m", ["a", "b"], [vector(0), vector(1)])
+    cache.close()
+    reopened = EmbeddingCache(path)
+    assert len(reopened) == 2
+    assert reopened.stats()["bytes"] == 2 * vector(0).nbytes
+    np.testing.assert_array_equal(reopened.get("m", "b"), vector(1))
+    reopened.clear()
+    assert len(reopened) == 0 and reopened.stats()["bytes"] == 0
+
+
+def test_cached_embeddings_are_computed_once(embedding_cache):
+    calls = []
+
+    async def embed(texts):
+        calls.append(list(texts))
+        return [vector(len(text)) for text in texts]
+
+    texts = ["the cat", "the  cat", "a dog", "the cat"]
+    first = asyncio.run(get_embeddings_cached("m", texts, embed))
+    # whitespace variants share one embedding
+    assert calls == [["the cat", "a dog"]]
+    np.testing.assert_array_equal(first[1], first[0])
+    second = asyncio.run(get_embeddings_cached("m", ["a dog", "a bird"], embed))
+    assert calls[1:] == [["a bird"]]
+    np.testing.assert_array_equal(second[0], first[2])
+    assert asyncio.run(get_embeddings_cached("m", [], embed)) == []
+
+
+def test_disabled_cache():
+    set_embedding_cache(None)
+    assert get_embedding_cache() is None
+    calls = []
+
+    async def embed(texts):
+        calls.append(list(texts))
+        return [vector(0) for _ in texts]
+
+    for _ in range(2):
+        asyncio.run(get_embeddings_cached("m", ["a"], embed))
+    assert calls == [["a"], ["a"]]
+
+
+def test_unopenable_cache_disables_caching(monkeypatch):
+    def fail(*args, **kwargs):
+        raise sqlite3.OperationalError("unable to open database file")
+
+    set_embedding_cache(None)
+    monkeypatch.setattr(memgpt.embedding_cache, "_embedding_cache_disabled", False)
+    monkeypatch.setattr(memgpt.embedding_cache, "EmbeddingCache", fail)
+    assert get_embedding_cache() is None
+    assert memgpt.embedding_cache._embedding_cache_disabled
+
+
+def test_openai_helpers_use_the_cache(embedding_requests):
+    first = asyncio.run(async_get_embeddings_with_backoff(["the cat sat", "a dog barked"]))
+    second = asyncio.run(async_get_embeddings_with_backoff(["a dog barked", "the bird sang"]))
+    single = asyncio.run(async_get_embedding_with_backoff("the cat sat"))
+    assert embedding_requests == [["the cat sat", "a dog barked"], ["the bird sang"]]
+    # cached or not, embeddings come back as lists of floats
+    assert isinstance(second[0], list) and isinstance(single, list)
+    assert second[0] == first[1]
+    np.testing.assert_allclose(single, fake_embedding("the cat sat"))
+
+
+def test_provider_embeddings_use_the_cache(embedding_cache, embedding_requests):
+    embeddings = asyncio.run(async_get_embeddings(["the cat sat", "a dog barked"], model=DEFAULT_EMBEDDING_MODEL))
+    embedding = asyncio.run(async_get_embedding("a dog barked", model=DEFAULT_EMBEDDING_MODEL))
+    assert embedding_requests == [["the cat sat", "a dog barked"]]
+    np.testing.assert_array_equal(embedding, embeddings[1])
+    assert len(embedding_cache) == 2
+
+
+def test_local_embeddings_are_not_cached(embedding_cache):
+    asyncio.run(async_get_embeddings(["the cat sat"], model="hashing-64"))
+    assert len(embedding_cache) == 0
+
+
+def test_archival_memory_reuses_cached_embeddings(embedding_requests):
+    for _ in range(2):
+        memory = DummyArchivalMemoryWithEmbeddings()
+        asyncio.run(memory.insert("the cat sat on the mat"))
+        results, total = asyncio.run(memory.search("the cat sat on the mat", count=1))
+        assert results[0]["content"] == "the cat sat on the mat"
+    assert embedding_requests == [["the cat sat on the mat"]]
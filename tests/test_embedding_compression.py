@@ -0,0 +1,108 @@
+import asyncio
+import pickle
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from memgpt.memory import DummyArchivalMemoryWithEmbeddings, EmbeddingMatrix
+from memgpt.persistence_manager import InMemoryStateManagerWithEmbeddings
+from memgpt.utils import build_faiss_index, dequantize_embeddings, quantize_embeddings
+
+from .test_faiss_index_types import clustered_vectors
+
+
+def unit_rows(n=200, dim=32, seed=0):
+    rows = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("dtype, atol", [("float32", 0), ("float16", 1e-3), ("int8", 1e-2)])
+def test_quantize_round_trip(dtype, atol):
+    rows = unit_rows()
+    data, scales = quantize_embeddings(rows, dtype)
+    assert data.dtype == np.dtype(dtype)
+    assert (scales is not None) == (dtype == "int8")
+    np.testing.assert_allclose(dequantize_embeddings(data, scales), rows, atol=atol)
+
+
+def test_quantize_zero_rows_and_unknown_dtypes():
+    data, scales = quantize_embeddings(np.zeros((2, 4)), "int8")
+    assert (dequantize_embeddings(data, scales) == 0).all()
+    with pytest.raises(ValueError):
+        quantize_embeddings(unit_rows(), "int4")
+    with pytest.raises(ValueError):
+        EmbeddingMatrix(dtype="int4")
+
+
+@pytest.mark.parametrize("dtype, ratio", [("float16", 2), ("int8", 4)])
+def test_compressed_matrix_memory_and_scores(dtype, ratio):
+    rows = unit_rows()
+    exact, compressed = EmbeddingMatrix(dtype="float32", initial_capacity=4), EmbeddingMatrix(dtype=dtype, initial_capacity=4)
+    for matrix in [exact, compressed]:
+        # grows (and copies the scales) a few times
+        matrix.extend(rows[:50])
+        matrix.extend(rows[50:])
+    assert compressed.vectors.dtype == np.dtype(dtype)
+    assert compressed.nbytes() < exact.nbytes() / ratio * 1.2
+    np.testing.assert_allclose(compressed.scores(rows[0]), exact.scores(rows[0]), atol=0.02)
+
+
+def test_rescoring_returns_exact_scores(tmp_path):
+    rows = unit_rows()
+    exact = EmbeddingMatrix()
+    exact.extend(rows)
+    compressed = EmbeddingMatrix(dtype="int8", rescore_path=str(tmp_path / "exact.f32"))
+    compressed.extend(rows[:100])
+    compressed.extend(rows[100:])
+    query = rows[3] + 0.1 * rows[7]
+    expected_rows, expected_scores = exact.search(query, k=5)
+    found_rows, found_scores = compressed.search(query, k=5)
+    assert list(found_rows) == list(expected_rows)
+    np.testing.assert_allclose(found_scores, expected_scores, rtol=1e-5)
+
+
+def test_compressed_matrix_reload(tmp_path):
+    matrix = EmbeddingMatrix(dtype="int8")
+    matrix.extend(unit_rows(10))
+    loaded = pickle.loads(pickle.dumps(matrix))
+    assert loaded.dtype == "int8"
+    np.testing.assert_array_equal(loaded.scores(unit_rows(1, seed=1)[0]), matrix.scores(unit_rows(1, seed=1)[0]))
+    loaded.extend(unit_rows(3, seed=2))
+    assert len(loaded) == 13
+
+
+def test_empty_compressed_matrix(tmp_path):
+    matrix = EmbeddingMatrix(dtype="int8", rescore_path=str(tmp_path / "exact.f32"))
+    rows, scores = matrix.search(np.ones(4), k=3)
+    assert len(rows) == len(scores) == 0
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_compressed_archival_memory_ranks_like_float32(dtype, tmp_path):
+    contents = ["the cat sat", "dogs bark loudly", "a cat and a dog", "weather report", "birds sing"]
+    exact = DummyArchivalMemoryWithEmbeddings()
+    compressed = DummyArchivalMemoryWithEmbeddings(embedding_dtype=dtype, rescore_path=str(tmp_path / "exact.f32"))
+    for memory in [exact, compressed]:
+        asyncio.run(memory.insert_many(contents))
+    for query in ["cat", "dogs", "birds sing"]:
+        assert asyncio.run(compressed.search(query, count=2)) == asyncio.run(exact.search(query, count=2))
+
+
+@pytest.mark.parametrize("index_type", ["sq-fp16", "sq8"])
+def test_scalar_quantized_faiss_indexes(index_type):
+    data = clustered_vectors()
+    index = build_faiss_index(data, index_type=index_type)
+    queries = data[:20] / np.linalg.norm(data[:20], axis=1, keepdims=True)
+    scores, ids = index.search(queries, 1)
+    assert (scores[:, 0] > 0.95).all()
+
+
+def test_manager_options(tmp_path):
+    agent = SimpleNamespace(messages=[{"role": "system", "content": "system prompt"}], memory=None)
+    manager = InMemoryStateManagerWithEmbeddings(embedding_dtype="int8", rescore_path=str(tmp_path / "exact.f32"))
+    manager.init(agent)
+    assert manager.archival_memory._embeddings.dtype == "int8"
+    assert manager.recall_memory.embedding_dtype == "int8"
+    asyncio.run(manager.archival_memory.insert("the cat sat"))
+    assert (tmp_path / "exact.f32").stat().st_size == 1536 * 4
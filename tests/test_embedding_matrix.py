@@ -0,0 +1,119 @@
+import asyncio
+import pickle
+
+import numpy as np
+import pytest
+
+from memgpt.memory import DummyArchivalMemoryWithEmbeddings, EmbeddingMatrix
+from memgpt.utils import top_k_indices
+
+from .conftest import fake_embedding
+
+
+def test_matrix_rows_are_normalized_and_survive_growth():
+    matrix = EmbeddingMatrix(initial_capacity=2)
+    rng = np.random.default_rng(0)
+    rows = rng.normal(size=(5, 8)).astype(np.float32)
+    matrix.extend(rows[:1])
+    matrix.extend(rows[1:])
+    assert len(matrix) == 5
+    expected = rows / np.linalg.norm(rows, axis=1, keepdims=True)
+    np.testing.assert_allclose(matrix.vectors, expected, rtol=1e-6)
+    np.testing.assert_allclose(matrix.scores(rows[2]), expected @ expected[2], rtol=1e-5)
+
+
+def test_matrix_rejects_other_dimensions():
+    matrix = EmbeddingMatrix()
+    matrix.append([1.0, 0.0, 0.0])
+    with pytest.raises(ValueError):
+        matrix.append([1.0, 0.0])
+
+
+def test_empty_matrix():
+    matrix = EmbeddingMatrix()
+    assert len(matrix) == 0
+    assert len(matrix.scores([1.0, 0.0])) == 0
+    matrix.extend([])
+    assert len(matrix) == 0
+
+
+def test_matrix_pickle_drops_unused_capacity():
+    matrix = EmbeddingMatrix(initial_capacity=1024)
+    matrix.extend(np.eye(3, dtype=np.float32))
+    loaded = pickle.loads(pickle.dumps(matrix))
+    assert len(loaded) == 3
+    assert len(pickle.dumps(matrix)) < 1024 * 3 * 4
+    np.testing.assert_array_equal(loaded.vectors, matrix.vectors)
+    loaded.append([0.0, 0.0, 2.0])
+    assert len(loaded) == 4
+
+
+def test_top_k_indices():
+    scores = np.array([0.1, 0.9, 0.5, 0.7])
+    assert list(top_k_indices(scores)) == [1, 3, 2, 0]
+    assert list(top_k_indices(scores, 2)) == [1, 3]
+    assert list(top_k_indices(scores, 10)) == [1, 3, 2, 0]
+    assert len(top_k_indices(scores, 0)) == 0
+    assert len(top_k_indices(np.array([]), 3)) == 0
+
+
+def test_top_k_indices_keeps_ties_in_index_order():
+    scores = np.array([0.5, 0.9, 0.5, 0.5, 0.1])
+    assert list(top_k_indices(scores)) == [1, 0, 2, 3, 4]
+
+
+def memory_with(contents):
+    memory = DummyArchivalMemoryWithEmbeddings()
+    for content in contents:
+        asyncio.run(memory.insert(content))
+    return memory
+
+
+def test_search_ranks_by_similarity_and_pages():
+    memory = memory_with(["the cat sat", "dogs bark loudly", "a cat and a dog", "weather report"])
+    matches, total = asyncio.run(memory.search("cat"))
+    assert total == 4
+    assert [m["content"] for m in matches[:2]] == ["the cat sat", "a cat and a dog"]
+    page, total = asyncio.run(memory.search("cat", count=1, start=1))
+    assert total == 4
+    assert [m["content"] for m in page] == ["a cat and a dog"]
+    assert "embedding" not in matches[0]
+
+
+def test_search_empty_archive():
+    memory = DummyArchivalMemoryWithEmbeddings()
+    assert asyncio.run(memory.search("anything")) == ([], 0)
+
+
+def test_preloaded_database_is_not_modified():
+    database = [{"content": "the cat sat", "embedding": fake_embedding("the cat sat")}, {"content": "dogs bark", "embedding": fake_embedding("dogs bark")}]
+    memory = DummyArchivalMemoryWithEmbeddings(database)
+    assert all("embedding" in d for d in database)
+    matches, _ = asyncio.run(memory.search("dogs"))
+    assert matches[0]["content"] == "dogs bark"
+
+
+def test_preloaded_database_needs_embeddings():
+    with pytest.raises(ValueError):
+        DummyArchivalMemoryWithEmbeddings([{"content": "no embedding"}])
+
+
+def test_reload_keeps_results():
+    memory = memory_with(["the cat sat", "dogs bark loudly", "a cat and a dog"])
+    loaded = pickle.loads(pickle.dumps(memory))
+    assert asyncio.run(loaded.search("dog")) == asyncio.run(memory.search("dog"))
+    asyncio.run(loaded.insert("another dog"))
+    assert len(loaded) == 4
+
+
+def test_load_archive_pickled_before_the_matrix():
+    memory = memory_with(["the cat sat", "dogs bark loudly"])
+    # the old format kept each embedding in its archive entry
+    state = {key: value for key, value in memory.__dict__.items() if key != "_embeddings"}
+    state["_archive"] = [dict(d, embedding=fake_embedding(d["content"])) for d in memory._archive]
+    old = DummyArchivalMemoryWithEmbeddings.__new__(DummyArchivalMemoryWithEmbeddings)
+    old.__setstate__(state)
+    assert len(old._embeddings) == 2
+    assert "embedding" not in old._archive[0]
+    matches, _ = asyncio.run(old.search("dogs"))
+    assert matches[0]["content"] == "dogs bark loudly"
@@ -0,0 +1,162 @@
+import asyncio
+import importlib.util
+import json
+import os
+
+import faiss
+import numpy as np
+import pytest
+
+from memgpt.embeddings import (
+    DEFAULT_EMBEDDING_MODEL,
+    HashingEmbeddingProvider,
+    OpenAIEmbeddingProvider,
+    _feature_hash,
+    async_get_embedding,
+    async_get_embeddings,
+    get_embedding_provider,
+    is_local_embedding_model,
+)
+from memgpt.memory import DummyArchivalMemoryWithEmbeddings, DummyArchivalMemoryWithFaiss, MmapArchivalMemory
+from memgpt.persistence_manager import InMemoryStateManagerWithFaiss
+from memgpt.utils import ARCHIVAL_INDEX_INFO_FILE, build_faiss_index, read_archival_index_info
+
+from .test_faiss_index_types import write_index_folder
+
+
+def embed(model, texts):
+    return asyncio.run(async_get_embeddings(texts, model=model))
+
+
+def test_provider_lookup_is_shared():
+    assert get_embedding_provider("hashing-64") is get_embedding_provider("hashing-64")
+    assert isinstance(get_embedding_provider("hashing"), HashingEmbeddingProvider)
+    assert get_embedding_provider("hashing").dim == 1024
+    openai_provider = get_embedding_provider(DEFAULT_EMBEDDING_MODEL)
+    assert isinstance(openai_provider, OpenAIEmbeddingProvider)
+    assert openai_provider.dim == 1536 and not openai_provider.is_local
+
+
+def test_is_local_embedding_model():
+    assert is_local_embedding_model("hashing")
+    assert is_local_embedding_model("hashing-256")
+    assert is_local_embedding_model("sentence-transformers/all-MiniLM-L6-v2")
+    assert is_local_embedding_model("st:all-MiniLM-L6-v2")
+    assert not is_local_embedding_model(DEFAULT_EMBEDDING_MODEL)
+    assert not is_local_embedding_model(None)
+
+
+def test_hashing_embeddings(embedding_requests):
+    texts = ["the quick brown fox", "The quick brown fox!", "a quick brown dog", "quarterly tax report"]
+    embeddings = embed("hashing-256", texts)
+    assert embeddings.shape == (4, 256) and embeddings.dtype == np.float32
+    # case and punctuation don't matter, and the embeddings don't change between calls
+    np.testing.assert_array_equal(embeddings[0], embeddings[1])
+    np.testing.assert_array_equal(embeddings[0], embed("hashing-256", texts[:1])[0])
+    unit = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    assert unit[0] @ unit[2] > unit[0] @ unit[3]
+    assert embedding_requests == []
+
+
+def test_hashing_embedding_of_empty_text():
+    embedding = asyncio.run(async_get_embedding("", model="hashing-64"))
+    assert embedding.shape == (64,)
+    assert not embedding.any()
+
+
+def test_hashing_repeated_words_are_sublinear():
+    once, many = embed("hashing-64", ["cat", " ".join(["cat"] * 100)])
+    assert np.abs(many).max() < 10 * np.abs(once).max()
+
+
+def test_feature_hash_cache_is_bounded():
+    assert _feature_hash.cache_info().maxsize == 65536
+
+
+def test_no_texts():
+    assert embed("hashing-64", []).shape == (0, 64)
+    assert embed(DEFAULT_EMBEDDING_MODEL, []).shape == (0, 1536)
+
+
+def test_openai_provider_makes_requests(embedding_requests):
+    embeddings = embed(DEFAULT_EMBEDDING_MODEL, ["first text", "second text"])
+    assert embeddings.shape == (2, 1536)
+    assert embedding_requests == [["first text", "second text"]]
+
+
+@pytest.mark.skipif(importlib.util.find_spec("sentence_transformers") is not None, reason="sentence-transformers is installed")
+def test_sentence_transformers_is_optional():
+    with pytest.raises(ImportError, match="sentence-transformers"):
+        get_embedding_provider("sentence-transformers/not-installed")
+
+
+def test_local_model_archival_memory(embedding_requests):
+    memory = DummyArchivalMemoryWithEmbeddings(embedding_model="hashing-128")
+    for text in ["the cat sat on the mat", "stock prices fell sharply", "my cat likes the mat"]:
+        asyncio.run(memory.insert(text))
+    results, total = asyncio.run(memory.search("cat mat", count=2))
+    assert total == 3
+    assert {r["content"] for r in results} == {"the cat sat on the mat", "my cat likes the mat"}
+    assert embedding_requests == []
+
+
+def test_local_model_faiss_memory(embedding_requests):
+    memory = DummyArchivalMemoryWithFaiss(embedding_model="hashing-128")
+    assert memory.index.d == 128
+    for text in ["the cat sat on the mat", "stock prices fell sharply"]:
+        asyncio.run(memory.insert(text))
+    results, total = asyncio.run(memory.search("stock prices", count=1))
+    assert results[0]["content"] == "stock prices fell sharply"
+    assert embedding_requests == []
+
+
+def test_faiss_memory_rejects_index_of_another_model():
+    index = build_faiss_index(np.random.default_rng(0).normal(size=(10, 64)).astype(np.float32))
+    with pytest.raises(ValueError, match="64-dimensional"):
+        DummyArchivalMemoryWithFaiss(index=index, embedding_model=DEFAULT_EMBEDDING_MODEL)
+    assert DummyArchivalMemoryWithFaiss(index=index, embedding_model="hashing-64").index is index
+
+
+def test_mmap_memory_keeps_the_model_it_was_built_with(tmp_path, embedding_requests):
+    path = str(tmp_path / "archive")
+    memory = MmapArchivalMemory(path, embedding_model="hashing-64")
+    asyncio.run(memory.insert("the cat sat on the mat"))
+    assert memory.dim == 64
+    reopened = MmapArchivalMemory(path)
+    assert reopened.embedding_model == "hashing-64" and reopened.dim == 64
+    results, total = asyncio.run(reopened.search("cat", count=1))
+    assert results[0]["content"] == "the cat sat on the mat"
+    assert embedding_requests == []
+
+
+def test_index_info(tmp_path):
+    folder = str(tmp_path / "index")
+    os.makedirs(folder)
+    # folders built before the model was recorded were embedded with the openai model
+    assert read_archival_index_info(folder) == {"embedding_model": DEFAULT_EMBEDDING_MODEL, "embedding_dim": None}
+    with open(os.path.join(folder, ARCHIVAL_INDEX_INFO_FILE), "w") as f:
+        json.dump({"embedding_model": "hashing-64", "embedding_dim": 64, "index_type": "flat"}, f)
+    assert read_archival_index_info(folder)["embedding_model"] == "hashing-64"
+
+
+def test_cli_uses_the_model_the_index_was_built_with(tmp_path, run_main, embedding_requests):
+    folder = str(tmp_path / "index")
+    contents = ["the cat sat on the mat", "stock prices fell sharply"]
+    write_index_folder(folder, contents, "flat")
+    embeddings = embed("hashing-64", contents)
+    faiss.write_index(build_faiss_index(embeddings), os.path.join(folder, "all_docs.index"))
+    with open(os.path.join(folder, ARCHIVAL_INDEX_INFO_FILE), "w") as f:
+        json.dump({"embedding_model": "hashing-64", "embedding_dim": 64, "index_type": "flat"}, f)
+    agent = run_main(archival_storage_faiss_path=folder, embedding_model=DEFAULT_EMBEDDING_MODEL)
+    manager = agent.persistence_manager
+    assert isinstance(manager, InMemoryStateManagerWithFaiss)
+    assert manager.embedding_model == "hashing-64"
+    assert manager.archival_memory.index.d == 64
+    results, total = asyncio.run(manager.archival_memory.search("stock prices", count=1))
+    assert results[0]["content"].endswith("stock prices fell sharply")
+    assert embedding_requests == []
+
+
+def test_cli_embedding_model(tmp_path, run_main):
+    agent = run_main(archival_storage_mmap_path=str(tmp_path / "archive"), embedding_model="hashing-64")
+    assert agent.persistence_manager.archival_memory.embedding_model == "hashing-64"
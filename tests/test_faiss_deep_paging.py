@@ -0,0 +1,85 @@
+import asyncio
+
+import faiss
+import numpy as np
+
+from memgpt.memory import DummyArchivalMemoryWithFaiss
+
+from .conftest import fake_embedding
+
+
+def memory_with(contents, **kwargs):
+    memory = DummyArchivalMemoryWithFaiss(**kwargs)
+    for content in contents:
+        asyncio.run(memory.insert(content))
+    return memory
+
+
+def page_through(memory, query, count):
+    seen, start = [], 0
+    while True:
+        page, total = asyncio.run(memory.search(query, count=count, start=start))
+        if not page:
+            return seen, total
+        seen += [m["content"] for m in page]
+        start += count
+
+
+def test_pages_past_k():
+    contents = [f"note {i} about cats" for i in range(10)]
+    memory = memory_with(contents, k=2)
+    page, total = asyncio.run(memory.search("cats", count=3, start=6))
+    assert total == 10
+    assert len(page) == 3
+    seen, _ = page_through(memory, "cats", 3)
+    assert sorted(seen) == sorted(contents)
+
+
+def test_pages_stay_stable_with_tied_scores():
+    # identical texts have identical embeddings, so every score is tied
+    memory = DummyArchivalMemoryWithFaiss(k=2)
+    for i in range(9):
+        asyncio.run(memory.insert("same text", embedding=fake_embedding("same text")))
+        memory._archive[-1]["content"] = f"copy {i}"
+    seen, total = page_through(memory, "same text", 2)
+    assert total == 9
+    assert sorted(seen) == [f"copy {i}" for i in range(9)]
+
+
+def test_empty_archive():
+    memory = DummyArchivalMemoryWithFaiss()
+    assert asyncio.run(memory.search("anything")) == ([], 0)
+    assert asyncio.run(memory.search("anything", count=5, start=10)) == ([], 0)
+
+
+def test_page_past_the_end():
+    memory = memory_with(["the cat sat", "dogs bark loudly"], k=1)
+    assert asyncio.run(memory.search("cat", count=5, start=5)) == ([], 2)
+
+
+def test_similarity_threshold_makes_the_total_exact():
+    contents = ["cats"] + [f"unrelated topic {i}" for i in range(6)] + ["cats and more cats"]
+    memory = memory_with(contents, k=1, similarity_threshold=0.3)
+    matches, total = asyncio.run(memory.search("cats"))
+    assert total == 2
+    assert [m["content"] for m in matches] == ["cats", "cats and more cats"]
+
+
+def test_legacy_l2_index_threshold():
+    contents = ["cats", "dogs", "cats and more cats"]
+    embeddings = np.array([fake_embedding(c) for c in contents], dtype=np.float32)
+    index = faiss.IndexFlatL2(embeddings.shape[1])
+    # unit-length vectors, like OpenAI embeddings
+    index.add(embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True))
+    memory = DummyArchivalMemoryWithFaiss(index, [{"content": c, "timestamp": "t"} for c in contents], similarity_threshold=0.5)
+    matches, total = asyncio.run(memory.search("cats"))
+    assert total == 2
+    assert [m["content"] for m in matches] == ["cats", "cats and more cats"]
+
+
+def test_whole_archive_without_count():
+    contents = [f"note {i}" for i in range(5)]
+    memory = memory_with(contents, k=2)
+    matches, total = asyncio.run(memory.search("note"))
+    assert total == 5
+    assert sorted(m["content"] for m in matches) == contents
@@ -0,0 +1,90 @@
+import json
+import os
+
+import faiss
+import numpy as np
+import pytest
+
+from memgpt.memory import DummyArchivalMemoryWithFaiss
+from memgpt.persistence_manager import InMemoryStateManagerWithFaiss
+from memgpt.utils import build_faiss_index, faiss_index_is_cosine, make_faiss_index, prepare_archival_index, set_faiss_search_params
+
+from .conftest import fake_embedding
+
+
+def clustered_vectors(n=2000, dim=64, n_clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    return (centers[rng.integers(n_clusters, size=n)] + 0.1 * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf-flat", "ivf-pq", "hnsw"])
+def test_index_types_find_stored_vectors(index_type):
+    data = clustered_vectors()
+    index = build_faiss_index(data, index_type=index_type, pq_m=2)
+    assert index.ntotal == len(data)
+    assert faiss_index_is_cosine(index)
+    set_faiss_search_params(index, nprobe=64, ef_search=128)
+    queries = data[:20] / np.linalg.norm(data[:20], axis=1, keepdims=True)
+    scores, ids = index.search(queries, 1)
+    if index_type == "ivf-pq":
+        # compressed codes are approximate, the right cluster is what matters
+        assert (scores[:, 0] > 0.9).all()
+    else:
+        assert (ids[:, 0] == np.arange(20)).mean() >= 0.9
+        np.testing.assert_allclose(scores[:, 0], 1.0, atol=1e-3)
+
+
+def test_search_params():
+    data = clustered_vectors()
+    ivf = build_faiss_index(data, index_type="ivf-flat")
+    set_faiss_search_params(ivf, nprobe=7)
+    assert faiss.extract_index_ivf(ivf).nprobe == 7
+    hnsw = make_faiss_index(64, "hnsw")
+    set_faiss_search_params(hnsw, ef_search=99)
+    assert hnsw.hnsw.efSearch == 99
+    # ignored by indexes without the knobs
+    set_faiss_search_params(make_faiss_index(64, "flat"), nprobe=7, ef_search=99)
+
+
+def test_invalid_index_types():
+    with pytest.raises(ValueError):
+        make_faiss_index(64, "annoy")
+    with pytest.raises(ValueError):
+        make_faiss_index(100, "ivf-pq", n_vectors=1000, pq_m=64)
+
+
+def test_legacy_l2_index_is_not_cosine():
+    assert not faiss_index_is_cosine(faiss.IndexFlatL2(8))
+
+
+def test_empty_archive_starts_with_an_untrained_type_as_flat():
+    memory = DummyArchivalMemoryWithFaiss(index_type="ivf-flat")
+    assert memory.index.is_trained
+    assert memory.index.ntotal == 0
+
+
+def write_index_folder(folder, contents, index_type):
+    os.makedirs(folder, exist_ok=True)
+    embeddings = np.array([fake_embedding(c) for c in contents], dtype=np.float32)
+    faiss.write_index(build_faiss_index(embeddings, index_type=index_type), os.path.join(folder, "all_docs.index"))
+    with open(os.path.join(folder, "all_docs.jsonl"), "w") as f:
+        f.write(json.dumps([{"title": "doc", "text": c} for c in contents]) + "\n")
+
+
+def test_prepare_archival_index_sets_search_params(tmp_path):
+    folder = str(tmp_path / "index")
+    write_index_folder(folder, ["the cat sat", "dogs bark loudly"], "hnsw")
+    index, database = prepare_archival_index(folder, ef_search=77)
+    assert index.hnsw.efSearch == 77
+    assert [d["content"] for d in database] == ["[Title: doc, 0/2] the cat sat", "[Title: doc, 1/2] dogs bark loudly"]
+
+
+def test_cli_index_options(tmp_path, run_main):
+    folder = str(tmp_path / "index")
+    write_index_folder(folder, ["the cat sat", "dogs bark loudly"], "hnsw")
+    agent = run_main(archival_storage_faiss_path=folder, archival_index_type="hnsw", archival_index_ef_search=55)
+    assert isinstance(agent.persistence_manager, InMemoryStateManagerWithFaiss)
+    index = agent.persistence_manager.archival_memory.index
+    assert index.hnsw.efSearch == 55
+    assert index.ntotal == 2
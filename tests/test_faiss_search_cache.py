@@ -0,0 +1,97 @@
+import asyncio
+import pickle
+
+from memgpt.memory import DummyArchivalMemoryWithFaiss
+from memgpt.utils import LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_bytes=30)
+    cache.put("a", 1, nbytes=10)
+    cache.put("b", 2, nbytes=10)
+    cache.put("c", 3, nbytes=10)
+    assert cache.get("a") == 1
+    cache.put("d", 4, nbytes=10)
+    assert "b" not in cache
+    assert [key for key in "acd" if key in cache] == ["a", "c", "d"]
+    assert cache.current_bytes == 30
+
+
+def test_lru_cache_replaces_and_skips_oversized_entries():
+    cache = LRUCache(max_bytes=30)
+    cache.put("a", 1, nbytes=10)
+    cache.put("a", 2, nbytes=20)
+    assert (cache.get("a"), cache.current_bytes) == (2, 20)
+    cache.put("huge", 3, nbytes=31)
+    assert "huge" not in cache
+    assert "a" in cache
+
+
+def test_lru_cache_generations():
+    cache = LRUCache()
+    cache.put("q", [1, 2], nbytes=16, generation=1)
+    assert cache.get("q", generation=1) == [1, 2]
+    # a stale entry is a miss, and is dropped
+    assert cache.get("q", generation=2) is None
+    assert "q" not in cache
+    assert cache.get("q", generation=1) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+    cache.put("q", [1], nbytes=8)
+    cache.clear()
+    assert (len(cache), cache.current_bytes) == (0, 0)
+
+
+def memory_with(contents, **kwargs):
+    memory = DummyArchivalMemoryWithFaiss(**kwargs)
+    for content in contents:
+        asyncio.run(memory.insert(content))
+    return memory
+
+
+def test_insert_and_search():
+    memory = memory_with(["the cat sat", "dogs bark loudly", "a cat and a dog"], index_type="hnsw")
+    matches, _ = asyncio.run(memory.search("cat", count=2))
+    assert [m["content"] for m in matches] == ["the cat sat", "a cat and a dog"]
+    page, _ = asyncio.run(memory.search("cat", count=1, start=1))
+    assert [m["content"] for m in page] == ["a cat and a dog"]
+
+
+def test_repeated_query_is_served_from_the_cache(embedding_requests):
+    memory = memory_with(["the cat sat", "dogs bark loudly"])
+    first = asyncio.run(memory.search("cat", count=1))
+    n_requests = len(embedding_requests)
+    assert asyncio.run(memory.search("cat", count=1)) == first
+    assert len(embedding_requests) == n_requests
+    assert memory.search_results_cache.stats()["hits"] == 1
+
+
+def test_insert_invalidates_cached_results(embedding_requests):
+    memory = memory_with(["the cat sat", "dogs bark loudly"])
+    assert asyncio.run(memory.search("birds", count=1))[0][0]["content"] != "birds sing"
+    asyncio.run(memory.insert("birds sing"))
+    n_requests = len(embedding_requests)
+    assert asyncio.run(memory.search("birds", count=1))[0][0]["content"] == "birds sing"
+    # the query embedding is still valid, only the results were recomputed
+    assert len(embedding_requests) == n_requests
+
+
+def test_caches_are_bounded():
+    memory = memory_with(["the cat sat"], cache_max_bytes=4 * 8192)
+    for i in range(20):
+        asyncio.run(memory.search(f"query {i}", count=1))
+    assert memory.query_embedding_cache.current_bytes <= 2 * 8192
+    assert memory.search_results_cache.current_bytes <= 2 * 8192
+    assert len(memory.query_embedding_cache) < 20
+
+
+def test_load_memory_pickled_with_unbounded_dicts():
+    memory = memory_with(["the cat sat", "dogs bark loudly"])
+    state = {key: value for key, value in memory.__dict__.items() if key not in ["query_embedding_cache", "search_results_cache", "generation"]}
+    state["embeddings_dict"] = {"cat": [0.0] * 1536}
+    state["search_results"] = {"cat": []}
+    old = DummyArchivalMemoryWithFaiss.__new__(DummyArchivalMemoryWithFaiss)
+    old.__setstate__(pickle.loads(pickle.dumps(state)))
+    assert "embeddings_dict" not in old.__dict__
+    assert "search_results" not in old.__dict__
+    assert asyncio.run(old.search("dogs", count=1))[0][0]["content"] == "dogs bark loudly"
@@ -0,0 +1,236 @@
+import asyncio
+import os
+import pickle
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from memgpt.faiss_store import FaissIndexStore
+from memgpt.memory import DummyArchivalMemory, DummyArchivalMemoryHybrid, DummyArchivalMemoryWithFaiss
+from memgpt.persistence_manager import InMemoryStateManager, InMemoryStateManagerWithFaiss
+from memgpt.utils import build_faiss_index
+
+from .conftest import fake_embedding
+
+
+def records(contents):
+    return [{"timestamp": "2023-10-01 09:00:00 AM PDT-0700", "content": c} for c in contents]
+
+
+def embeddings_of(contents):
+    return np.array([fake_embedding(c, dim=16) for c in contents], dtype=np.float32)
+
+
+def words(prefix, n):
+    return [f"{prefix} {i}" for i in range(n)]
+
+
+def contents_of(memories):
+    return [m["content"] for m in memories]
+
+
+def new_store(tmp_path, contents, **kwargs):
+    store = FaissIndexStore(str(tmp_path / "store"), **kwargs)
+    return store, store.write_base(build_faiss_index(embeddings_of(contents)), records(contents))
+
+
+def test_base_and_segments(tmp_path):
+    store, base = new_store(tmp_path, words("base", 3))
+    first = store.append_segment(base, embeddings_of(words("one", 2)), records(words("one", 2)))
+    second = store.append_segment(first, embeddings_of(words("two", 1)), records(words("two", 1)))
+    index, memories, manifest = store.load(second)
+    assert contents_of(memories) == words("base", 3) + words("one", 2) + words("two", 1)
+    assert index.ntotal == 6 and FaissIndexStore.count(manifest) == 6
+    # generations never change, older ones still load as they were saved
+    assert contents_of(store.load(first)[1]) == words("base", 3) + words("one", 2)
+    assert store.load(base)[0].ntotal == 3
+    # nothing new, nothing written
+    assert store.append_segment(second, embeddings_of([]), []) == second
+
+
+def test_branching_off_an_older_generation(tmp_path):
+    store, base = new_store(tmp_path, words("base", 2))
+    first = store.append_segment(base, embeddings_of(["left"]), records(["left"]))
+    branch = store.append_segment(base, embeddings_of(["right"]), records(["right"]))
+    assert contents_of(store.load(first)[1]) == words("base", 2) + ["left"]
+    assert contents_of(store.load(branch)[1]) == words("base", 2) + ["right"]
+
+
+def test_missing_generation(tmp_path):
+    store, base = new_store(tmp_path, words("base", 2))
+    with pytest.raises(FileNotFoundError):
+        store.load(base + 100)
+
+
+def test_merge_is_size_tiered(tmp_path):
+    store, generation = new_store(tmp_path, words("base", 100), max_segments=100)
+    expected = words("base", 100)
+    for i, size in enumerate([9, 5, 3, 1, 1]):
+        generation = store.append_segment(generation, embeddings_of(words(f"s{i}", size)), records(words(f"s{i}", size)))
+        expected += words(f"s{i}", size)
+    store.merge(generation)
+    merged = store._merged(generation)
+    assert merged != generation
+    # the two newest segments are merged, the older (bigger) ones are kept
+    assert [s["count"] for s in store.read_manifest(merged)["segments"]] == [9, 5, 3, 2]
+    index, memories, _ = store.load(generation)
+    assert contents_of(memories) == expected and index.ntotal == len(expected)
+    # later segments build on the merged copy
+    child = store.append_segment(generation, embeddings_of(["new"]), records(["new"]))
+    assert [s["count"] for s in store.read_manifest(child)["segments"]] == [9, 5, 3, 2, 1]
+    assert contents_of(store.load(child)[1]) == expected + ["new"]
+
+
+def test_merge_folds_big_segments_into_a_new_base(tmp_path):
+    store, generation = new_store(tmp_path, words("base", 2), max_segments=100)
+    for i in range(3):
+        generation = store.append_segment(generation, embeddings_of(words(f"s{i}", 2)), records(words(f"s{i}", 2)))
+    store.merge(generation)
+    merged = store.read_manifest(store._merged(generation))
+    assert merged["segments"] == [] and merged["base_count"] == 8
+    assert store.load(generation)[0].ntotal == 8
+
+
+def test_merge_runs_in_the_background(tmp_path):
+    store, generation = new_store(tmp_path, words("base", 50), max_segments=2)
+    for i in range(3):
+        generation = store.append_segment(generation, embeddings_of([f"s{i}"]), records([f"s{i}"]))
+    store.wait()
+    assert store._merged(generation) != generation
+    assert contents_of(store.load(generation)[1]) == words("base", 50) + ["s0", "s1", "s2"]
+
+
+def test_garbage_collection_keeps_pinned_generations(tmp_path):
+    store, base = new_store(tmp_path, words("base", 2))
+    first = store.append_segment(base, embeddings_of(["a"]), records(["a"]))
+    second = store.append_segment(first, embeddings_of(["b"]), records(["b"]))
+    third = store.append_segment(second, embeddings_of(["c"]), records(["c"]))
+    checkpoints = {generation: str(tmp_path / f"checkpoint-{generation}") for generation in [first, second]}
+    for generation, checkpoint_file in checkpoints.items():
+        open(checkpoint_file, "w").close()
+        store.pin(checkpoint_file, generation)
+    # nothing pinned the base (but its files are still used), the newest generation is always kept
+    assert store.collect_garbage() == 1
+    assert not os.path.exists(store._file(f"manifest-{base}.json"))
+    os.remove(checkpoints[first])
+    assert store.collect_garbage() == 1
+    assert contents_of(store.load(second)[1]) == words("base", 2) + ["a", "b"]
+    assert contents_of(store.load(third)[1]) == words("base", 2) + ["a", "b", "c"]
+    with pytest.raises(FileNotFoundError):
+        store.load(first)
+
+
+def test_garbage_collection_of_merged_segments(tmp_path):
+    store, generation = new_store(tmp_path, words("base", 20), max_segments=100)
+    for i in range(4):
+        generation = store.append_segment(generation, embeddings_of([f"s{i}"]), records([f"s{i}"]))
+    store.merge(generation)
+    checkpoint_file = str(tmp_path / "checkpoint")
+    open(checkpoint_file, "w").close()
+    store.pin(checkpoint_file, generation)
+    store.collect_garbage()
+    # only the base and the merged segment are left
+    data_files = sorted(f for f in os.listdir(store.path) if f.endswith(".npy") or f.endswith(".index"))
+    assert len(data_files) == 2
+    assert contents_of(store.load(generation)[1]) == words("base", 20) + ["s0", "s1", "s2", "s3"]
+    assert FaissIndexStore(store.path).collect_garbage() == 0
+
+
+def test_empty_store(tmp_path):
+    assert FaissIndexStore(str(tmp_path / "store")).collect_garbage() == 0
+
+
+def faiss_memory(contents):
+    return DummyArchivalMemoryWithFaiss(index=build_faiss_index(embeddings_of(contents)), archival_memory_database=records(contents), embedding_model="hashing-16")
+
+
+def test_checkpointed_memory_pickles_without_its_index(tmp_path):
+    memory = faiss_memory(words("base", 50))
+    generation = memory.checkpoint(str(tmp_path / "store"))
+    asyncio.run(memory.insert("new memory", embedding=fake_embedding("new memory", dim=16)))
+    with pytest.raises(RuntimeError, match="checkpoint"):
+        pickle.dumps(memory)
+    assert memory.checkpoint() != generation
+    data = pickle.dumps(memory)
+    assert b"base 49" not in data
+    unpickled = pickle.loads(data)
+    assert contents_of(unpickled._archive) == words("base", 50) + ["new memory"]
+    assert unpickled.index.ntotal == 51
+    expected = embeddings_of(["base 7", "new memory"])
+    np.testing.assert_allclose(unpickled.index.reconstruct_n(0, 51)[[7, 50]], expected / np.linalg.norm(expected, axis=1, keepdims=True), atol=1e-6)
+
+
+def test_unpickling_a_deleted_generation(tmp_path):
+    memory = faiss_memory(words("base", 5))
+    memory.checkpoint(str(tmp_path / "store"))
+    data = pickle.dumps(memory)
+    for filename in os.listdir(str(tmp_path / "store")):
+        if filename.startswith("manifest-"):
+            os.remove(str(tmp_path / "store" / filename))
+    with pytest.raises(FileNotFoundError):
+        pickle.loads(data)
+
+
+def faiss_manager(contents, hybrid_search=False):
+    manager = InMemoryStateManagerWithFaiss(build_faiss_index(embeddings_of(contents)), records(contents), hybrid_search=hybrid_search, embedding_model="hashing-16")
+    manager.init(SimpleNamespace(messages=[{"role": "system", "content": "system prompt"}], memory=None))
+    return manager
+
+
+def archive_of(manager):
+    return contents_of(getattr(manager.archival_memory, "vector_memory", manager.archival_memory)._archive)
+
+
+def test_manager_saves_incrementally(tmp_path):
+    manager = faiss_manager(words("base", 20))
+    first = str(tmp_path / "first.persistence.pickle")
+    manager.save(first)
+    store_path = str(tmp_path / "first.persistence.archival")
+    assert manager.archival_store_path == store_path
+    asyncio.run(manager.archival_memory.insert("added later", embedding=fake_embedding("added later", dim=16)))
+    second = str(tmp_path / "second.persistence.pickle")
+    manager.save(second)
+    # the second save only wrote the new memory
+    manifest = FaissIndexStore(store_path).read_manifest(manager.archival_store_generation)
+    assert manifest["base_count"] == 20 and manifest["segments"][0]["count"] == 1
+    assert archive_of(InMemoryStateManager.load(first)) == words("base", 20)
+    assert archive_of(InMemoryStateManager.load(second)) == words("base", 20) + ["added later"]
+
+
+def test_manager_branches_off_an_older_checkpoint(tmp_path):
+    manager = faiss_manager(words("base", 5))
+    first = str(tmp_path / "first.persistence.pickle")
+    manager.save(first)
+    asyncio.run(manager.archival_memory.insert("on main", embedding=fake_embedding("on main", dim=16)))
+    manager.save(str(tmp_path / "main.persistence.pickle"))
+    branch = InMemoryStateManager.load(first)
+    asyncio.run(branch.archival_memory.insert("on branch", embedding=fake_embedding("on branch", dim=16)))
+    branch.save(str(tmp_path / "branch.persistence.pickle"))
+    assert archive_of(InMemoryStateManager.load(str(tmp_path / "main.persistence.pickle"))) == words("base", 5) + ["on main"]
+    assert archive_of(InMemoryStateManager.load(str(tmp_path / "branch.persistence.pickle"))) == words("base", 5) + ["on branch"]
+    assert archive_of(InMemoryStateManager.load(first)) == words("base", 5)
+
+
+def test_manager_collects_deleted_checkpoints(tmp_path):
+    manager = faiss_manager(words("base", 5))
+    first = str(tmp_path / "first.persistence.pickle")
+    manager.save(first)
+    first_generation = manager.archival_store_generation
+    os.remove(first)
+    asyncio.run(manager.archival_memory.insert("later", embedding=fake_embedding("later", dim=16)))
+    manager.save(str(tmp_path / "second.persistence.pickle"))
+    assert not os.path.exists(os.path.join(manager.archival_store_path, f"manifest-{first_generation}.json"))
+    assert archive_of(InMemoryStateManager.load(str(tmp_path / "second.persistence.pickle"))) == words("base", 5) + ["later"]
+
+
+def test_hybrid_manager_rebuilds_the_keyword_index(tmp_path):
+    manager = faiss_manager(["the cat sat", "dogs bark loudly"], hybrid_search=True)
+    filename = str(tmp_path / "agent.persistence.pickle")
+    manager.save(filename)
+    loaded = InMemoryStateManager.load(filename)
+    assert isinstance(loaded.archival_memory, DummyArchivalMemoryHybrid)
+    assert isinstance(loaded.archival_memory.lexical_memory, DummyArchivalMemory)
+    assert loaded.archival_memory._archive is loaded.archival_memory.vector_memory._archive
+    results, total = asyncio.run(loaded.archival_memory.lexical_memory.search("dogs"))
+    assert (total, results[0]["content"]) == (1, "dogs bark loudly")
@@ -0,0 +1,91 @@
+import asyncio
+import pickle
+from types import SimpleNamespace
+
+from memgpt.memory import DummyArchivalMemoryHybrid, DummyArchivalMemoryWithEmbeddings, DummyArchivalMemoryWithFaiss
+from memgpt.persistence_manager import InMemoryStateManagerWithEmbeddings
+
+from .conftest import fake_embedding
+from .test_faiss_index_types import write_index_folder
+
+
+def hybrid_with(memories, vector_memory=None):
+    """memories: (content, text the embedding is made of) pairs"""
+    memory = DummyArchivalMemoryHybrid(vector_memory or DummyArchivalMemoryWithEmbeddings())
+    for content, embedded_text in memories:
+        asyncio.run(memory.insert(content, embedding=fake_embedding(embedded_text)))
+    return memory
+
+
+def search(memory, query, **kwargs):
+    matches, total = asyncio.run(memory.search(query, **kwargs))
+    return [m["content"] for m in matches], total
+
+
+MEMORIES = [
+    # the embedding misses the identifier, only the keyword search finds it
+    ("the build failed with error E1234", "compiler problems"),
+    ("deploy failed again", "deploy failed again error"),
+    ("lunch was great", "lunch was great"),
+]
+
+
+def test_fuses_keyword_and_vector_results():
+    memory = hybrid_with(MEMORIES)
+    contents, total = search(memory, "error E1234")
+    assert total == 3
+    # found by both searches
+    assert contents[0] in ["the build failed with error E1234", "deploy failed again"]
+    assert set(contents[:2]) == {"the build failed with error E1234", "deploy failed again"}
+
+
+def test_agreeing_rankings_win():
+    memory = hybrid_with([("red apple", "red apple"), ("green apple", "green apple"), ("red car", "red car")])
+    assert search(memory, "red apple")[0][0] == "red apple"
+
+
+def test_pages_follow_the_fused_ranking():
+    memory = hybrid_with([(f"note {i} about apples", f"note {i} apples") for i in range(6)])
+    ranking, total = search(memory, "apples")
+    assert total == 6
+    pages = [search(memory, "apples", count=2, start=start)[0] for start in range(0, 6, 2)]
+    assert sum(pages, []) == ranking
+    assert search(memory, "apples", count=2, start=10)[0] == []
+
+
+def test_empty_archive():
+    assert search(hybrid_with([]), "anything") == ([], 0)
+
+
+def test_inserts_reach_both_indexes_and_survive_reload():
+    memory = hybrid_with(MEMORIES[:1])
+    asyncio.run(memory.insert("the cache is cold"))
+    assert len(memory) == 2
+    assert search(memory, "cache")[0][0] == "the cache is cold"
+    loaded = pickle.loads(pickle.dumps(memory))
+    assert search(loaded, "E1234") == search(memory, "E1234")
+    asyncio.run(loaded.insert("a warm cache"))
+    assert "a warm cache" in search(loaded, "warm")[0]
+    assert len(loaded.vector_memory) == 3
+
+
+def test_wraps_a_faiss_memory():
+    memory = hybrid_with(MEMORIES, vector_memory=DummyArchivalMemoryWithFaiss())
+    contents, total = search(memory, "error E1234", count=2)
+    assert set(contents) == {"the build failed with error E1234", "deploy failed again"}
+
+
+def test_manager_option():
+    agent = SimpleNamespace(messages=[{"role": "system", "content": "system prompt"}], memory=None)
+    manager = InMemoryStateManagerWithEmbeddings(hybrid_search=True)
+    manager.init(agent)
+    assert isinstance(manager.archival_memory, DummyArchivalMemoryHybrid)
+
+
+def test_cli_option(tmp_path, run_main):
+    folder = str(tmp_path / "index")
+    write_index_folder(folder, ["the cat sat", "dogs bark loudly"], "flat")
+    agent = run_main(archival_storage_faiss_path=folder, archival_hybrid_search=True)
+    archival_memory = agent.persistence_manager.archival_memory
+    assert isinstance(archival_memory, DummyArchivalMemoryHybrid)
+    assert search(archival_memory, "dogs", count=1)[0] == ["[Title: doc, 1/2] dogs bark loudly"]
@@ -0,0 +1,95 @@
+import asyncio
+import random
+
+import openai
+import pytest
+
+from memgpt.memory import DummyArchivalMemory, DummyArchivalMemoryHybrid, DummyArchivalMemoryWithEmbeddings, DummyArchivalMemoryWithFaiss, MmapArchivalMemory
+from memgpt.openai_tools import async_get_embeddings_with_backoff
+from memgpt.utils import process_concurrently
+
+from .conftest import fake_embedding
+
+
+CONTENTS = ["the cat sat", "dogs bark loudly", "a cat and a dog", "weather report", "birds sing"]
+
+
+def test_batched_embeddings_keep_their_order(monkeypatch):
+    in_flight, max_in_flight, batch_sizes = [0], [0], []
+
+    async def acreate(input, model, **kwargs):
+        batch_sizes.append(len(input))
+        in_flight[0] += 1
+        max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        data = [{"index": i, "embedding": fake_embedding(text)} for i, text in enumerate(input)]
+        # the API doesn't promise any order
+        random.Random(len(batch_sizes)).shuffle(data)
+        return {"data": data}
+
+    monkeypatch.setattr(openai.Embedding, "acreate", staticmethod(acreate))
+    texts = [f"text number {i}" for i in range(25)]
+    embeddings = asyncio.run(async_get_embeddings_with_backoff(texts, batch_size=4, concurrency=2))
+    assert [list(e) for e in embeddings] == [fake_embedding(text) for text in texts]
+    assert sorted(batch_sizes) == [1] + [4] * 6
+    assert max_in_flight[0] == 2
+
+
+def test_no_texts():
+    assert list(asyncio.run(async_get_embeddings_with_backoff([]))) == []
+
+
+def test_process_concurrently():
+    database = [{"content": content} for content in CONTENTS]
+    embeddings = asyncio.run(process_concurrently(database, "text-embedding-ada-002", concurrency=2, batch_size=2))
+    assert [list(e) for e in embeddings] == [fake_embedding(content) for content in CONTENTS]
+
+
+def archival_memories(tmp_path):
+    return {
+        "text": lambda: DummyArchivalMemory(),
+        "embeddings": lambda: DummyArchivalMemoryWithEmbeddings(),
+        "faiss": lambda: DummyArchivalMemoryWithFaiss(),
+        "mmap": lambda: MmapArchivalMemory(str(tmp_path / f"archive-{random.random()}")),
+        "hybrid": lambda: DummyArchivalMemoryHybrid(DummyArchivalMemoryWithEmbeddings()),
+    }
+
+
+@pytest.mark.parametrize("kind", ["text", "embeddings", "faiss", "mmap", "hybrid"])
+def test_insert_many_matches_single_inserts(kind, tmp_path, embedding_requests):
+    make = archival_memories(tmp_path)[kind]
+    one_by_one = make()
+    for content in CONTENTS:
+        asyncio.run(one_by_one.insert(content, embedding=None if kind == "text" else fake_embedding(content)))
+    bulk = make()
+    asyncio.run(bulk.insert_many(CONTENTS))
+    # one request for the whole batch
+    assert embedding_requests == ([] if kind == "text" else [CONTENTS])
+    assert len(bulk) == len(CONTENTS)
+    for query in ["cat", "dogs", "birds"]:
+        assert [m["content"] for m in asyncio.run(bulk.search(query, count=3))[0]] == [m["content"] for m in asyncio.run(one_by_one.search(query, count=3))[0]]
+
+
+@pytest.mark.parametrize("kind", ["embeddings", "faiss", "mmap", "hybrid"])
+def test_insert_many_with_given_embeddings(kind, tmp_path, embedding_requests):
+    memory = archival_memories(tmp_path)[kind]()
+    asyncio.run(memory.insert_many(CONTENTS, embeddings=[fake_embedding(content) for content in CONTENTS]))
+    assert embedding_requests == []
+    asyncio.run(memory.insert_many(["zebras run"]))
+    assert len(memory) == len(CONTENTS) + 1
+    assert asyncio.run(memory.search("zebras", count=1))[0][0]["content"] == "zebras run"
+
+
+@pytest.mark.parametrize("kind", ["text", "embeddings", "mmap", "hybrid"])
+def test_insert_many_nothing(kind, tmp_path):
+    memory = archival_memories(tmp_path)[kind]()
+    asyncio.run(memory.insert_many(CONTENTS[:1]))
+    asyncio.run(memory.insert_many([]))
+    assert len(memory) == 1
+
+
+def test_text_memory_rejects_embeddings():
+    with pytest.raises(ValueError):
+        asyncio.run(DummyArchivalMemory().insert_many(["the cat sat"], embeddings=[fake_embedding("the cat sat")]))
+
@@ -0,0 +1,156 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+from memgpt.journal import MessageJournal
+from memgpt.persistence_manager import InMemoryStateManager
+
+from .test_faiss_store import archive_of, faiss_manager, words
+from .test_message_journal import contents_of, new_journal
+from .test_recall_text_search import message
+
+
+LAZY = ["all_messages", "recall_memory", "archival_memory"]
+
+
+def saved_manager(tmp_path, n_messages=50):
+    agent_messages = [{"role": "system", "content": "system prompt"}]
+    manager = InMemoryStateManager()
+    manager.init(SimpleNamespace(messages=agent_messages, memory=None))
+    added = [{"role": "user", "content": f"message number {i}"} for i in range(n_messages)]
+    manager.append_to_messages(added)
+    agent_messages.extend(added)
+    asyncio.run(manager.archival_memory.insert("the cat sat on the mat"))
+    filename = str(tmp_path / "agent.persistence.pickle")
+    manager.save(filename)
+    manager.close()
+    return filename
+
+
+def test_resuming_only_loads_the_window(tmp_path):
+    loaded = InMemoryStateManager.load(saved_manager(tmp_path))
+    try:
+        assert [msg["content"] for msg in loaded.messages][-1] == "message number 49"
+        assert all(name not in loaded.__dict__ for name in LAZY)
+        # each part is loaded on first use
+        assert asyncio.run(loaded.recall_memory.text_search("number 7"))[1] == 1
+        assert "all_messages" in loaded.__dict__ and "archival_memory" not in loaded.__dict__
+        assert asyncio.run(loaded.archival_memory.search("cat"))[1] == 1
+        # the log holds the window's message objects
+        assert loaded.all_messages[-1]["message"] is loaded.messages[-1]
+    finally:
+        loaded.close()
+
+
+def test_messages_logged_before_the_log_is_loaded(tmp_path):
+    loaded = InMemoryStateManager.load(saved_manager(tmp_path))
+    try:
+        window = [dict(msg) for msg in loaded.messages]
+        loaded.link_messages(window)
+        added = [{"role": "user", "content": "logged while lazy"}]
+        loaded.append_to_messages(added)
+        window.extend(added)
+        assert "all_messages" not in loaded.__dict__
+        matches, total = asyncio.run(loaded.recall_memory.text_search("while lazy"))
+        assert total == 1 and matches[0]["message"] is window[-1]
+        assert len(loaded.all_messages) == 52
+    finally:
+        loaded.close()
+
+
+def test_recovering_before_the_log_is_loaded(tmp_path):
+    filename = saved_manager(tmp_path)
+    crashed = InMemoryStateManager.load(filename)
+    crashed.append_to_messages([{"role": "user", "content": "not saved"}])
+    crashed.messages.append({"role": "user", "content": "not saved"})
+    crashed.close()
+    loaded = InMemoryStateManager.load(filename)
+    try:
+        assert loaded.recover() == 1
+        assert "all_messages" not in loaded.__dict__
+        assert loaded.messages[-1]["content"] == "not saved"
+        assert contents_of(loaded.all_messages)[-2:] == ["message number 49", "not saved"]
+    finally:
+        loaded.close()
+
+
+def test_recall_options_apply_once_recall_memory_is_loaded(tmp_path):
+    loaded = InMemoryStateManager.load(saved_manager(tmp_path))
+    try:
+        loaded.configure_recall(restrict_search_to_summaries=True)
+        assert "recall_memory" not in loaded.__dict__
+        assert loaded.recall_memory.restrict_search_to_summaries
+    finally:
+        loaded.close()
+
+
+def test_saving_again_without_loading_the_parts(tmp_path):
+    loaded = InMemoryStateManager.load(saved_manager(tmp_path))
+    loaded.append_to_messages([{"role": "user", "content": "added after resuming"}])
+    loaded.messages.append({"role": "user", "content": "added after resuming"})
+    second = str(tmp_path / "second.persistence.pickle")
+    loaded.save(second)
+    assert all(name not in loaded.__dict__ for name in LAZY)
+    loaded.close()
+    loaded = InMemoryStateManager.load(second)
+    try:
+        assert contents_of(loaded.all_messages)[-1] == "added after resuming"
+        assert asyncio.run(loaded.recall_memory.text_search("after resuming"))[1] == 1
+        assert asyncio.run(loaded.archival_memory.search("cat"))[1] == 1
+    finally:
+        loaded.close()
+
+
+def test_faiss_manager_resumes_lazily(tmp_path):
+    manager = faiss_manager(words("base", 10))
+    first = str(tmp_path / "first.persistence.pickle")
+    manager.save(first)
+    loaded = InMemoryStateManager.load(first)
+    assert "archival_memory" not in loaded.__dict__
+    second = str(tmp_path / "second.persistence.pickle")
+    loaded.save(second)
+    assert "archival_memory" not in loaded.__dict__
+    loaded.close()
+    loaded = InMemoryStateManager.load(second)
+    try:
+        assert archive_of(loaded) == words("base", 10)
+    finally:
+        loaded.close()
+
+
+def test_journal_reads_messages_by_id(tmp_path):
+    journal = new_journal(tmp_path, n_messages=100)
+    journal.log_append([message("user", "appended")])
+    assert contents_of(journal.read_messages([99, 3, 100])) == ["message 99", "message 3", "appended"]
+    context, context_ids, n_messages, seq = journal.load_context()
+    assert (context_ids[-1], n_messages, seq) == (100, 101, journal.seq)
+    assert contents_of(context) == ["system prompt"] + [f"message {i}" for i in range(1, 100)] + ["appended"]
+    assert contents_of(journal.read_history(3)) == ["system prompt", "message 1", "message 2"]
+    journal.close()
+
+
+def test_journals_without_an_index_get_one(tmp_path):
+    journal = new_journal(tmp_path, n_messages=10)
+    journal.log_append([message("user", "appended")])
+    journal.close()
+    os.remove(os.path.join(journal.path, MessageJournal.INDEX_FILE))
+    journal = MessageJournal(journal.path)
+    assert journal.n_messages == 11
+    assert contents_of(journal.read_messages([10, 0])) == ["appended", "system prompt"]
+    journal.close()
+
+
+def test_a_message_without_its_index_entry_is_dropped(tmp_path):
+    journal = new_journal(tmp_path, n_messages=3)
+    journal.close()
+    # the process died after writing a message, before (fully) writing its offset
+    with open(os.path.join(journal.path, MessageJournal.HISTORY_FILE), "ab") as f:
+        f.write((MessageJournal._dumps(message("user", "lost")) + "\n").encode("utf-8"))
+    with open(os.path.join(journal.path, MessageJournal.INDEX_FILE), "ab") as f:
+        f.write(b"\x00\x01")
+    journal = MessageJournal(journal.path)
+    assert journal.n_messages == 3
+    journal.log_append([message("user", "next")])
+    assert contents_of(journal.read_messages([3])) == ["next"]
+    assert contents_of(journal.load()[0]) == ["system prompt", "message 1", "message 2", "next"]
+    journal.close()
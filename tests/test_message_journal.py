@@ -0,0 +1,253 @@
+import json
+import os
+import random
+
+import pytest
+
+import memgpt.main
+from memgpt.journal import MessageJournal, load_context_messages
+from memgpt.persistence_manager import InMemoryStateManager
+
+from .test_recall_text_search import message
+from .test_sqlite_state_manager import Agent
+
+
+def contents_of(messages):
+    return [d["message"]["content"] for d in messages]
+
+
+def new_journal(tmp_path, n_messages=2, **kwargs):
+    messages = [message("system", "system prompt")] + [message("user", f"message {i}") for i in range(1, n_messages)]
+    return MessageJournal.create(str(tmp_path / "agent.journal"), messages, list(range(n_messages)), **kwargs)
+
+
+class Window(object):
+    """The context window and the history a journal should hold, kept in plain lists"""
+
+    def __init__(self, n_messages=2):
+        self.history = ["system prompt"] + [f"message {i}" for i in range(1, n_messages)]
+        self.context = list(self.history)
+
+    def apply(self, journal, op, *contents):
+        messages = [message("user", content) for content in contents]
+        if op == "append":
+            journal.log_append(messages)
+            self.context += contents
+        elif op == "prepend":
+            journal.log_prepend(messages)
+            self.context[1:1] = contents
+        elif op == "swap":
+            journal.log_swap(messages[0])
+            self.context[0] = contents[0]
+        self.history += contents
+
+    def trim(self, journal, num):
+        journal.log_trim(num)
+        del self.context[1:num]
+
+
+def random_ops(journal, window, rng, n):
+    for i in range(n):
+        op = rng.choice(["append", "append", "prepend", "swap", "trim"])
+        if op == "trim":
+            window.trim(journal, rng.randint(1, len(window.context)))
+        elif op == "swap":
+            window.apply(journal, op, f"system prompt {i}")
+        else:
+            window.apply(journal, op, *[f"{op} {i}.{j}" for j in range(rng.randint(1, 3))])
+
+
+def assert_loads(journal, window, seq=None):
+    all_messages, context, _ = journal.load(seq)
+    assert contents_of(all_messages) == window.history
+    assert contents_of(context) == window.context
+    # the context window holds the same dicts as the history
+    assert all(any(d is m for m in all_messages) for d in context)
+
+
+@pytest.mark.parametrize("snapshot_every", [1000, 3])
+def test_replay_matches_the_operations(tmp_path, snapshot_every):
+    journal = new_journal(tmp_path, snapshot_every=snapshot_every)
+    window = Window()
+    random_ops(journal, window, random.Random(0), 50)
+    assert_loads(journal, window)
+    journal.close()
+    # and after reopening
+    journal = MessageJournal(journal.path)
+    assert_loads(journal, window)
+    assert len(journal.context_ids) == len(window.context)
+    journal.close()
+    if snapshot_every == 3:
+        assert len([f for f in os.listdir(journal.path) if f.startswith("snapshot-")]) > 10
+
+
+@pytest.mark.parametrize("snapshot_every", [1000, 3])
+def test_every_checkpoint_can_be_loaded(tmp_path, snapshot_every):
+    journal = new_journal(tmp_path, snapshot_every=snapshot_every)
+    window = Window()
+    rng = random.Random(1)
+    checkpoints = []
+    for _ in range(5):
+        random_ops(journal, window, rng, rng.randint(1, 6))
+        checkpoints.append((journal.checkpoint(), list(window.history), list(window.context)))
+    journal.close()
+    journal = MessageJournal(journal.path, snapshot_every=snapshot_every)
+    for seq, history, context in checkpoints:
+        window.history, window.context = history, context
+        assert_loads(journal, window, seq)
+        assert [m["content"] for m in load_context_messages(journal.path, seq)] == context
+    assert journal.saved_seq == checkpoints[-1][0]
+    journal.close()
+
+
+def test_saving_twice_in_a_row_is_one_checkpoint(tmp_path):
+    journal = new_journal(tmp_path)
+    first = journal.checkpoint()
+    assert journal.checkpoint() == first
+    journal.log_append([message("user", "hello")])
+    assert journal.checkpoint() == first + 2
+    journal.close()
+
+
+def test_history_is_only_appended_to(tmp_path):
+    journal = new_journal(tmp_path, n_messages=100)
+    history_file = os.path.join(journal.path, MessageJournal.HISTORY_FILE)
+    size = os.path.getsize(history_file)
+    journal.log_append([message("user", "hello")])
+    journal.checkpoint()
+    # one line more, the rest of the history wasn't rewritten
+    assert os.path.getsize(history_file) - size == len(MessageJournal._dumps(message("user", "hello"))) + 1
+    journal.close()
+
+
+def test_creating_a_journal_twice(tmp_path):
+    new_journal(tmp_path).close()
+    with pytest.raises(FileExistsError):
+        new_journal(tmp_path)
+
+
+def test_torn_lines_are_dropped(tmp_path):
+    journal = new_journal(tmp_path)
+    window = Window()
+    window.apply(journal, "append", "kept")
+    journal.checkpoint()
+    journal.close()
+    # the process died while writing a message, and while writing an operation
+    with open(os.path.join(journal.path, MessageJournal.HISTORY_FILE), "ab") as f:
+        f.write(b'{"timestamp": "2023-10-01 09:00:00 AM PDT-0700", "mess')
+    ops_file = max((f for f in os.listdir(journal.path) if f.startswith("ops-")), key=lambda f: int(f[4:-6]))
+    with open(os.path.join(journal.path, ops_file), "a") as f:
+        f.write('{"seq": 99, "op": "app')
+    journal = MessageJournal(journal.path)
+    assert_loads(journal, window)
+    # and it keeps working
+    window.apply(journal, "append", "after the crash")
+    journal.close()
+    journal = MessageJournal(journal.path)
+    assert_loads(journal, window)
+    journal.close()
+
+
+def test_the_api_response_is_not_logged(tmp_path):
+    journal = new_journal(tmp_path)
+    journal.log_append([{"timestamp": "2023-10-01 09:00:00 AM PDT-0700", "message": {"role": "assistant", "content": "hi", "api_response": object()}}])
+    journal.close()
+    journal = MessageJournal(journal.path)
+    assert journal.load()[0][-1]["message"] == {"role": "assistant", "content": "hi"}
+    journal.close()
+
+
+def journaled_manager():
+    manager = InMemoryStateManager()
+    agent = Agent(manager, [{"role": "system", "content": "system prompt"}])
+    agent.append({"role": "user", "content": "first"})
+    return manager, agent
+
+
+def test_manager_saves_only_what_changed(tmp_path):
+    manager, agent = journaled_manager()
+    first = str(tmp_path / "first.persistence.pickle")
+    manager.save(first)
+    assert manager.journal.path == str(tmp_path / "first.persistence.journal")
+    agent.append(*[{"role": "user", "content": f"message number {i}"} for i in range(100)])
+    second = str(tmp_path / "second.persistence.pickle")
+    manager.save(second)
+    # the pickles record how far into the journal they are, not the messages
+    with open(second, "rb") as f:
+        assert b"message number" not in f.read()
+    manager.close()
+    loaded = InMemoryStateManager.load(second)
+    try:
+        assert contents_of(loaded.all_messages) == ["system prompt", "first"] + [f"message number {i}" for i in range(100)]
+        assert contents_of(loaded.journal.load()[1]) == contents_of(loaded.all_messages)
+        assert loaded.recover() == 0
+    finally:
+        loaded.close()
+
+
+def test_manager_recovers_what_was_logged_after_the_last_save(tmp_path):
+    manager, agent = journaled_manager()
+    filename = str(tmp_path / "agent.persistence.pickle")
+    manager.save(filename)
+    agent.append({"role": "user", "content": "unsaved"})
+    agent.summarize(2, {"role": "user", "content": "Summary: first"})
+    # the process ends without saving again
+    manager.close()
+    loaded = InMemoryStateManager.load(filename)
+    try:
+        # the checkpoint, exactly as saved
+        assert contents_of(loaded.all_messages) == ["system prompt", "first"]
+        assert loaded.recover() == 3
+        assert contents_of(loaded.all_messages) == ["system prompt", "first", "unsaved", "Summary: first"]
+        assert contents_of(loaded.journal.load()[1]) == ["system prompt", "Summary: first", "unsaved"]
+        assert contents_of(loaded.journal.load()[0]) == contents_of(loaded.all_messages)
+    finally:
+        loaded.close()
+
+
+def test_manager_branches_off_an_older_checkpoint(tmp_path):
+    manager, agent = journaled_manager()
+    first = str(tmp_path / "first.persistence.pickle")
+    manager.save(first)
+    agent.append({"role": "user", "content": "on main"})
+    main = str(tmp_path / "main.persistence.pickle")
+    manager.save(main)
+    manager.close()
+
+    branch = InMemoryStateManager.load(first)
+    # an older checkpoint: what came after it is in the later checkpoint, not recovered
+    assert branch.recover() == 0
+    assert contents_of(branch.all_messages) == ["system prompt", "first"]
+    branch.append_to_messages([{"role": "user", "content": "on the branch"}])
+    branch_file = str(tmp_path / "branch.persistence.pickle")
+    branch.save(branch_file)
+    branch.close()
+    for filename, expected in [(first, ["first"]), (main, ["first", "on main"]), (branch_file, ["first", "on the branch"])]:
+        loaded = InMemoryStateManager.load(filename)
+        try:
+            assert contents_of(loaded.all_messages) == ["system prompt"] + expected
+        finally:
+            loaded.close()
+
+
+def test_agent_checkpoints_refer_to_the_journal(tmp_path, run_main):
+    agent = run_main()
+    agent.append_to_messages([{"role": "user", "content": "before the first save"}])
+    first = str(tmp_path / "first.json")
+    agent.save_to_json_file(first)
+    agent.persistence_manager.save(first.replace(".json", ".persistence.pickle"))
+    first_messages = [dict(m) for m in agent.messages]
+    agent.append_to_messages([{"role": "user", "content": "after the first save"}])
+    second = str(tmp_path / "second.json")
+    agent.save_to_json_file(second)
+    agent.persistence_manager.save(second.replace(".json", ".persistence.pickle"))
+    with open(second) as f:
+        state = json.load(f)
+    assert state["messages"] is None and state["messages_journal"]["path"] == str(tmp_path / "first.persistence.journal")
+
+    memgpt.main.load(agent, first)
+    assert agent.messages == first_messages
+    assert contents_of(agent.persistence_manager.all_messages)[-1] == "before the first save"
+    memgpt.main.load(agent, second)
+    assert agent.messages[-1]["content"] == "after the first save"
+    agent.persistence_manager.close()
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import pickle
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from memgpt.memory import MmapArchivalMemory
+from memgpt.persistence_manager import InMemoryStateManager, InMemoryStateManagerWithMmap
+from memgpt.utils import locked_file
+
+
+def archive_with(path, contents):
+    memory = MmapArchivalMemory(path)
+    for content in contents:
+        asyncio.run(memory.insert(content))
+    return memory
+
+
+def test_insert_search_and_page(tmp_path):
+    memory = archive_with(str(tmp_path / "archive"), ["the cat sat", "dogs bark loudly", "a cat and a dog"])
+    assert len(memory) == 3
+    matches, total = asyncio.run(memory.search("cat"))
+    assert total == 3
+    assert [m["content"] for m in matches[:2]] == ["the cat sat", "a cat and a dog"]
+    assert "timestamp" in matches[0]
+    page, _ = asyncio.run(memory.search("cat", count=1, start=1))
+    assert [m["content"] for m in page] == ["a cat and a dog"]
+
+
+def test_empty_archive(tmp_path):
+    memory = MmapArchivalMemory(str(tmp_path / "archive"))
+    assert len(memory) == 0
+    assert asyncio.run(memory.search("anything")) == ([], 0)
+
+
+def test_reopen_and_unpickle(tmp_path):
+    path = str(tmp_path / "archive")
+    archive_with(path, ["the cat sat", "dogs bark loudly"])
+    reopened = MmapArchivalMemory(path)
+    assert len(reopened) == 2
+    assert reopened.dim == 1536
+    matches, _ = asyncio.run(reopened.search("dogs"))
+    assert matches[0]["content"] == "dogs bark loudly"
+    # only the location is pickled
+    data = pickle.dumps(reopened)
+    assert b"dogs bark" not in data
+    unpickled = pickle.loads(data)
+    assert asyncio.run(unpickled.search("dogs")) == asyncio.run(reopened.search("dogs"))
+
+
+def test_inserts_of_another_instance_are_seen(tmp_path):
+    path = str(tmp_path / "archive")
+    reader = archive_with(path, ["the cat sat"])
+    assert asyncio.run(reader.search("cat"))[1] == 1
+    writer = MmapArchivalMemory(path)
+    asyncio.run(writer.insert("dogs bark loudly"))
+    matches, total = asyncio.run(reader.search("dogs"))
+    assert total == 2
+    assert matches[0]["content"] == "dogs bark loudly"
+
+
+def test_dimension_mismatch(tmp_path):
+    memory = archive_with(str(tmp_path / "archive"), ["the cat sat"])
+    with pytest.raises(ValueError):
+        asyncio.run(memory.insert("short", embedding=[1.0, 0.0]))
+    assert len(memory) == 1
+
+
+def test_recover_interrupted_insert(tmp_path):
+    path = str(tmp_path / "archive")
+    memory = archive_with(path, ["the cat sat", "dogs bark loudly"])
+    sizes = {name: os.path.getsize(memory._file(name)) for name in [memory.EMBEDDINGS_FILE, memory.CONTENTS_FILE, memory.OFFSETS_FILE]}
+    # an insert that died after writing its embedding and part of its record, and half of its offset
+    with open(memory._file(memory.EMBEDDINGS_FILE), "ab") as f:
+        f.write(np.ones(memory.dim, dtype=np.float32).tobytes())
+    with open(memory._file(memory.CONTENTS_FILE), "ab") as f:
+        f.write(b'{"timestamp": "x", "con')
+    with open(memory._file(memory.OFFSETS_FILE), "ab") as f:
+        f.write(b"\0\0\0\0")
+
+    recovered = MmapArchivalMemory(path)
+    assert len(recovered) == 2
+    assert {name: os.path.getsize(recovered._file(name)) for name in sizes} == sizes
+    asyncio.run(recovered.insert("birds sing"))
+    matches, total = asyncio.run(recovered.search("birds"))
+    assert total == 3
+    assert matches[0]["content"] == "birds sing"
+
+
+def test_recover_empty_archive(tmp_path):
+    path = str(tmp_path / "archive")
+    memory = MmapArchivalMemory(path)
+    with open(memory._file(memory.CONTENTS_FILE), "ab") as f:
+        f.write(b'{"timestamp": "x"')
+    assert len(MmapArchivalMemory(path)) == 0
+    assert os.path.getsize(memory._file(memory.CONTENTS_FILE)) == 0
+
+
+def test_opening_waits_for_an_insert_in_progress(tmp_path):
+    path = str(tmp_path / "archive")
+    memory = archive_with(path, ["the cat sat"])
+    opened = []
+    with locked_file(memory._file(memory.LOCK_FILE)):
+        # what an unfinished insert wrote so far mustn't be cut off while it's still running
+        with open(memory._file(memory.CONTENTS_FILE), "ab") as f:
+            f.write(b'{"timestamp": "x", "content": "in progress"}\n')
+        thread = threading.Thread(target=lambda: opened.append(MmapArchivalMemory(path)))
+        thread.start()
+        time.sleep(0.2)
+        assert opened == []
+    thread.join(5)
+    assert len(opened) == 1
+
+
+def test_manager_reload_keeps_the_archive_on_disk(tmp_path):
+    agent = SimpleNamespace(messages=[{"role": "system", "content": "system prompt"}], memory=None)
+    manager = InMemoryStateManagerWithMmap(str(tmp_path / "archive"))
+    manager.init(agent)
+    asyncio.run(manager.archival_memory.insert("the cat sat"))
+    filename = str(tmp_path / "agent.persistence.pickle")
+    manager.save(filename)
+    loaded = InMemoryStateManager.load(filename)
+    assert isinstance(loaded.archival_memory, MmapArchivalMemory)
+    matches, total = asyncio.run(loaded.archival_memory.search("cat"))
+    assert (total, matches[0]["content"]) == (1, "the cat sat")
+
+
+def test_cli_option(tmp_path, run_main):
+    path = str(tmp_path / "archive")
+    agent = run_main(archival_storage_mmap_path=path)
+    assert isinstance(agent.persistence_manager, InMemoryStateManagerWithMmap)
+    assert agent.persistence_manager.archival_memory.path == path
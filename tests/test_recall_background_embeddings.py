@@ -0,0 +1,164 @@
+import asyncio
+import pickle
+from types import SimpleNamespace
+
+import openai
+
+from memgpt.memory import DummyRecallMemoryWithEmbeddings
+from memgpt.persistence_manager import InMemoryStateManager, InMemoryStateManagerWithEmbeddings
+
+from .test_recall_text_search import message
+
+
+def conversation():
+    return [
+        message("system", "system prompt"),
+        message("user", "my cat is called Tom"),
+        message("assistant", "Tom is a great name for a cat"),
+        message("function", "function output"),
+        message("assistant", None),
+        message("user", "my cat is called Tom"),
+        message("user", "the weather is sunny"),
+    ]
+
+
+SEARCHABLE = ["my cat is called Tom", "Tom is a great name for a cat", "the weather is sunny"]
+
+
+def contents_of(matches):
+    return [d["message"]["content"] for d in matches]
+
+
+def searchable_total(memory):
+    """Number of messages a search can find, ie. the embedded ones (without starting to embed new ones)"""
+    only_preloaded = memory.only_use_preloaded_embeddings
+    memory.only_use_preloaded_embeddings = True
+    try:
+        return asyncio.run(memory.text_search("anything"))[1]
+    finally:
+        memory.only_use_preloaded_embeddings = only_preloaded
+
+
+def test_new_messages_are_embedded_in_the_background(embedding_requests):
+    memory = DummyRecallMemoryWithEmbeddings(message_database=conversation())
+
+    async def run():
+        memory.index_new_messages()
+        # queued, but not embedded yet: not searchable
+        assert (await memory.text_search("cat"))[1] == 0
+        await memory.wait_for_embeddings()
+        return await memory.text_search("cat", count=2)
+
+    matches, total = asyncio.run(run())
+    # one batch with every distinct searchable message, besides the queries
+    assert [request for request in embedding_requests if request != ["cat"]] == [SEARCHABLE]
+    assert total == 4
+    assert set(contents_of(matches)) <= {"my cat is called Tom", "Tom is a great name for a cat"}
+
+
+def test_messages_are_embedded_in_batches(embedding_requests):
+    messages = [message("user", f"message number {i}") for i in range(10)]
+    memory = DummyRecallMemoryWithEmbeddings(message_database=messages)
+    memory.EMBEDDING_BATCH_SIZE = 4
+    asyncio.run(memory.wait_for_embeddings())
+    assert [len(request) for request in embedding_requests] == [4, 4, 2]
+    assert searchable_total(memory) == 10
+
+
+def test_unembedded_messages_are_skipped_by_searches(embedding_requests):
+    memory = DummyRecallMemoryWithEmbeddings(message_database=conversation())
+    # appended outside of an event loop, nothing can run the task yet
+    memory.index_new_messages()
+    assert embedding_requests == []
+
+    async def run():
+        # the search starts the task, but doesn't wait for it
+        first = await memory.text_search("cat")
+        await memory.wait_for_embeddings()
+        return first, await memory.text_search("cat")
+
+    (first, first_total), (_, total) = asyncio.run(run())
+    assert (first, first_total) == ([], 0)
+    assert total == 4
+
+
+def test_failed_batches_are_retried(monkeypatch, embedding_requests):
+    async def fail(input, model, **kwargs):
+        raise openai.error.APIConnectionError("no network")
+
+    memory = DummyRecallMemoryWithEmbeddings(message_database=conversation())
+    with monkeypatch.context() as m:
+        m.setattr(openai.Embedding, "acreate", staticmethod(fail))
+        asyncio.run(memory.wait_for_embeddings())
+    assert searchable_total(memory) == 0
+    asyncio.run(memory.wait_for_embeddings())
+    assert searchable_total(memory) == 4
+    assert [request for request in embedding_requests if request != ["anything"]] == [SEARCHABLE]
+
+
+def test_close_keeps_the_queue(monkeypatch, embedding_requests):
+    started = []
+
+    async def slow(input, model, **kwargs):
+        started.append(list(input))
+        await asyncio.sleep(60)
+
+    memory = DummyRecallMemoryWithEmbeddings(message_database=conversation())
+
+    async def run():
+        memory.index_new_messages()
+        await asyncio.sleep(0.01)
+        memory.close()
+        await asyncio.sleep(0)
+
+    with monkeypatch.context() as m:
+        m.setattr(openai.Embedding, "acreate", staticmethod(slow))
+        asyncio.run(run())
+    assert started == [SEARCHABLE]
+    assert memory._embedding_task is None
+    # the queue is saved, and embedded after loading
+    loaded = pickle.loads(pickle.dumps(memory))
+    assert searchable_total(loaded) == 0
+    asyncio.run(loaded.wait_for_embeddings())
+    assert searchable_total(loaded) == 4
+    assert [request for request in embedding_requests if request != ["anything"]] == [SEARCHABLE]
+
+
+def test_embedding_resumes_in_a_new_event_loop(embedding_requests):
+    messages = [message("user", "first message")]
+    memory = DummyRecallMemoryWithEmbeddings(message_database=messages)
+    asyncio.run(memory.wait_for_embeddings())
+    messages.append(message("user", "second message"))
+    asyncio.run(memory.wait_for_embeddings())
+    assert embedding_requests == [["first message"], ["second message"]]
+
+
+def test_preloaded_embeddings_only(embedding_requests):
+    memory = DummyRecallMemoryWithEmbeddings(message_database=conversation())
+    memory.only_use_preloaded_embeddings = True
+    asyncio.run(memory.wait_for_embeddings())
+    assert embedding_requests == []
+    assert searchable_total(memory) == 0
+
+
+def test_manager_embeds_appended_messages_and_closes(tmp_path, embedding_requests):
+    manager = InMemoryStateManagerWithEmbeddings()
+    manager.init(SimpleNamespace(messages=[{"role": "system", "content": "system prompt"}], memory=None))
+
+    async def run():
+        manager.append_to_messages([{"role": "user", "content": "remember the blue door"}])
+        await manager.recall_memory.wait_for_embeddings()
+        manager.append_to_messages([{"role": "assistant", "content": "the door is blue"}])
+        manager.close()
+
+    asyncio.run(run())
+    assert embedding_requests == [["remember the blue door"]]
+    filename = str(tmp_path / "agent.persistence.pickle")
+    manager.save(filename)
+    loaded = InMemoryStateManager.load(filename)
+    asyncio.run(loaded.recall_memory.wait_for_embeddings())
+    assert embedding_requests == [["remember the blue door"], ["the door is blue"]]
+    # managers without background work can be closed too
+    plain = InMemoryStateManager()
+    plain.init(SimpleNamespace(messages=[{"role": "system", "content": "system prompt"}], memory=None))
+    plain.close()
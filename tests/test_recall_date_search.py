@@ -0,0 +1,107 @@
+import asyncio
+import pickle
+import random
+
+import pytest
+
+from memgpt.memory import DummyRecallMemory
+from memgpt.utils import TimeIndex, timestamp_to_epoch
+
+from .test_recall_text_search import message
+
+
+def date_search(memory, start_date, end_date, **kwargs):
+    return asyncio.run(memory.date_search(start_date, end_date, **kwargs))
+
+
+def brute_force(messages, start_date, end_date):
+    return [
+        d for d in messages
+        if d["message"]["role"] not in ["system", "function"] and start_date <= d["timestamp"][:10] <= end_date
+    ]
+
+
+def dated_messages(days, roles=("user", "assistant", "system", "function")):
+    rng = random.Random(0)
+    return [
+        message(rng.choice(roles), f"message {i}", timestamp=f"2023-10-{day:02d} {rng.randint(1, 12):02d}:{rng.randint(0, 59):02d}:00 {rng.choice(['AM', 'PM'])} PDT-0700")
+        for i, day in enumerate(days)
+    ]
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_matches_a_full_scan(ordered):
+    days = sorted(random.Random(1).randint(1, 28) for _ in range(200))
+    if not ordered:
+        random.Random(2).shuffle(days)
+    messages = dated_messages(days)
+    if ordered:
+        # within a day the time of day goes up too
+        messages.sort(key=lambda d: timestamp_to_epoch(d["timestamp"]))
+    memory = DummyRecallMemory(message_database=messages)
+    for start_date, end_date in [("2023-10-01", "2023-10-31"), ("2023-10-05", "2023-10-05"), ("2023-10-10", "2023-10-20"), ("2023-11-01", "2023-11-30")]:
+        expected = brute_force(messages, start_date, end_date)
+        matches, total = date_search(memory, start_date, end_date)
+        assert total == len(expected)
+        assert (matches if ordered else sorted(matches, key=messages.index)) == expected
+
+
+def test_paging():
+    messages = [message("user", f"message {i}", timestamp=f"2023-10-{1 + i // 3:02d} 0{1 + i % 3}:00:00 PM PDT-0700") for i in range(30)]
+    memory = DummyRecallMemory(message_database=messages)
+    assert date_search(memory, "2023-10-02", "2023-10-04", count=4) == (messages[3:7], 9)
+    assert date_search(memory, "2023-10-02", "2023-10-04", count=4, start=4) == (messages[7:11], 9)
+    assert date_search(memory, "2023-10-02", "2023-10-04", count=4, start=8) == (messages[11:12], 9)
+    assert date_search(memory, "2023-10-02", "2023-10-04", start=7) == (messages[10:12], 9)
+    assert date_search(memory, "2023-10-02", "2023-10-04", count=4, start=20) == ([], 9)
+
+
+def test_out_of_order_paging():
+    messages = [
+        message("user", "third", timestamp="2023-10-03 09:00:00 AM PDT-0700"),
+        message("user", "first", timestamp="2023-10-01 09:00:00 AM PDT-0700"),
+        message("user", "second", timestamp="2023-10-02 09:00:00 AM PDT-0700"),
+    ]
+    memory = DummyRecallMemory(message_database=messages)
+    pages = [date_search(memory, "2023-10-01", "2023-10-03", count=1, start=i) for i in range(3)]
+    assert all(total == 3 for _, total in pages)
+    assert sorted(page[0]["message"]["content"] for page, _ in pages) == ["first", "second", "third"]
+
+
+def test_empty_and_invalid_ranges():
+    memory = DummyRecallMemory(message_database=dated_messages([1, 2, 3], roles=("user",)))
+    assert date_search(memory, "2023-10-03", "2023-10-01") == ([], 0)
+    assert date_search(DummyRecallMemory(), "2023-10-01", "2023-10-03") == ([], 0)
+    with pytest.raises(ValueError, match="YYYY-MM-DD"):
+        date_search(memory, "October 1st", "2023-10-03")
+
+
+def test_unparsable_timestamps_are_skipped():
+    messages = [message("user", "when?", timestamp="some day"), message("user", "now", timestamp="2023-10-01 09:00:00 AM PDT-0700")]
+    assert date_search(DummyRecallMemory(message_database=messages), "1970-01-01", "2023-12-31") == (messages[1:], 1)
+
+
+def test_new_messages_and_reload():
+    messages = dated_messages([1, 2], roles=("user",))
+    memory = DummyRecallMemory(message_database=messages)
+    assert date_search(memory, "2023-10-01", "2023-10-31")[1] == 2
+    messages.append(message("assistant", "later", timestamp="2023-10-20 09:00:00 AM PDT-0700"))
+    messages.append(message("function", "hidden", timestamp="2023-10-20 09:00:00 AM PDT-0700"))
+    assert date_search(memory, "2023-10-20", "2023-10-20") == (messages[2:3], 1)
+    data = pickle.dumps(memory)
+    assert b"_date_index" not in data
+    assert date_search(pickle.loads(data), "2023-10-01", "2023-10-31") == (messages[:3], 3)
+
+
+def test_time_index_page():
+    index = TimeIndex()
+    index.add([10.0, 20.0, 20.0, 30.0], positions=[0, 2, 5, 7])
+    assert list(index.page(15.0, 31.0)[0]) == [2, 5, 7]
+    assert list(index.page(15.0, 31.0, start=1, count=1)[0]) == [5]
+    assert index.page(15.0, 31.0, start=1, count=1)[1] == 3
+    assert list(index.page(15.0, 31.0, start=5, count=2)[0]) == []
+    assert index.page(40.0, 10.0)[1] == 0
+    # out of order entries: pages are in position order
+    index.add([5.0], positions=[9])
+    assert list(index.page(0.0, 21.0, count=2)[0]) == [0, 2]
+    assert list(index.page(0.0, 21.0, start=3)[0]) == [9]
@@ -0,0 +1,130 @@
+import asyncio
+import pickle
+
+import numpy as np
+
+from memgpt.memory import DummyRecallMemoryWithEmbeddings
+from memgpt.utils import normalize_embeddings, quantize_embeddings, top_k_indices
+
+from .conftest import fake_embedding
+from .test_recall_text_search import message
+
+
+def embedded_memory(messages):
+    memory = DummyRecallMemoryWithEmbeddings(message_database=messages)
+    asyncio.run(memory.wait_for_embeddings())
+    return memory
+
+
+def search(memory, query, **kwargs):
+    return asyncio.run(memory.text_search(query, **kwargs))
+
+
+def brute_force(messages, query):
+    """Searchable messages by cosine similarity to the query, ties in message order"""
+    pool = [d for d in messages if d["message"]["role"] not in ["system", "function"] and d["message"]["content"] is not None]
+    scores = normalize_embeddings([fake_embedding(d["message"]["content"]) for d in pool]) @ normalize_embeddings(fake_embedding(query))
+    return [pool[i] for i in np.argsort(-scores, kind="stable")]
+
+
+MESSAGES = [
+    message("system", "system prompt about cats"),
+    message("user", "hi"),
+    message("assistant", "hi"),
+    message("user", "my cat is called Tom"),
+    message("function", "cat facts"),
+    message("assistant", "Tom is a great name for a cat"),
+    message("user", "the weather is sunny"),
+    message("assistant", None),
+    message("user", "hi"),
+]
+
+
+def test_repeated_messages_get_their_own_rows(embedding_requests):
+    memory = embedded_memory(list(MESSAGES))
+    # every searchable message is a row, but a repeated text is only embedded once
+    assert embedding_requests == [["hi", "my cat is called Tom", "Tom is a great name for a cat", "the weather is sunny"]]
+    matches, total = search(memory, "hi", count=3)
+    assert total == 6
+    assert matches == [MESSAGES[1], MESSAGES[2], MESSAGES[8]]
+
+
+def test_matches_a_full_ranking():
+    memory = embedded_memory(list(MESSAGES))
+    for query in ["cat", "Tom", "sunny weather", "hi", "zebra"]:
+        matches, total = search(memory, query)
+        assert matches == brute_force(MESSAGES, query), query
+        assert total == 6
+
+
+def test_pages_are_slices_of_the_full_ranking():
+    # many exact ties: every message has the query word and one other word
+    messages = [message("user", f"cat {word}") for word in ["apple", "banana", "cherry", "date", "elder", "fig", "grape"]]
+    messages += [message("user", "cat cat grape"), message("user", "dog")]
+    memory = embedded_memory(messages)
+    everything, total = search(memory, "cat")
+    assert everything == brute_force(messages, "cat")
+    for count in [1, 2, 3, 4]:
+        pages = []
+        for start in range(0, total, count):
+            page, page_total = search(memory, "cat", count=count, start=start)
+            assert page_total == total
+            pages += page
+        assert pages == everything, count
+    assert search(memory, "cat", count=2, start=total) == ([], total)
+
+
+def test_empty_memory(embedding_requests):
+    memory = embedded_memory([message("system", "system prompt")])
+    assert search(memory, "anything", count=3) == ([], 0)
+    assert search(DummyRecallMemoryWithEmbeddings(), "anything") == ([], 0)
+
+
+def test_pickle_round_trip():
+    messages = list(MESSAGES)
+    memory = embedded_memory(messages)
+    unpickled = pickle.loads(pickle.dumps(memory))
+    assert search(unpickled, "cat") == search(memory, "cat")
+    # the unpickled memory keeps embedding new messages
+    unpickled._message_logs.append(message("user", "a cat on a hat"))
+    asyncio.run(unpickled.wait_for_embeddings())
+    assert search(unpickled, "cat hat", count=1) == ([unpickled._message_logs[-1]], 7)
+
+
+def test_unpickling_a_string_keyed_embedding_dict(embedding_requests):
+    """Memories pickled with a message string -> embedding dict load into the matrix"""
+    messages = list(MESSAGES)
+    state = DummyRecallMemoryWithEmbeddings(message_database=messages).__getstate__()
+    for key in ["_embeddings", "_row_positions", "_pending_positions", "_n_queued"]:
+        state.pop(key, None)
+    data, scales = quantize_embeddings(normalize_embeddings([fake_embedding("my cat is called Tom")]), "int8")
+    state["embeddings"] = {
+        # raw list of floats
+        "hi": fake_embedding("hi"),
+        # compressed row
+        "my cat is called Tom": (data[0], scales[0]),
+        "Tom is a great name for a cat": (quantize_embeddings(normalize_embeddings(fake_embedding("Tom is a great name for a cat")), "float16")[0], None),
+    }
+    memory = DummyRecallMemoryWithEmbeddings.__new__(DummyRecallMemoryWithEmbeddings)
+    memory.__setstate__(pickle.loads(pickle.dumps(state)))
+    assert "embeddings" not in memory.__dict__
+    # "the weather is sunny" had no embedding, it's queued
+    matches, total = search(memory, "cat Tom", count=2)
+    assert total == 5
+    assert set(d["message"]["content"] for d in matches) == {"my cat is called Tom", "Tom is a great name for a cat"}
+    asyncio.run(memory.wait_for_embeddings())
+    assert ["the weather is sunny"] in embedding_requests
+    assert search(memory, "sunny weather", count=1) == ([messages[6]], 6)
+
+
+def test_top_k_ties_at_the_cutoff_go_to_the_lowest_indices():
+    scores = np.array([0.5, 0.9, 0.5, 0.5, 0.1, 0.5])
+    assert list(top_k_indices(scores, 2)) == [1, 0]
+    assert list(top_k_indices(scores, 3)) == [1, 0, 2]
+    assert list(top_k_indices(scores, 5)) == [1, 0, 2, 3, 5]
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        scores = rng.integers(0, 4, size=30).astype(np.float32)
+        full = list(top_k_indices(scores))
+        for k in [1, 5, 12, 29]:
+            assert list(top_k_indices(scores, k)) == full[:k]
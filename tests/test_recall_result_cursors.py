@@ -0,0 +1,126 @@
+import asyncio
+import pickle
+
+import pytest
+
+from memgpt.memory import DummyRecallMemory, DummyRecallMemoryWithEmbeddings
+
+from .test_recall_text_search import message
+
+
+def search(memory, query, **kwargs):
+    return asyncio.run(memory.text_search(query, **kwargs))
+
+
+def all_pages(memory, query, count):
+    pages, total = [], None
+    start = 0
+    while total is None or start < total:
+        page, total = search(memory, query, count=count, start=start)
+        pages += page
+        start += count
+    return pages, total
+
+
+@pytest.fixture
+def counted(monkeypatch):
+    """Counts the calls of a method of one object"""
+
+    def count(obj, name):
+        calls = []
+        method = getattr(obj, name)
+
+        def wrapper(*args, **kwargs):
+            calls.append(args)
+            return method(*args, **kwargs)
+
+        monkeypatch.setattr(obj, name, wrapper)
+        return calls
+
+    return count
+
+
+def notes(n):
+    return [message("user", f"note number {i}") for i in range(n)]
+
+
+def test_pages_of_a_text_search_run_it_once(counted):
+    messages = notes(25)
+    memory = DummyRecallMemory(message_database=messages)
+    calls = counted(memory, "_matching_positions")
+    assert all_pages(memory, "note", count=4) == (messages, 25)
+    assert len(calls) == 1
+    # another query, and the same query in the other mode, are searches of their own
+    search(memory, "number 1", count=4)
+    memory.restrict_search_to_summaries = True
+    search(memory, "note", count=4)
+    assert len(calls) == 3
+
+
+def test_new_messages_invalidate_the_results(counted):
+    messages = notes(5)
+    memory = DummyRecallMemory(message_database=messages)
+    calls = counted(memory, "_matching_positions")
+    assert search(memory, "note", count=2) == (messages[:2], 5)
+    messages.append(message("assistant", "another note"))
+    assert search(memory, "note", count=2, start=4) == (messages[4:6], 6)
+    assert len(calls) == 2
+
+
+def test_empty_results_and_pages_past_the_end(counted):
+    memory = DummyRecallMemory(message_database=notes(3))
+    calls = counted(memory, "_matching_positions")
+    assert search(memory, "zebra", count=2) == ([], 0)
+    assert search(memory, "zebra", count=2, start=2) == ([], 0)
+    assert search(memory, "note", count=2, start=10) == ([], 3)
+    assert len(calls) == 2
+
+
+def test_results_are_left_out_of_the_pickle():
+    messages = notes(5)
+    memory = DummyRecallMemory(message_database=messages)
+    search(memory, "note", count=2)
+    data = pickle.dumps(memory)
+    assert b"_results_cache" not in data
+    assert search(pickle.loads(data), "note", count=2, start=2) == (messages[2:4], 5)
+
+
+def test_a_small_budget_still_gives_the_right_pages(monkeypatch):
+    monkeypatch.setattr(DummyRecallMemory, "RESULTS_CACHE_MAX_BYTES", 16)
+    messages = notes(10)
+    memory = DummyRecallMemory(message_database=messages)
+    assert all_pages(memory, "note", count=3) == (messages, 10)
+
+
+def embedded_memory(messages):
+    memory = DummyRecallMemoryWithEmbeddings(message_database=messages)
+    asyncio.run(memory.wait_for_embeddings())
+    return memory
+
+
+def test_pages_of_an_embedding_search_deepen_the_ranking(counted):
+    # ties everywhere, the pages still line up
+    messages = [message("user", f"cat {word}") for word in ["apple", "banana", "cherry", "date", "elder", "fig", "grape", "honey", "ice", "jam"]]
+    memory = embedded_memory(messages)
+    # the full ranking, from a memory of its own
+    everything, total = search(embedded_memory(list(messages)), "cat")
+    calls = counted(memory._embeddings, "search")
+    pages, page_total = all_pages(memory, "cat", count=2)
+    assert page_total == total == 10
+    assert [d["message"]["content"] for d in pages] == [d["message"]["content"] for d in everything]
+    # the ranked depth doubles, so 5 pages take fewer than 5 rankings
+    assert len(calls) < 5
+    calls.clear()
+    # every page of the cached ranking comes from the cache
+    for start in range(0, 10, 2):
+        search(memory, "cat", count=2, start=start)
+    assert calls == []
+
+
+def test_newly_embedded_messages_invalidate_the_ranking():
+    messages = [message("user", "cat one"), message("user", "dog")]
+    memory = embedded_memory(messages)
+    assert search(memory, "cat", count=1) == ([messages[0]], 2)
+    messages.append(message("user", "cat cat cat"))
+    asyncio.run(memory.wait_for_embeddings())
+    assert search(memory, "cat", count=1) == ([messages[2]], 3)
@@ -0,0 +1,148 @@
+import asyncio
+import pickle
+import random
+from types import SimpleNamespace
+
+from memgpt.memory import DummyRecallMemory, DummyRecallMemoryWithEmbeddings
+from memgpt.persistence_manager import InMemoryStateManager
+
+from .test_recall_text_search import message
+
+
+def search(memory, query, **kwargs):
+    return asyncio.run(memory.text_search(query, **kwargs))
+
+
+def contents_of(matches):
+    return [d["message"]["content"] for d in matches]
+
+
+def summarized_log():
+    """Two summarized spans, the summaries, and a message no summary covers"""
+    messages = [
+        message("system", "system prompt about apples"),
+        message("user", "we talked about apples"),
+        message("assistant", "apples are red"),
+        message("user", "bananas are yellow"),
+        message("assistant", "I like bananas more than apples"),
+        message("user", "Summary: the user likes apples"),
+        message("user", "Summary: the user likes bananas"),
+        message("user", "apples again"),
+    ]
+    memory = DummyRecallMemory(message_database=messages, restrict_search_to_summaries=True)
+    memory.add_summary(5, 1, 3)
+    memory.add_summary(6, 3, 5)
+    return messages, memory
+
+
+def test_only_the_spans_of_matching_summaries_are_searched():
+    messages, memory = summarized_log()
+    # the bananas span isn't searched, even though one of its messages mentions apples
+    assert search(memory, "apples") == ([messages[i] for i in [1, 2, 5, 7]], 4)
+    assert search(memory, "bananas") == ([messages[i] for i in [3, 4, 6]], 3)
+    # no summary matches, only the messages no summary covers are searched
+    assert search(memory, "again") == ([messages[7]], 1)
+    assert search(memory, "yellow") == ([], 0)
+    # too short to have trigrams
+    assert contents_of(search(memory, "ap")[0]) == ["we talked about apples", "apples are red", "Summary: the user likes apples", "apples again"]
+    # paging
+    assert search(memory, "apples", count=2, start=1) == ([messages[2], messages[5]], 4)
+
+
+def test_without_the_flag_everything_is_searched():
+    messages, memory = summarized_log()
+    memory.restrict_search_to_summaries = False
+    assert search(memory, "apples") == ([messages[i] for i in [1, 2, 4, 5, 7]], 5)
+    # with the flag but no summaries, it's a plain search too
+    memory = DummyRecallMemory(message_database=messages[:5], restrict_search_to_summaries=True)
+    assert search(memory, "apples") == ([messages[i] for i in [1, 2, 4]], 3)
+
+
+def test_matches_a_scoped_full_scan():
+    rng = random.Random(0)
+    words = ["red", "green", "blue", "cat", "dog"]
+    messages = [message(rng.choice(["user", "assistant", "function"]), " ".join(rng.sample(words, 2))) for _ in range(200)]
+    memory = DummyRecallMemory(message_database=messages, restrict_search_to_summaries=True)
+    summaries = []
+    for start in range(0, 180, 20):
+        end = start + rng.randint(5, 20)
+        messages.append(message("user", "summary of " + " ".join(rng.sample(words, 2))))
+        summaries.append((len(messages) - 1, start, end))
+        memory.add_summary(*summaries[-1])
+    messages += [message("user", " ".join(rng.sample(words, 2))) for _ in range(10)]
+    for query in words + ["re", "cat dog", "summary of red", "zebra"]:
+        scope = set(range(len(messages))) - {p for _, start, end in summaries for p in range(start, end)}
+        for position, start, end in summaries:
+            if query in messages[position]["message"]["content"]:
+                scope |= set(range(start, end)) | {position}
+        expected = [
+            d for position, d in enumerate(messages)
+            if position in scope and d["message"]["role"] != "function" and query in d["message"]["content"]
+        ]
+        assert search(memory, query) == (expected, len(expected)), query
+
+
+def test_summaries_are_kept_and_reindexed_after_pickling():
+    messages, memory = summarized_log()
+    search(memory, "apples")
+    data = pickle.dumps(memory)
+    assert b"_summary_postings" not in data
+    unpickled = pickle.loads(data)
+    assert search(unpickled, "bananas") == ([unpickled._message_logs[i] for i in [3, 4, 6]], 3)
+    # a summary added later is indexed too
+    unpickled._message_logs.append(message("user", "Summary: more bananas talk"))
+    unpickled.add_summary(8, 7, 8)
+    assert search(unpickled, "again") == ([], 0)
+    assert contents_of(search(unpickled, "talk")[0]) == ["Summary: more bananas talk"]
+
+
+def test_embedding_search_drills_into_the_most_similar_summaries():
+    messages, _ = summarized_log()
+    memory = DummyRecallMemoryWithEmbeddings(message_database=messages)
+    memory.SUMMARY_SEARCH_TOP_K = 1
+    asyncio.run(memory.wait_for_embeddings())
+    memory.add_summary(5, 1, 3)
+    memory.add_summary(6, 3, 5)
+    memory.restrict_search_to_summaries = True
+    matches, total = search(memory, "the user likes apples")
+    # the apples span, both summaries (no summary covers them) and the uncovered message
+    assert total == 5
+    assert sorted(messages.index(d) for d in matches) == [1, 2, 5, 6, 7]
+    assert matches[0] is messages[5]
+    memory.restrict_search_to_summaries = False
+    assert search(memory, "the user likes apples")[1] == 7
+
+
+def test_manager_links_summaries_to_the_messages_they_replace():
+    agent_messages = [{"role": "system", "content": "system prompt"}]
+    manager = InMemoryStateManager()
+    manager.init(SimpleNamespace(messages=agent_messages, memory=None))
+    shared = manager.messages is agent_messages
+
+    def append(messages):
+        manager.append_to_messages(messages)
+        if shared:
+            agent_messages.extend(messages)
+
+    append([{"role": "user", "content": "my favourite colour is green"}, {"role": "assistant", "content": "green is nice"}])
+    append([{"role": "user", "content": "I have a dog"}, {"role": "assistant", "content": "what colour is the dog?"}])
+    # the agent summarizes the two oldest messages (after the system message)
+    summary = {"role": "user", "content": "Summary: the user's favourite colour is green"}
+    manager.trim_messages(3)
+    manager.prepend_to_messages([summary])
+    if shared:
+        agent_messages[1:3] = [summary]
+    append([{"role": "user", "content": "the dog is brown, not green"}])
+    manager.configure_recall(restrict_search_to_summaries=True)
+    assert contents_of(search(manager.recall_memory, "colour")[0]) == [
+        "my favourite colour is green", "what colour is the dog?", "Summary: the user's favourite colour is green",
+    ]
+    assert contents_of(search(manager.recall_memory, "dog")[0]) == ["I have a dog", "what colour is the dog?", "the dog is brown, not green"]
+    assert contents_of(search(manager.recall_memory, "nice")[0]) == []
+
+
+def test_cli_option(run_main):
+    agent = run_main(recall_summary_search=True)
+    assert agent.persistence_manager.recall_memory.restrict_search_to_summaries
+    agent = run_main()
+    assert not agent.persistence_manager.recall_memory.restrict_search_to_summaries
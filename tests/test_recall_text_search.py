@@ -0,0 +1,110 @@
+import asyncio
+import pickle
+import random
+from types import SimpleNamespace
+
+from memgpt.memory import DummyRecallMemory
+from memgpt.persistence_manager import InMemoryStateManager
+from memgpt.utils import trigrams
+
+
+def message(role, content, timestamp="2023-10-01 09:00:00 AM PDT-0700"):
+    return {"timestamp": timestamp, "message": {"role": role, "content": content}}
+
+
+def brute_force(messages, query):
+    return [
+        d for d in messages
+        if d["message"]["role"] not in ["system", "function"] and d["message"]["content"] is not None and query.lower() in d["message"]["content"].lower()
+    ]
+
+
+def search(memory, query, **kwargs):
+    return asyncio.run(memory.text_search(query, **kwargs))
+
+
+MESSAGES = [
+    message("system", "You are a helpful assistant, remember the Password"),
+    message("user", "My password is hunter2"),
+    message("assistant", "Got it, I won't share your PASSWORD."),
+    message("function", '{"status": "OK", "message": "password saved"}'),
+    message("assistant", None),
+    message("user", "What's the weather like?"),
+    message("assistant", "Sunny, with a chance of passwords."),
+]
+
+
+def test_trigrams():
+    assert trigrams("abcd") == {"abc", "bcd"}
+    assert trigrams("aaaa") == {"aaa"}
+    assert trigrams("ab") == set()
+
+
+def test_matches_a_full_scan():
+    memory = DummyRecallMemory(message_database=list(MESSAGES))
+    for query in ["password", "PASSWORD.", "hunter", "it", "a", "", "weather like?", "zebra", "ssw", "s, w"]:
+        matches, total = search(memory, query)
+        assert matches == brute_force(MESSAGES, query), query
+        assert total == len(matches)
+
+
+def test_system_and_function_messages_are_never_found():
+    memory = DummyRecallMemory(message_database=[MESSAGES[0], MESSAGES[3]])
+    assert search(memory, "password") == ([], 0)
+    assert search(memory, "") == ([], 0)
+    assert search(DummyRecallMemory(), "anything") == ([], 0)
+
+
+def test_random_messages_match_a_full_scan():
+    rng = random.Random(0)
+    alphabet = "abcAB c"
+    messages = [message(rng.choice(["user", "assistant", "system"]), "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))) for _ in range(300)]
+    memory = DummyRecallMemory(message_database=messages)
+    for _ in range(100):
+        query = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 6)))
+        assert search(memory, query)[0] == brute_force(messages, query), query
+
+
+def test_paging():
+    messages = [message("user", f"note number {i}") for i in range(10)]
+    memory = DummyRecallMemory(message_database=messages)
+    assert search(memory, "note", count=3, start=3) == (messages[3:6], 10)
+    assert search(memory, "note", count=3) == (messages[:3], 10)
+    assert search(memory, "note", start=8) == (messages[8:], 10)
+    assert search(memory, "note", count=3, start=9) == (messages[9:], 10)
+    assert search(memory, "note", count=3, start=12) == ([], 10)
+
+
+def test_messages_appended_to_a_shared_log_are_found():
+    messages = [message("user", "the cat sat")]
+    memory = DummyRecallMemory(message_database=messages)
+    assert search(memory, "cat")[1] == 1
+    messages.append(message("assistant", "a cat, how nice"))
+    messages.append(message("function", "cat facts"))
+    assert search(memory, "cat") == (messages[:2], 2)
+
+
+def test_pickle_leaves_out_the_index():
+    messages = [message("user", f"message about topic {i}.") for i in range(200)]
+    memory = DummyRecallMemory(message_database=messages)
+    search(memory, "topic")
+    data = pickle.dumps(memory)
+    assert b"_trigram_postings" not in data
+    unpickled = pickle.loads(data)
+    assert search(unpickled, "topic 17.") == ([messages[17]], 1)
+    # saved before the index existed
+    del unpickled._trigram_postings, unpickled._role_positions, unpickled._n_indexed
+    assert search(unpickled, "topic 199.") == ([messages[199]], 1)
+
+
+def test_manager_keeps_the_index_up_to_date():
+    manager = InMemoryStateManager()
+    manager.init(SimpleNamespace(messages=[{"role": "system", "content": "system prompt"}], memory=None))
+    manager.append_to_messages([{"role": "user", "content": "remember the blue door"}])
+    assert manager.recall_memory._n_indexed == len(manager.all_messages)
+    manager.prepend_to_messages([{"role": "assistant", "content": "the door is blue"}])
+    manager.swap_system_message({"role": "system", "content": "new system prompt about doors"})
+    assert manager.recall_memory._n_indexed == len(manager.all_messages)
+    matches, total = search(manager.recall_memory, "door")
+    assert total == 2
+    assert [d["message"]["content"] for d in matches] == ["remember the blue door", "the door is blue"]
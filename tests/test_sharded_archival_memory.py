@@ -0,0 +1,161 @@
+import asyncio
+import pickle
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import memgpt.memory
+from memgpt.memory import DummyArchivalMemoryWithEmbeddings, ShardedArchivalMemory
+from memgpt.persistence_manager import InMemoryStateManager, InMemoryStateManagerWithShards
+from memgpt.utils import build_faiss_index, faiss_index_vectors
+
+from .conftest import fake_embedding
+from .test_faiss_index_types import clustered_vectors, write_index_folder
+
+
+CONTENTS = [
+    "the cat sat on the mat",
+    "a cat chased a mouse",
+    "dogs bark at the mailman",
+    "the weather report says rain",
+    "birds sing in the morning",
+    "a cat and a dog became friends",
+    "stock prices fell sharply",
+    "my cat likes the mat",
+]
+
+
+@pytest.fixture
+def shards():
+    """Makes sharded memories, and stops their worker processes after the test"""
+    made = []
+
+    def make(*args, **kwargs):
+        made.append(ShardedArchivalMemory(*args, **kwargs))
+        return made[-1]
+
+    yield make
+    for memory in made:
+        memory.close()
+
+
+def preloaded(contents):
+    return [{"timestamp": "2023-10-01 09:00:00 AM PDT-0700", "content": c, "embedding": fake_embedding(c)} for c in contents]
+
+
+def contents_of(results):
+    return [r["content"] for r in results]
+
+
+def test_search_matches_a_single_matrix(shards):
+    memory = shards(n_shards=3)
+    asyncio.run(memory.insert_many(CONTENTS))
+    reference = DummyArchivalMemoryWithEmbeddings()
+    asyncio.run(reference.insert_many(CONTENTS))
+    assert len(memory) == len(CONTENTS)
+    assert sum(size > 0 for size in memory._shard_sizes) > 1
+    for query in ["cat mat", "weather rain", "dogs"]:
+        results, total = asyncio.run(memory.search(query))
+        expected, _ = asyncio.run(reference.search(query))
+        assert total == len(CONTENTS)
+        assert contents_of(results)[0] == contents_of(expected)[0]
+        assert sorted(contents_of(results)) == sorted(CONTENTS)
+
+
+def test_paging(shards):
+    memory = shards(archival_memory_database=preloaded(CONTENTS), n_shards=2)
+    everything, total = asyncio.run(memory.search("cat mat"))
+    pages = []
+    for start in range(0, total + 3, 3):
+        page, page_total = asyncio.run(memory.search("cat mat", count=3, start=start))
+        assert page_total == total
+        pages += contents_of(page)
+    assert pages == contents_of(everything)
+    assert asyncio.run(memory.search("cat mat", count=3, start=total)) == ([], total)
+
+
+def test_empty_and_underfilled_shards(shards, embedding_requests):
+    memory = shards(n_shards=4)
+    assert len(memory) == 0
+    assert asyncio.run(memory.search("cat")) == ([], 0)
+    asyncio.run(memory.insert_many([]))
+    assert embedding_requests == []
+    # fewer memories than shards
+    asyncio.run(memory.insert("the cat sat on the mat", embedding=fake_embedding("the cat sat on the mat")))
+    assert asyncio.run(memory.search("cat", count=5))[1] == 1
+    assert "1 memories stored across 4 shards" in repr(memory)
+
+
+def test_date_filter(shards, monkeypatch):
+    timestamps = iter(["2023-10-01 09:00:00 AM PDT-0700", "2023-10-03 09:00:00 AM PDT-0700"])
+    monkeypatch.setattr(memgpt.memory, "get_local_time", lambda: next(timestamps))
+    memory = shards(n_shards=2)
+    asyncio.run(memory.insert_many(CONTENTS[:4]))
+    asyncio.run(memory.insert_many(CONTENTS[4:]))
+    results, total = asyncio.run(memory.search("cat", start_date="2023-10-02"))
+    assert total == 4 and sorted(contents_of(results)) == sorted(CONTENTS[4:])
+    assert asyncio.run(memory.search("cat", start_date="2023-10-04")) == ([], 0)
+    with pytest.raises(ValueError):
+        asyncio.run(memory.search("cat", end_date="tomorrow"))
+
+
+def test_preloaded_memories_need_embeddings(shards):
+    with pytest.raises(ValueError):
+        shards(archival_memory_database=[{"timestamp": "", "content": "the cat sat"}], n_shards=1)
+
+
+def test_pickle_round_trip(shards):
+    memory = shards(archival_memory_database=preloaded(CONTENTS), n_shards=2)
+    unpickled = pickle.loads(pickle.dumps(memory))
+    try:
+        assert unpickled.n_shards == 2 and len(unpickled) == len(CONTENTS)
+        assert asyncio.run(unpickled.search("cat mat", count=3)) == asyncio.run(memory.search("cat mat", count=3))
+    finally:
+        unpickled.close()
+    empty = pickle.loads(pickle.dumps(shards(n_shards=2)))
+    try:
+        assert asyncio.run(empty.search("cat")) == ([], 0)
+    finally:
+        empty.close()
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf-flat"])
+def test_faiss_index_vectors(index_type):
+    data = clustered_vectors(n=500, dim=16)
+    vectors = faiss_index_vectors(build_faiss_index(data, index_type=index_type))
+    np.testing.assert_allclose(vectors, data / np.linalg.norm(data, axis=1, keepdims=True), atol=1e-5)
+
+
+def test_manager_save_and_load(tmp_path):
+    index = build_faiss_index(np.array([fake_embedding(c) for c in CONTENTS], dtype=np.float32))
+    database = [{"timestamp": "2023-10-01 09:00:00 AM PDT-0700", "content": c} for c in CONTENTS]
+    manager = InMemoryStateManagerWithShards(index, database, n_shards=2)
+    manager.init(SimpleNamespace(messages=[{"role": "system", "content": "system prompt"}], memory=None))
+    try:
+        # the shards hold the archive now
+        assert manager.archival_index is None and manager.archival_memory_db is None
+        assert asyncio.run(manager.archival_memory.search("weather", count=1))[0][0]["content"] == "the weather report says rain"
+        filename = str(tmp_path / "agent.persistence.pickle")
+        manager.save(filename)
+    finally:
+        manager.archival_memory.close()
+    loaded = InMemoryStateManager.load(filename)
+    try:
+        assert isinstance(loaded.archival_memory, ShardedArchivalMemory)
+        results, total = asyncio.run(loaded.archival_memory.search("weather", count=1))
+        assert (total, results[0]["content"]) == (len(CONTENTS), "the weather report says rain")
+    finally:
+        loaded.archival_memory.close()
+
+
+def test_cli_option(tmp_path, run_main):
+    folder = str(tmp_path / "index")
+    write_index_folder(folder, CONTENTS[:3], "flat")
+    agent = run_main(archival_storage_faiss_path=folder, archival_shards=2)
+    manager = agent.persistence_manager
+    try:
+        assert isinstance(manager, InMemoryStateManagerWithShards)
+        assert manager.archival_memory.n_shards == 2 and len(manager.archival_memory) == 3
+    finally:
+        manager.archival_memory.close()
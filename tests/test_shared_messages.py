@@ -0,0 +1,129 @@
+import asyncio
+import pickle
+from types import SimpleNamespace
+
+import pytest
+from openai.openai_object import OpenAIObject
+
+import memgpt.agent
+import memgpt.main
+from memgpt.persistence_manager import InMemoryStateManager, SQLiteStateManager
+
+
+def reply(content):
+    return OpenAIObject.construct_from({
+        "choices": [{"finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        "usage": {"total_tokens": 100},
+    })
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    """Answers chat completions with the replies (or raises the exceptions) queued on the returned list"""
+    replies = []
+
+    async def acreate(**kwargs):
+        r = replies.pop(0)
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+    monkeypatch.setattr(memgpt.agent, "acreate", acreate)
+    return replies
+
+
+def logged(monkeypatch, manager):
+    """Copies of the messages appended through the persistence manager (before the agent strips their metadata)"""
+    appended = []
+    append_to_messages = manager.append_to_messages
+
+    def record(added_messages):
+        appended.extend(dict(msg) for msg in added_messages)
+        append_to_messages(added_messages)
+
+    monkeypatch.setattr(manager, "append_to_messages", record)
+    return appended
+
+
+def test_the_window_is_shared_with_the_manager(run_main, llm, monkeypatch):
+    agent = run_main()
+    window = agent.messages
+    manager = agent.persistence_manager
+    assert manager.messages is window
+    appended = logged(monkeypatch, manager)
+    before = list(window)
+    llm.append(reply("thinking about it"))
+    asyncio.run(agent.step("hello", skip_verify=True))
+    assert agent.messages is window and manager.messages is window
+    assert [msg["content"] for msg in window[len(before):]] == ["hello", "thinking about it"]
+    # the recall log holds the same message objects
+    assert manager.all_messages[-1]["message"] is window[-1]
+    # the request had the window, and the user message at its end
+    assert appended[1]["api_args"]["messages"] == before + [{"role": "user", "content": "hello"}]
+    assert "api_args" not in window[-1]
+
+
+def test_a_failed_step_leaves_the_window_as_it_was(run_main, llm):
+    agent = run_main()
+    window = agent.messages
+    before = list(window)
+    llm.append(Exception("the API is down"))
+    with pytest.raises(Exception, match="the API is down"):
+        asyncio.run(agent.step("hello", skip_verify=True))
+    assert agent.messages is window and window == before
+    assert len(agent.persistence_manager.all_messages) == len(before)
+
+
+def test_trim_prepend_and_swap_are_in_place(run_main, tmp_path):
+    agent = run_main()
+    window = agent.messages
+    manager = agent.persistence_manager
+    # the journal records the changes from the first save on
+    manager.save(str(tmp_path / "agent.persistence.pickle"))
+    agent.append_to_messages([{"role": "user", "content": f"message {i}"} for i in range(4)])
+    n = len(window)
+    agent.trim_messages(3)
+    agent.prepend_to_messages([{"role": "user", "content": "Summary"}])
+    agent.swap_system_message({"role": "system", "content": "new system prompt"})
+    assert agent.messages is window and manager.messages is window and len(window) == n - 1
+    assert window[0]["content"] == "new system prompt" and window[1]["content"] == "Summary"
+    assert [d["message"] for d in manager.journal.load()[1]] == window
+    manager.close()
+
+
+def test_loading_links_the_restored_window(run_main, tmp_path):
+    agent = run_main()
+    agent.append_to_messages([{"role": "user", "content": "remember this"}])
+    filename = str(tmp_path / "agent.json")
+    agent.save_to_json_file(filename)
+    agent.persistence_manager.save(filename.replace(".json", ".persistence.pickle"))
+    agent.append_to_messages([{"role": "user", "content": "not saved"}])
+    memgpt.main.load(agent, filename)
+    manager = agent.persistence_manager
+    assert manager.messages is agent.messages
+    assert agent.messages[-1]["content"] == "remember this"
+    # the window holds the messages of the recall log, so summaries can find what they replace
+    assert manager.all_messages[-1]["message"] is agent.messages[-1]
+    assert manager.recall_memory.positions_of(agent.messages[1:]) == list(range(1, len(agent.messages)))
+    manager.close()
+
+
+def test_pickles_with_a_timestamped_window_are_migrated():
+    manager = InMemoryStateManager()
+    manager.init(SimpleNamespace(messages=[{"role": "system", "content": "system prompt"}], memory=None))
+    # what the window looked like before it was shared
+    manager.messages = [{"timestamp": d["timestamp"], "message": d["message"]} for d in manager.all_messages]
+    loaded = pickle.loads(pickle.dumps(manager))
+    assert loaded.messages == [{"role": "system", "content": "system prompt"}]
+
+
+def test_sqlite_manager_checks_the_linked_window(tmp_path):
+    manager = SQLiteStateManager(str(tmp_path / "agent.db"))
+    try:
+        window = [{"role": "system", "content": "system prompt"}]
+        manager.init(SimpleNamespace(messages=window, memory=memgpt.agent.Memory("persona", "human")))
+        assert manager.messages is window
+        with pytest.raises(AssertionError):
+            manager.link_messages(window + [{"role": "user", "content": "unknown"}])
+    finally:
+        manager.store.close()
@@ -0,0 +1,248 @@
+import asyncio
+import random
+from types import SimpleNamespace
+
+import pytest
+
+import memgpt.sqlite_store
+from memgpt.memory import CoreMemory
+from memgpt.persistence_manager import SQLiteStateManager
+from memgpt.sqlite_store import SQLiteStore
+
+from .test_recall_text_search import brute_force, message
+
+
+@pytest.fixture
+def stores():
+    """Opens sqlite stores, and closes them after the test"""
+    opened = []
+
+    def open_store(path=":memory:"):
+        opened.append(SQLiteStore(path))
+        return opened[-1]
+
+    yield open_store
+    for store in opened:
+        store.close()
+
+
+def log(store, messages):
+    store.call(store.append_messages, store.call(store.count_messages), messages)
+
+
+def contents_of(results):
+    return [d["message"]["content"] for d in results]
+
+
+MESSAGES = [
+    message("system", "You are a helpful assistant, remember the Password"),
+    message("user", "My password is hunter2"),
+    message("assistant", "Got it, I won't share your PASSWORD."),
+    message("function", '{"status": "OK", "message": "password saved"}'),
+    message("assistant", None),
+    message("user", "What's the weather like?"),
+    message("assistant", "Sunny, with a chance of passwords."),
+]
+
+
+def test_store_is_in_wal_mode(tmp_path, stores):
+    store = stores(str(tmp_path / "agent.db"))
+    assert store.call(lambda: store._conn.execute("PRAGMA journal_mode").fetchone()[0]) == "wal"
+    assert store.has_fts5
+
+
+@pytest.mark.parametrize("fts5", [True, False])
+def test_message_search_matches_a_full_scan(monkeypatch, stores, fts5):
+    if not fts5:
+        # as if sqlite was built without FTS5
+        monkeypatch.setattr(memgpt.sqlite_store, "FTS5_SCHEMA", ["CREATE VIRTUAL TABLE missing USING no_such_module (content)"])
+    store = stores()
+    assert store.has_fts5 == fts5
+    log(store, MESSAGES)
+    for query in ["password", "PASSWORD.", "hunter", "it", "a", "", "weather like?", "zebra", 'say "hi"']:
+        matches, total = store.call(store.search_messages, query)
+        assert matches == brute_force(MESSAGES, query), query
+        assert total == len(matches)
+    assert store.call(store.search_messages, "password", 1, 1) == (MESSAGES[2:3], 3)
+    assert store.call(store.search_messages, "password", 2, 5) == ([], 3)
+
+
+def test_random_messages_match_a_full_scan(stores):
+    rng = random.Random(0)
+    alphabet = "abcAB c"
+    messages = [message(rng.choice(["user", "assistant", "system"]), "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))) for _ in range(300)]
+    store = stores()
+    log(store, messages)
+    for _ in range(100):
+        query = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 6)))
+        assert store.call(store.search_messages, query)[0] == brute_force(messages, query), query
+
+
+def test_date_search(stores):
+    messages = [
+        message("user", "third", timestamp="2023-10-03 09:00:00 AM PDT-0700"),
+        message("user", "first", timestamp="2023-10-01 09:00:00 AM PDT-0700"),
+        message("system", "hidden", timestamp="2023-10-01 10:00:00 AM PDT-0700"),
+        message("assistant", "second", timestamp="2023-10-02 09:00:00 AM PDT-0700"),
+    ]
+    store = stores()
+    log(store, messages)
+    matches, total = store.call(store.search_messages_by_date, "2023-10-01", "2023-10-03")
+    assert (contents_of(matches), total) == (["first", "second", "third"], 3)
+    assert contents_of(store.call(store.search_messages_by_date, "2023-10-01", "2023-10-03", 1, 1)[0]) == ["second"]
+    assert store.call(store.search_messages_by_date, "2023-10-04", "2023-10-31") == ([], 0)
+    with pytest.raises(ValueError):
+        store.call(store.search_messages_by_date, "yesterday", "2023-10-03")
+
+
+def test_archival_search(stores):
+    store = stores()
+    memories = [
+        {"timestamp": "2023-10-01 09:00:00 AM PDT-0700", "content": "the cat sat on the mat"},
+        {"timestamp": "2023-10-02 09:00:00 AM PDT-0700", "content": "dogs bark at cats and at the mailman"},
+        {"timestamp": "2023-10-03 09:00:00 AM PDT-0700", "content": "my cat likes the cat mat"},
+        {"timestamp": "2023-10-03 09:00:00 AM PDT-0700", "content": "the weather report says rain"},
+    ]
+    store.call(store.insert_archival, memories)
+    matches, total = store.call(store.search_archival, "cat mat")
+    assert total == 2
+    # the memory with the most mentions of the query words ranks first
+    assert [d["content"] for d in matches] == ["my cat likes the cat mat", "the cat sat on the mat"]
+    assert store.call(store.search_archival, "cat mat", 1, 1)[0] == [memories[0]]
+    assert store.call(store.search_archival, "cat", None, None, "2023-10-02", "2023-10-31") == ([memories[2]], 1)
+    assert store.call(store.search_archival, "zebra") == ([], 0)
+    # nothing to look up in the index, a plain substring search
+    assert store.call(store.search_archival, "!") == ([], 0)
+    assert store.call(store.all_archival) == memories
+
+
+def test_failed_background_writes_are_raised_by_flush(stores):
+    store = stores()
+
+    def fail():
+        raise ValueError("disk full")
+
+    store.submit(fail)
+    with pytest.raises(RuntimeError, match="disk full"):
+        store.flush()
+    # reported once
+    store.flush()
+
+
+def core_memory(human):
+    return CoreMemory(persona="I am a helpful assistant", human=human)
+
+
+class Agent(object):
+    """Drives a persistence manager like the agent does, and keeps its own in-context messages"""
+
+    def __init__(self, manager, messages):
+        self.manager = manager
+        self.messages = messages
+        manager.init(SimpleNamespace(messages=self.messages, memory=core_memory("nothing yet")))
+        # the manager either shares the agent's window, or keeps a copy of its own
+        self.shared = manager.messages is self.messages
+
+    def append(self, *messages):
+        self.manager.append_to_messages(list(messages))
+        if self.shared:
+            self.messages.extend(messages)
+
+    def summarize(self, num, summary):
+        self.manager.trim_messages(num)
+        self.manager.prepend_to_messages([summary])
+        if self.shared:
+            self.messages[1:num] = [summary]
+
+
+def context_of(manager):
+    _, context = manager.store.call(manager.store.get_context)
+    return contents_of(context)
+
+
+def test_manager_logs_every_change(tmp_path):
+    manager = SQLiteStateManager(str(tmp_path / "agent.db"))
+    agent = Agent(manager, [{"role": "system", "content": "system prompt"}])
+    agent.append({"role": "user", "content": "my favourite colour is green"}, {"role": "assistant", "content": "green is nice", "api_response": {"id": 1}})
+    agent.summarize(3, {"role": "user", "content": "Summary: the user likes green"})
+    agent.append({"role": "user", "content": "what is my favourite colour?"})
+    manager.swap_system_message({"role": "system", "content": "new system prompt"})
+    manager.update_memory(core_memory("likes green"))
+    manager.store.flush()
+    try:
+        assert context_of(manager) == ["new system prompt", "Summary: the user likes green", "what is my favourite colour?"]
+        assert len(manager.recall_memory) == 6
+        # searches see the whole log, not just the window
+        matches, total = asyncio.run(manager.recall_memory.text_search("green"))
+        assert (contents_of(matches), total) == (["my favourite colour is green", "green is nice", "Summary: the user likes green"], 3)
+        assert "api_response" not in matches[1]["message"]
+        assert asyncio.run(manager.recall_memory.date_search("1970-01-01", "2999-12-31"))[1] == 4
+        assert manager.store.call(manager.store.get_memory)["human"] == "likes green"
+        assert manager.store.call(manager.store.get_memory, 0)["human"] == "nothing yet"
+        assert "6 total messages" in repr(manager.recall_memory)
+    finally:
+        manager.store.close()
+
+
+def test_manager_checkpoints_and_branches(tmp_path):
+    manager = SQLiteStateManager(str(tmp_path / "agent.db"))
+    agent = Agent(manager, [{"role": "system", "content": "system prompt"}])
+    agent.append({"role": "user", "content": "first"})
+    first = str(tmp_path / "first.persistence.pickle")
+    manager.save(first)
+    agent.append({"role": "user", "content": "second"})
+    manager.update_memory(core_memory("said second"))
+    second = str(tmp_path / "second.persistence.pickle")
+    manager.save(second)
+    manager.store.close()
+
+    # each checkpoint is the window and core memory as they were saved
+    loaded = SQLiteStateManager.load(second)
+    assert contents_of(loaded.store.call(loaded.store.get_messages, loaded.message_ids)) == ["system prompt", "first", "second"]
+    assert loaded.memory.human == "said second"
+    loaded.store.close()
+    branch = SQLiteStateManager.load(first)
+    try:
+        assert contents_of(branch.store.call(branch.store.get_messages, branch.message_ids)) == ["system prompt", "first"]
+        assert branch.memory.human == "nothing yet"
+        # continuing from the older checkpoint keeps the whole log, and the window goes on from the checkpoint's
+        branch.append_to_messages([{"role": "user", "content": "on the branch"}])
+        branch.store.flush()
+        assert context_of(branch) == ["system prompt", "first", "on the branch"]
+        assert len(branch.recall_memory) == 4
+        assert asyncio.run(branch.recall_memory.text_search("second"))[1] == 1
+    finally:
+        branch.store.close()
+    # the later checkpoint still loads as it was saved
+    loaded = SQLiteStateManager.load(second)
+    try:
+        assert contents_of(loaded.store.call(loaded.store.get_messages, loaded.message_ids)) == ["system prompt", "first", "second"]
+    finally:
+        loaded.store.close()
+
+
+def test_manager_archival_memory(tmp_path):
+    manager = SQLiteStateManager(str(tmp_path / "agent.db"))
+    try:
+        assert len(manager.archival_memory) == 0
+        assert asyncio.run(manager.archival_memory.search("cat")) == ([], 0)
+        asyncio.run(manager.archival_memory.insert_many(["the cat sat on the mat", "dogs bark"]))
+        asyncio.run(manager.archival_memory.insert("a cat and a dog"))
+        assert len(manager.archival_memory) == 3
+        results, total = asyncio.run(manager.archival_memory.search("cat", count=1))
+        assert total == 2 and len(results) == 1
+        with pytest.raises(ValueError):
+            asyncio.run(manager.archival_memory.insert("with an embedding", embedding=[0.0, 1.0]))
+    finally:
+        manager.store.close()
+
+
+def test_cli_option(tmp_path, run_main):
+    agent = run_main(sqlite_db=str(tmp_path / "agent.db"))
+    manager = agent.persistence_manager
+    try:
+        assert isinstance(manager, SQLiteStateManager)
+        manager.store.flush()
+        assert len(manager.recall_memory) == len(agent.messages)
+    finally:
+        manager.store.close()